@@ -1,4 +1,14 @@
 """Python API to Mercurial, without using the internal Mercurial API
 """
-import hgapi as _hgapi
+from . import hgapi as _hgapi
 Repo = _hgapi.Repo
+ChangelogMirror = _hgapi.ChangelogMirror
+RevisionTable = _hgapi.RevisionTable
+ChangelogGraph = _hgapi.ChangelogGraph
+RepoGroup = _hgapi.RepoGroup
+SSHSessionManager = _hgapi.SSHSessionManager
+set_ssh_session_manager = _hgapi.set_ssh_session_manager
+from .mirror import Mirror, MirrorDaemon
+import sys as _sys
+if _sys.version_info >= (3, 5):
+    from .asyncrepo import AsyncRepo
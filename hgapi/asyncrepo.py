@@ -0,0 +1,312 @@
+"""asyncio interface to Mercurial; requires Python 3.5 or later.
+
+AsyncRepo mirrors the commonly used parts of Repo, running hg in asyncio subprocesses so that no threads are needed.
+"""
+import asyncio
+import os
+import signal
+from asyncio.subprocess import PIPE
+
+try:
+    from . import hgapi as _hgapi
+    from .fileops import fits_on_command_line, write_listfile0
+except (ImportError, ValueError): #not imported as part of the package
+    import hgapi as _hgapi
+    from fileops import fits_on_command_line, write_listfile0
+
+
+
+
+async def _communicate(proc, line_listener):
+    if line_listener is None:
+        return await proc.communicate()
+    # Read stderr alongside stdout, so that hg cannot block on a full pipe
+    err_reader = asyncio.ensure_future(proc.stderr.read())
+    try:
+        out_lines = []
+        while True:
+            line = await proc.stdout.readline()
+            if not line:
+                break
+            out_lines.append(line)
+            line_listener(line.decode('utf-8'))
+        err = await err_reader
+    finally:
+        if not err_reader.done():
+            err_reader.cancel()
+    await proc.wait()
+    return b''.join(out_lines), err
+
+
+async def _run_hg(return_code_handler, cmd, line_listener=None, timeout=None):
+    """Run hg in a subprocess and return its output, raising the exception that return_code_handler maps its return
+    code to on error. Raises asyncio.TimeoutError if it takes longer than timeout seconds; if timed out or cancelled,
+    the hg process is killed."""
+    if return_code_handler is None:
+        return_code_handler = _hgapi._default_return_code_handler
+    try:
+        # In a process group of its own, so that anything that hg starts (hooks, ssh) can be killed along with it
+        proc = await asyncio.create_subprocess_exec(*cmd, stdout=PIPE, stderr=PIPE, env=_hgapi._hg_env(),
+                                                    start_new_session=os.name != 'nt')
+    except OSError as e:
+        raise _hgapi.HGCannotLaunchError('Cannot launch hg executable: {0}'.format(e))
+    try:
+        out, err = await asyncio.wait_for(_communicate(proc, line_listener), timeout)
+    except BaseException:
+        # Timed out or cancelled; do not leave hg running
+        _kill(proc)
+        await proc.wait()
+        raise
+    out, err = out.decode('utf-8'), err.decode('utf-8')
+    if proc.returncode:
+        if return_code_handler._handle_return_code(cmd, err, out, proc.returncode):
+            return out
+        raise _hgapi.HGError("Error running %s:\n\tErr: %s\n\tOut: %s\n\tExit: %s"
+                             % (' '.join(cmd), err, out, proc.returncode))
+    return out
+
+
+def _kill(proc):
+    try:
+        if os.name != 'nt':
+            os.killpg(proc.pid, signal.SIGKILL)
+        elif proc.returncode is None:
+            proc.kill()
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+def _progress_line_listener(progress_listener, ignored_lines=()):
+    """Wrap progress_listener, passing it the non-empty lines of hg's verbose output"""
+    def line_listener(line):
+        line = line.strip()
+        if line != ''  and  line not in ignored_lines:
+            progress_listener(line)
+    return line_listener
+
+
+_PULL_IGNORED_LINES = ('(run \'hg update\' to get a working copy)',)
+
+
+_FINISHED = object()
+
+
+class CommandProgress (object):
+    """A hg command that reports its progress. It is an async iterator over the progress lines reported by hg,
+    and is awaitable for the result of the command; if the command fails, iteration ends and awaiting raises::
+
+        progress = repo.hg_pull_progress()
+        async for line in progress:
+            print(line)
+        out = await progress
+
+    The command starts running as soon as the CommandProgress is created, which must be done within a running event
+    loop, and continues whether or not the progress lines are consumed. cancel() cancels it.
+    """
+    def __init__(self, run):
+        # run(listener) is a coroutine that runs the command, calling listener with each progress line
+        self.__lines = asyncio.Queue()
+        self.__task = asyncio.ensure_future(run(self.__lines.put_nowait))
+        self.__task.add_done_callback(lambda task: self.__lines.put_nowait(_FINISHED))
+
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        line = await self.__lines.get()
+        if line is _FINISHED:
+            # Leave the marker in place, so that iterating again also ends
+            self.__lines.put_nowait(_FINISHED)
+            raise StopAsyncIteration
+        return line
+
+
+    def __await__(self):
+        return self.__task.__await__()
+
+
+    def done(self):
+        return self.__task.done()
+
+    def cancel(self):
+        return self.__task.cancel()
+
+
+
+
+class AsyncRepo (object):
+    """A representation of a Mercurial repository whose methods are coroutines; see Repo for their descriptions.
+
+    Each hg command runs in an asyncio subprocess, raising the same exceptions as the corresponding Repo method.
+    Every method takes an optional timeout in seconds (defaulting to the timeout given here; None for no limit),
+    beyond which hg is killed and asyncio.TimeoutError is raised. Cancelling a call also kills hg.
+    """
+    def __init__(self, path, user=None, ssh_key_path=None, disable_host_key_checking=False, timeout=None):
+        self.path = path
+        self.user = user
+        self.ssh_key_path = ssh_key_path
+        self.disable_host_key_checking = disable_host_key_checking
+        self.timeout = timeout
+
+
+    def __timeout(self, timeout):
+        return timeout   if timeout is not None   else self.timeout
+
+    async def __hg_command(self, return_code_handler, args, line_listener=None, timeout=None):
+        cmd = [_hgapi.get_hg_path(), "--cwd", self.path, "--encoding", "UTF-8"] + list(args)
+        return await _run_hg(return_code_handler, cmd, line_listener, self.__timeout(timeout))
+
+    async def hg_command(self, return_code_handler, *args, timeout=None):
+        """Run a hg command in path and return the result.
+        Throws on error."""
+        return await self.__hg_command(return_code_handler, args, timeout=timeout)
+
+    def __remote_args(self, args):
+        return _hgapi._hg_config_options(self.user, self.ssh_key_path, self.disable_host_key_checking) + list(args)
+
+    async def hg_remote_command(self, return_code_handler, *args, timeout=None):
+        """Run a hg command in path and return the result.
+        Throws on error.
+        Adds SSH key path"""
+        return await self.__hg_command(return_code_handler, self.__remote_args(args), timeout=timeout)
+
+    async def __hg_file_command(self, return_code_handler, args, paths, timeout):
+        """Run a hg command on the files in paths, passing them in a list file if there are many of them"""
+        paths = list(paths)
+        if len(paths) <= _hgapi.Repo.LISTFILE_THRESHOLD  and  fits_on_command_line(paths):
+            return await self.__hg_command(return_code_handler, args + paths, timeout=timeout)
+        listfile_path = write_listfile0(paths)
+        try:
+            return await self.__hg_command(return_code_handler, args + ['listfile0:' + listfile_path], timeout=timeout)
+        finally:
+            os.remove(listfile_path)
+
+
+    async def hg_id(self, timeout=None):
+        """Get the output of the hg id command"""
+        res = await self.hg_command(None, "id", "-i", timeout=timeout)
+        return res.strip("\n +")
+
+    async def hg_rev(self, timeout=None):
+        """Get the revision number of the current revision"""
+        res = await self.hg_command(None, "id", "-n", timeout=timeout)
+        return int(res.strip("\n +"))
+
+    async def hg_node(self, rev_id=None, timeout=None):
+        """Get the full node id of a revision; the working directory's parent if rev_id is None"""
+        res = await self.hg_command(None, "log", "-r", rev_id   if rev_id is not None   else ".", "--template", "{node}",
+                                    timeout=timeout)
+        return res.strip()
+
+
+    async def hg_status(self, filenames=None, timeout=None):
+        """Get repository status as a Status object"""
+        out = await self.__hg_file_command(None, ['status'], filenames   or  [], timeout)
+        return _hgapi._status_from_output(out)
+
+
+    async def hg_log(self, rev_identifier=None, limit=None, template=None, filename=None, timeout=None, **kwargs):
+        """Get repositiory log."""
+        return await self.hg_command(None, *_hgapi._log_args(rev_identifier, limit, template, filename, kwargs), timeout=timeout)
+
+    async def revisions(self, rev_identifier, timeout=None):
+        """Returns a list of Revision objects for the given identifier"""
+        out = await self.hg_log(rev_identifier=str(rev_identifier), template=_hgapi._LOG_TEMPLATE, timeout=timeout)
+        return _hgapi._revisions_from_log(out)
+
+    async def revision(self, rev_identifier, timeout=None):
+        """Get the identified revision as a Revision object, or None if there is no such revision"""
+        revs = await self.revisions(rev_identifier, timeout=timeout)
+        return revs[0]   if len(revs) > 0   else None
+
+    async def hg_heads(self, timeout=None):
+        """Gets a list with the node id's of all open heads"""
+        res = await self.hg_command(_hgapi.Repo._heads_handler, "heads", "--template", "{node}\n", timeout=timeout)
+        return [head for head in res.split("\n") if head]
+
+    async def hg_branch(self, branch_name=None, timeout=None):
+        """Creates a branch of branch_name isn't None
+        If not, returns the current branch name."""
+        args = [branch_name]   if branch_name   else []
+        branch = await self.hg_command(None, "branch", *args, timeout=timeout)
+        return branch.strip()
+
+
+    async def hg_add(self, filepath, timeout=None):
+        """Add a file to the repo"""
+        await self.hg_command(None, "add", filepath, timeout=timeout)
+
+    async def hg_remove(self, filepath, timeout=None):
+        """Remove a file from the repo"""
+        await self.hg_command(_hgapi.Repo._remove_handler, "remove", filepath, timeout=timeout)
+
+    async def hg_commit(self, message, user=None, files=[], close_branch=False, timeout=None):
+        """Commit changes to the repository."""
+        user = user   or  self.user
+        args = (["--close-branch"]   if close_branch   else []) + (["-u" + user]   if user   else [])
+        await self.__hg_file_command(_hgapi.Repo._commit_handler, ["commit", "-m", message] + args, files, timeout)
+
+    async def hg_revert(self, all=False, *files, timeout=None):
+        """Revert repository"""
+        if all:
+            await self.hg_command(None, "revert", "--all", timeout=timeout)
+        else:
+            await self.__hg_file_command(None, ["revert"], files, timeout)
+
+    async def hg_update(self, reference, clean=False, timeout=None):
+        """Update to the revision indetified by reference"""
+        cmd = ["update"]
+        if reference is not None:
+            cmd.append(str(reference))
+        if clean:
+            cmd.append("--clean")
+        await self.hg_command(_hgapi.Repo._unresolved_handler, *cmd, timeout=timeout)
+
+    async def hg_merge(self, reference=None, tool=None, timeout=None):
+        """Merge reference to current"""
+        cmd = ['merge']
+        if reference is not None:
+            cmd += ['-r', reference]
+        if tool is not None:
+            cmd += ['--tool', tool]
+        await self.hg_command(_hgapi.Repo._unresolved_handler, *cmd, timeout=timeout)
+
+
+    async def hg_pull(self, progress_listener=None, timeout=None):
+        """Pull from the default remote; progress_listener, if given, is called with each line of hg's verbose output"""
+        line_listener = _progress_line_listener(progress_listener, _PULL_IGNORED_LINES)   if progress_listener is not None   else None
+        cmd = ['pull'] + (['-v']   if progress_listener is not None   else [])
+        return await self.__hg_command(_hgapi.Repo._pull_handler, self.__remote_args(cmd), line_listener, timeout)
+
+    async def hg_push(self, force=False, progress_listener=None, timeout=None):
+        """Push to the default remote; progress_listener, if given, is called with each line of hg's verbose output"""
+        line_listener = _progress_line_listener(progress_listener)   if progress_listener is not None   else None
+        cmd = ['push'] + (['--force']   if force   else []) + (['-v']   if progress_listener is not None   else [])
+        return await self.__hg_command(_hgapi.Repo._push_handler, self.__remote_args(cmd), line_listener, timeout)
+
+    def hg_pull_progress(self, timeout=None):
+        """Start pulling; returns a CommandProgress delivering the progress lines as an async iterator"""
+        return CommandProgress(lambda listener: self.hg_pull(progress_listener=listener, timeout=timeout))
+
+    def hg_push_progress(self, force=False, timeout=None):
+        """Start pushing; returns a CommandProgress delivering the progress lines as an async iterator"""
+        return CommandProgress(lambda listener: self.hg_push(force=force, progress_listener=listener, timeout=timeout))
+
+
+    @staticmethod
+    async def hg_init(path, user=None, ssh_key_path=None, disable_host_key_checking=False, timeout=None):
+        """Initialize a new repo"""
+        cmd = [_hgapi.get_hg_path(), "--encoding", "UTF-8", "init", path]
+        await _run_hg(None, cmd, timeout=timeout)
+        return AsyncRepo(path, user, ssh_key_path=ssh_key_path, disable_host_key_checking=disable_host_key_checking, timeout=timeout)
+
+    @staticmethod
+    async def hg_clone(path, remote_uri, user=None, revision=None, ssh_key_path=None, disable_host_key_checking=False,
+                       ok_if_local_dir_exists=False, timeout=None):
+        """Clone an existing repo"""
+        _hgapi._prepare_clone_path(path, ok_if_local_dir_exists)
+        cmd = [_hgapi.get_hg_path(), "--encoding", "UTF-8"] + _hgapi._hg_config_options(user, ssh_key_path, disable_host_key_checking)
+        cmd += ['clone'] + (['-r', revision]   if revision is not None   else []) + [remote_uri, path]
+        await _run_hg(_hgapi.Repo._clone_handler, cmd, timeout=timeout)
+        return AsyncRepo(path, user, ssh_key_path=ssh_key_path, disable_host_key_checking=disable_host_key_checking, timeout=timeout)
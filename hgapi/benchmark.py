@@ -0,0 +1,50 @@
+"""Micro-benchmarks for hgapi
+
+Usage: python benchmark.py <repo path> [<revision identifier>]
+"""
+from __future__ import print_function
+import sys
+import time
+
+try:
+    from . import hgapi as _hgapi
+except (ImportError, ValueError): #not imported as part of the package
+    import hgapi as _hgapi
+
+
+
+
+def _best_time(fn, repeat):
+    best = None
+    for i in range(repeat):
+        t0 = time.time()
+        result = fn()
+        elapsed = time.time() - t0
+        best = elapsed   if best is None   else min(best, elapsed)
+    return best, result
+
+
+def benchmark_log_parsing(repo, rev_identifier='0:tip', repeat=3):
+    """Compare the throughput of the log parsers, in revisions per second.
+    hg is run once per log format, so that only parsing is timed.
+
+    Returns a dictionary mapping 'json' (the legacy urlescaped JSON template) and 'fast' (the NUL-separated
+    template) to revisions per second"""
+    logs = {
+        'json': (_hgapi._revisions_from_json_log, repo.hg_log(rev_identifier=rev_identifier, template=repo.rev_log_tpl)),
+        'fast': (_hgapi._revisions_from_log, repo.hg_log(rev_identifier=rev_identifier, template=repo.rev_log_fast_tpl)),
+    }
+    results = {}
+    for name, (parse, log) in logs.items():
+        elapsed, revs = _best_time(lambda: parse(log), repeat)
+        results[name] = len(revs) / elapsed   if elapsed > 0   else float('inf')
+    return results
+
+
+
+
+if __name__ == '__main__':
+    repo = _hgapi.Repo(sys.argv[1])
+    rev_identifier = sys.argv[2]   if len(sys.argv) > 2   else '0:tip'
+    for name, rate in sorted(benchmark_log_parsing(repo, rev_identifier).items()):
+        print('{0}: {1:.0f} revisions/s'.format(name, rate))
@@ -0,0 +1,73 @@
+import os
+from collections import namedtuple
+
+
+
+
+# The repository views for which hg writes branch caches (.hg/cache/branch2-<filter>), from most to least inclusive.
+# The unfiltered cache (branch2) is not used, as it includes hidden changesets.
+_FILTERS = ['visible', 'served', 'immutable', 'base']
+
+
+
+
+class BranchHead (namedtuple('BranchHead', ['node', 'closed'])):
+    """A head of a named branch, as recorded in the branch cache: its hex node id, and whether it closes the branch"""
+    __slots__ = ()
+
+
+
+
+def _parse_branch_cache(data, tip_rev, tip_node):
+    lines = data.decode('utf-8').split('\n')
+    header = lines[0].split()
+    if len(header) != 2  or  header[0] != tip_node  or  header[1] != str(tip_rev):
+        # Stale, or the view filters out some revisions (a third field holds a hash of the filtered revisions)
+        return None
+    branches = {}
+    for line in lines[1:]:
+        if line == '':
+            continue
+        node, state, name = line.split(' ', 2)
+        if state not in ('o', 'c')  or  len(node) != 40:
+            return None
+        branches.setdefault(name, []).append(BranchHead(node, state == 'c'))
+    return branches
+
+
+def read_branch_cache(repo_path, tip_rev, tip_node):
+    """Read hg's branch cache for the repository at repo_path, if there is one that is valid for the given tip and
+    that includes every revision. Returns a dictionary mapping branch names to lists of BranchHead objects,
+    or None if there is no usable cache."""
+    if tip_rev < 0:
+        return None
+    hg_dir = os.path.join(repo_path, '.hg')
+    try:
+        if os.path.getsize(os.path.join(hg_dir, 'store', 'obsstore')) > 0:
+            # Hidden changesets would make the views differ
+            return None
+    except OSError:
+        pass
+    for filter_name in _FILTERS:
+        try:
+            with open(os.path.join(hg_dir, 'cache', 'branch2-' + filter_name), 'rb') as f:
+                data = f.read()
+        except IOError:
+            continue
+        try:
+            branches = _parse_branch_cache(data, tip_rev, tip_node)
+        except (ValueError, UnicodeDecodeError):
+            branches = None
+        if branches is not None:
+            return branches
+    return None
+
+
+def obsstore_signature(repo_path):
+    """The stat signature of the repository's obsolescence marker store; changes to it can hide changesets
+    without changing the tip"""
+    try:
+        st = os.stat(os.path.join(repo_path, '.hg', 'store', 'obsstore'))
+    except OSError:
+        return None
+    return (st.st_ino, st.st_size, st.st_mtime)
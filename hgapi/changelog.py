@@ -0,0 +1,68 @@
+def check_tip(repo, rev, node):
+    """With one cheap query, determine the repository's tip revision number, and whether the revision numbered
+    rev still has the given node. If node is None, only the tip is determined.
+    Returns a tuple (tip_rev, still_present)"""
+    revset = 'tip'   if node is None   else 'tip + rev({0})'.format(rev)
+    out = repo.hg_log(rev_identifier=revset, template='{rev}:{node}\n')
+    nodes_by_rev = {}
+    for line in out.split('\n'):
+        line = line.strip()
+        if line != '':
+            r, n = line.split(':')
+            nodes_by_rev[int(r)] = n
+    return max(nodes_by_rev.keys()), node is None  or  nodes_by_rev.get(rev) == node
+
+
+
+
+class ChangelogMirror (object):
+    """An in-memory copy of a repository's history that can be brought up to date incrementally.
+
+    Built on Repo.revisions. The mirror remembers the highest revision number and the tip node that it
+    has loaded, so refresh() only fetches revisions that are newer than those. If the previously loaded
+    tip is no longer present at the same revision number (after a strip or rollback), the history is
+    reloaded from scratch.
+
+    Available fields are::
+
+      revisions - the list of Revision objects loaded so far, ordered by revision number
+      tip_rev, tip_node - the last revision loaded, or -1 and None if none have been
+      refreshes, resyncs, revisions_fetched - counters
+    """
+    def __init__(self, repo):
+        self.repo = repo
+        self.revisions = []
+        self.tip_rev = -1
+        self.tip_node = None
+        self.refreshes = 0
+        self.resyncs = 0
+        self.revisions_fetched = 0
+
+
+    def __len__(self):
+        return len(self.revisions)
+
+
+    def refresh(self):
+        """Bring the mirror up to date with the repository.
+        Returns the list of Revision objects that were added; after a resync, this is the entire history"""
+        self.refreshes += 1
+        repo_tip_rev, still_present = check_tip(self.repo, self.tip_rev, self.tip_node)
+
+        if not still_present:
+            # History has been rewritten below our tip
+            self.resyncs += 1
+            self.revisions = []
+            self.tip_rev = -1
+            self.tip_node = None
+
+        if repo_tip_rev <= self.tip_rev:
+            return []
+
+        new_revs = self.repo.revisions('{0}:{1}'.format(self.tip_rev + 1, repo_tip_rev))
+        self.revisions.extend(new_revs)
+        self.revisions_fetched += len(new_revs)
+        if len(self.revisions) > 0:
+            self.tip_rev = self.revisions[-1].rev
+            self.tip_node = self.revisions[-1].node
+        return new_revs
@@ -0,0 +1,386 @@
+import os
+import struct
+import threading
+import time
+
+try:
+    from Queue import Queue
+except ImportError: #python 3
+    from queue import Queue
+
+from subprocess import Popen, PIPE
+
+
+
+
+class CommandServerError (Exception):
+    pass
+
+
+
+
+# Commands that do not modify the repository or working copy; these may run concurrently
+READ_ONLY_COMMANDS = frozenset(['log', 'status', 'heads', 'paths', 'branches', 'id', 'identify', 'showconfig', 'config',
+                                'tags', 'tip', 'parents', 'cat', 'diff', 'manifest', 'annotate', 'files', 'root',
+                                'version', 'incoming', 'outgoing'])
+
+# Read-only commands that contact a remote, and so may take a long time; a CommandServerPool runs one at a time,
+# so that they cannot occupy every worker. Their remote options are passed per call with --config, so they leave
+# nothing behind in the server.
+REMOTE_COMMANDS = frozenset(['incoming', 'outgoing'])
+
+# Global options that consume the following argument
+_GLOBAL_OPTIONS_WITH_VALUE = frozenset(['--config', '--cwd', '-R', '--repository', '--encoding', '--encodingmode'])
+
+
+def command_name(args):
+    """Return the name of the hg command in args, skipping any leading global options"""
+    args = list(args)
+    i = 0
+    while i < len(args):
+        a = args[i]
+        if a in _GLOBAL_OPTIONS_WITH_VALUE:
+            i += 2
+        elif a.startswith('-'):
+            i += 1
+        else:
+            return a
+    return None
+
+
+def is_read_only_command(args):
+    """Determine if the hg command in args leaves the repository and working copy untouched"""
+    name = command_name(args)
+    if name == 'branch':
+        # 'hg branch' reports the current branch; 'hg branch NAME' sets it
+        return len(args) - args.index(name) == 1
+    if name == 'incoming'  and  [a   for a in args   if a == '--bundle'  or  a.startswith('--bundle=')]:
+        # Writes the incoming changesets to a bundle file
+        return False
+    return name in READ_ONLY_COMMANDS
+
+
+
+
+def _read_exactly(f, n):
+    """Read exactly n bytes from f, raising CommandServerError if the stream ends early"""
+    chunks = []
+    remaining = n
+    while remaining > 0:
+        data = f.read(remaining)
+        if not data:
+            raise CommandServerError('Command server closed its output channel unexpectedly')
+        chunks.append(data)
+        remaining -= len(data)
+    return b''.join(chunks)
+
+
+
+
+class CommandServer (object):
+    """A long-lived 'hg serve --cmdserver pipe' process bound to a single repository.
+
+    Commands are sent using the command server channel protocol, so that the cost of starting
+    the Python interpreter and loading extensions is paid once rather than once per command.
+    The server is started on first use and restarted automatically if it dies.
+    """
+    def __init__(self, hg_path, repo_path, env):
+        self.hg_path = hg_path
+        self.repo_path = repo_path
+        self.__env = dict(env)
+        # Ask the server to talk UTF-8; the equivalent of passing --encoding UTF-8 to each command
+        self.__env[str('HGENCODING')] = str('UTF-8')
+        self.__proc = None
+        self.__lock = threading.Lock()
+        self.commands_run = 0
+
+
+    @property
+    def is_running(self):
+        return self.__proc is not None  and  self.__proc.poll() is None
+
+
+    def __start(self):
+        cmd = [self.hg_path, 'serve', '--cmdserver', 'pipe', '-R', self.repo_path, '--config', 'ui.interactive=False']
+        try:
+            # Command errors arrive on the 'e' channel; the process' own stderr is not read, so discard it
+            # rather than risk filling the pipe buffer
+            with open(os.devnull, 'wb') as devnull:
+                self.__proc = Popen(cmd, stdin=PIPE, stdout=PIPE, stderr=devnull, cwd=self.repo_path, env=self.__env)
+        except OSError as e:
+            self.__proc = None
+            raise CommandServerError('Cannot launch command server: {0}'.format(e))
+        try:
+            channel, hello = self.__read_channel()
+        except CommandServerError:
+            self.__kill()
+            raise
+        if channel != b'o'  or  b'runcommand' not in hello:
+            self.__kill()
+            raise CommandServerError('Command server does not support runcommand')
+
+
+    def __kill(self):
+        proc = self.__proc
+        self.__proc = None
+        if proc is not None:
+            for f in (proc.stdin, proc.stdout):
+                try:
+                    f.close()
+                except (IOError, OSError):
+                    pass
+            if proc.poll() is None:
+                try:
+                    proc.kill()
+                except OSError:
+                    pass
+            proc.wait()
+
+
+    def __read_channel(self):
+        header = _read_exactly(self.__proc.stdout, 5)
+        channel, length = struct.unpack(str('>cI'), header)
+        if channel in (b'I', b'L'):
+            # Input request; the length is the amount of data requested, not a payload length
+            return channel, length
+        return channel, _read_exactly(self.__proc.stdout, length)
+
+
+    def run_command(self, args, stdout_listener=None):
+        """Run the hg command described by args (without the leading hg executable).
+
+        stdout_listener - if not None, called with each line of output as it arrives
+
+        Returns a tuple (out, err, returncode)
+        """
+        with self.__lock:
+            if not self.is_running:
+                self.__kill()
+                self.__start()
+            try:
+                return self.__run_command(args, stdout_listener)
+            except (IOError, OSError, CommandServerError) as e:
+                # The server is in an unknown state; discard it so that the next command gets a fresh one
+                self.__kill()
+                if isinstance(e, CommandServerError):
+                    raise
+                raise CommandServerError('Command server failed: {0}'.format(e))
+
+
+    def __run_command(self, args, stdout_listener):
+        data = b'\0'.join([a.encode('utf-8')   if not isinstance(a, bytes)   else a   for a in args])
+        self.__proc.stdin.write(b'runcommand\n' + struct.pack(str('>I'), len(data)) + data)
+        self.__proc.stdin.flush()
+
+        out_chunks = []
+        err_chunks = []
+        pending_line = b''
+        while True:
+            channel, payload = self.__read_channel()
+            if channel == b'o':
+                out_chunks.append(payload)
+                if stdout_listener is not None:
+                    lines = (pending_line + payload).split(b'\n')
+                    pending_line = lines.pop()
+                    for line in lines:
+                        stdout_listener((line + b'\n').decode('utf-8'))
+            elif channel == b'e':
+                err_chunks.append(payload)
+            elif channel == b'r':
+                returncode = struct.unpack(str('>i'), payload)[0]
+                break
+            elif channel in (b'I', b'L'):
+                # We have no input to give; an empty block signals EOF
+                self.__proc.stdin.write(struct.pack(str('>I'), 0))
+                self.__proc.stdin.flush()
+            elif channel.isupper():
+                raise CommandServerError('Unexpected required channel {0!r}'.format(channel))
+            # Other optional channels (e.g. 'd' for debug output) are ignored
+
+        if stdout_listener is not None  and  pending_line:
+            stdout_listener(pending_line.decode('utf-8'))
+        self.commands_run += 1
+        return b''.join(out_chunks).decode('utf-8'), b''.join(err_chunks).decode('utf-8'), returncode
+
+
+    def close(self):
+        """Shut down the server process"""
+        with self.__lock:
+            self.__kill()
+
+
+
+
+
+class _ReadWriteLock (object):
+    """A lock that admits any number of readers or a single writer. Waiting writers block new readers, but not
+    threads that already hold a read lock, so that reads may be nested."""
+    def __init__(self):
+        self.__cond = threading.Condition(threading.Lock())
+        self.__readers = 0
+        self.__writer = False
+        self.__writers_waiting = 0
+        self.__local = threading.local()
+
+
+    def acquire_read(self):
+        held = getattr(self.__local, 'reads', 0)
+        with self.__cond:
+            if held == 0:
+                while self.__writer  or  self.__writers_waiting > 0:
+                    self.__cond.wait()
+            self.__readers += 1
+        self.__local.reads = held + 1
+
+    def release_read(self):
+        self.__local.reads -= 1
+        with self.__cond:
+            self.__readers -= 1
+            if self.__readers == 0:
+                self.__cond.notify_all()
+
+
+    def acquire_write(self):
+        with self.__cond:
+            self.__writers_waiting += 1
+            try:
+                while self.__writer  or  self.__readers > 0:
+                    self.__cond.wait()
+            finally:
+                self.__writers_waiting -= 1
+            self.__writer = True
+
+    def release_write(self):
+        with self.__cond:
+            self.__writer = False
+            self.__cond.notify_all()
+
+
+
+
+class CommandServerPoolStats (object):
+    """Timing metrics for a CommandServerPool. Times are in seconds.
+    Available fields are::
+
+      reads, writes, total_queue_wait, max_queue_wait, total_exec_time, max_exec_time
+    """
+    def __init__(self):
+        self.reads = 0
+        self.writes = 0
+        self.total_queue_wait = 0.0
+        self.max_queue_wait = 0.0
+        self.total_exec_time = 0.0
+        self.max_exec_time = 0.0
+
+
+    @property
+    def commands(self):
+        return self.reads + self.writes
+
+    @property
+    def mean_queue_wait(self):
+        return self.total_queue_wait / self.commands   if self.commands > 0   else 0.0
+
+    @property
+    def mean_exec_time(self):
+        return self.total_exec_time / self.commands   if self.commands > 0   else 0.0
+
+
+    def _record(self, read_only, queue_wait, exec_time):
+        if read_only:
+            self.reads += 1
+        else:
+            self.writes += 1
+        self.total_queue_wait += queue_wait
+        self.max_queue_wait = max(self.max_queue_wait, queue_wait)
+        self.total_exec_time += exec_time
+        self.max_exec_time = max(self.max_exec_time, exec_time)
+
+
+    def copy(self):
+        x = CommandServerPoolStats()
+        x.__dict__.update(self.__dict__)
+        return x
+
+
+    def __repr__(self):
+        return 'CommandServerPoolStats(reads={0}, writes={1}, mean_queue_wait={2:.6f}, mean_exec_time={3:.6f})'.format(
+            self.reads, self.writes, self.mean_queue_wait, self.mean_exec_time)
+
+
+
+
+class CommandServerPool (object):
+    """A bounded pool of command servers for a single repository, safe for use from multiple threads.
+
+    Read-only commands (see is_read_only_command) are spread across the workers and may run concurrently.
+    All other commands are serialized behind a writer lock, and run while no reads are in progress.
+    Has the same run_command/close interface as CommandServer.
+
+    Read-only commands that contact a remote (see REMOTE_COMMANDS) run one at a time, leaving the other workers to
+    local reads.
+
+    A stdout_listener may run further read-only commands on the pool, even while a writer is waiting, as long as
+    a worker is free to run them. It must not run other commands, which would wait for its own read to finish.
+    """
+    def __init__(self, hg_path, repo_path, env, size):
+        if size < 1:
+            raise ValueError('Command server pool size must be at least 1')
+        self.hg_path = hg_path
+        self.repo_path = repo_path
+        self.size = size
+        self.__workers = [CommandServer(hg_path, repo_path, env)   for i in range(size)]
+        self.__idle = Queue()
+        for w in self.__workers:
+            self.__idle.put(w)
+        self.__rwlock = _ReadWriteLock()
+        self.__remote_lock = threading.RLock()
+        self.__stats = CommandServerPoolStats()
+        self.__stats_lock = threading.Lock()
+
+
+    @property
+    def stats(self):
+        """A snapshot of the pool's CommandServerPoolStats"""
+        with self.__stats_lock:
+            return self.__stats.copy()
+
+
+    def run_command(self, args, stdout_listener=None):
+        """Run the hg command described by args on a pool worker; returns a tuple (out, err, returncode)"""
+        read_only = is_read_only_command(args)
+        remote = read_only  and  command_name(args) in REMOTE_COMMANDS
+        t_request = time.time()
+        if remote:
+            self.__remote_lock.acquire()
+        if read_only:
+            self.__rwlock.acquire_read()
+        else:
+            self.__rwlock.acquire_write()
+        try:
+            worker = self.__idle.get()
+            t_start = time.time()
+            try:
+                return worker.run_command(args, stdout_listener)
+            finally:
+                t_end = time.time()
+                self.__idle.put(worker)
+                with self.__stats_lock:
+                    self.__stats._record(read_only, t_start - t_request, t_end - t_start)
+        finally:
+            if read_only:
+                self.__rwlock.release_read()
+            else:
+                self.__rwlock.release_write()
+            if remote:
+                self.__remote_lock.release()
+
+
+    def close(self):
+        """Shut down all worker processes"""
+        self.__rwlock.acquire_write()
+        try:
+            for w in self.__workers:
+                w.close()
+        finally:
+            self.__rwlock.release_write()
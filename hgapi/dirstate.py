@@ -0,0 +1,183 @@
+import binascii
+import os
+import struct
+from collections import namedtuple
+
+
+
+
+NULL_NODE = '0' * 40
+
+_V1_ENTRY = struct.Struct(str('>cllll'))
+
+_V2_MARKER = b'dirstate-v2\n'
+_V2_TREE_METADATA_SIZE = 44
+_V2_DOCKET = struct.Struct(str('>12s32s32s{0}sLB').format(_V2_TREE_METADATA_SIZE))
+_V2_ROOT = struct.Struct(str('>LL'))
+_V2_NODE = struct.Struct(str('>LHHLHLLLLHLLL'))
+
+_V2_WDIR_TRACKED = 1 << 0
+_V2_P1_TRACKED = 1 << 1
+_V2_P2_INFO = 1 << 2
+_V2_MODE_EXEC_PERM = 1 << 3
+_V2_MODE_IS_SYMLINK = 1 << 4
+_V2_HAS_MODE_AND_SIZE = 1 << 8
+_V2_HAS_MTIME = 1 << 9
+
+
+class DirstateEntry (namedtuple('DirstateEntry', ['state', 'mode', 'size', 'mtime', 'copy_source'])):
+    """An entry of the dirstate's file table.
+
+    state is one of 'n' (normal), 'a' (added), 'r' (removed) or 'm' (merged); mode, size and mtime are as recorded
+    when the file was last known to be clean (-1 if unknown); copy_source is the path the file was copied from, or None"""
+    __slots__ = ()
+
+
+
+
+class DirstateError (Exception):
+    pass
+
+
+
+
+def _read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def _hex(node):
+    return binascii.hexlify(node).decode('ascii')
+
+
+def _read_docket(data):
+    marker, p1, p2, tree_metadata, data_size, uuid_length = _V2_DOCKET.unpack_from(data, 0)
+    uuid = data[_V2_DOCKET.size:_V2_DOCKET.size + uuid_length].decode('ascii')
+    return p1[:20], p2[:20], tree_metadata, data_size, uuid
+
+
+def read_parents(repo_path):
+    """The working directory's parents, as a tuple of hex nodes (p1, p2); p2 is NULL_NODE unless a merge is in
+    progress. Raises DirstateError if the dirstate cannot be read."""
+    path = os.path.join(repo_path, '.hg', 'dirstate')
+    try:
+        with open(path, 'rb') as f:
+            header = f.read(_V2_DOCKET.size)
+    except IOError as e:
+        if not os.path.exists(path)  and  os.path.isdir(os.path.join(repo_path, '.hg')):
+            # A new repository has no dirstate
+            return NULL_NODE, NULL_NODE
+        raise DirstateError(str(e))
+    if header.startswith(_V2_MARKER):
+        if len(header) < _V2_DOCKET.size:
+            raise DirstateError('Truncated dirstate docket')
+        p1, p2 = _read_docket(header)[:2]
+    elif len(header) >= 40:
+        p1, p2 = header[:20], header[20:40]
+    elif len(header) == 0:
+        return NULL_NODE, NULL_NODE
+    else:
+        raise DirstateError('Truncated dirstate')
+    return _hex(p1), _hex(p2)
+
+
+def read_branch(repo_path):
+    """The working directory's branch, from .hg/branch"""
+    try:
+        branch = _read(os.path.join(repo_path, '.hg', 'branch')).decode('utf-8').strip()
+    except IOError:
+        branch = ''
+    return branch   or  'default'
+
+
+
+
+class Dirstate (object):
+    """The contents of a repository's dirstate: the working directory's parents and branch, and the file table.
+
+    Available fields are::
+
+      p1, p2 - hex nodes of the working directory's parents; p2 is NULL_NODE unless a merge is in progress
+      branch - the working directory's branch
+      entries - a dictionary mapping tracked (and removed) filenames to DirstateEntry tuples
+      version - 1 or 2
+    """
+    def __init__(self, repo_path):
+        hg_dir = os.path.join(repo_path, '.hg')
+        self.branch = read_branch(repo_path)
+        self.entries = {}
+        try:
+            data = _read(os.path.join(hg_dir, 'dirstate'))
+        except IOError:
+            if not os.path.isdir(hg_dir):
+                raise DirstateError('\'{0}\' is not a Mercurial repository'.format(repo_path))
+            data = b''
+        if data.startswith(_V2_MARKER):
+            self.version = 2
+            p1, p2, tree_metadata, data_size, uuid = _read_docket(data)
+            try:
+                tree = _read(os.path.join(hg_dir, 'dirstate.' + uuid))[:data_size]
+            except IOError as e:
+                raise DirstateError(str(e))
+            self.__parse_v2(tree, tree_metadata)
+        else:
+            self.version = 1
+            if len(data) == 0:
+                p1 = p2 = b'\0' * 20
+            elif len(data) < 40:
+                raise DirstateError('Truncated dirstate')
+            else:
+                p1, p2 = data[:20], data[20:40]
+                self.__parse_v1(data)
+        self.p1 = _hex(p1)
+        self.p2 = _hex(p2)
+
+
+    @property
+    def parents(self):
+        """The parents as a list, omitting p2 if there is no merge in progress"""
+        return [self.p1]   if self.p2 == NULL_NODE   else [self.p1, self.p2]
+
+
+    def __parse_v1(self, data):
+        pos = 40
+        n = len(data)
+        while pos < n:
+            state, mode, size, mtime, length = _V1_ENTRY.unpack_from(data, pos)
+            pos += _V1_ENTRY.size
+            name = data[pos:pos + length]
+            pos += length
+            name, sep, copy_source = name.partition(b'\0')
+            self.entries[name.decode('utf-8', 'replace')] = DirstateEntry(state.decode('ascii'), mode, size, mtime,
+                                                                          copy_source.decode('utf-8', 'replace')   if sep   else None)
+
+
+    def __parse_v2(self, tree, tree_metadata):
+        root_start, root_count = _V2_ROOT.unpack_from(tree_metadata, 0)
+        pending = [(root_start, root_count)]
+        while pending:
+            start, count = pending.pop()
+            for i in range(count):
+                (path_start, path_length, base_name_start, copy_start, copy_length, children_start, children_count,
+                 descendants_with_entry, tracked_descendants, flags, size, mtime, mtime_ns) = _V2_NODE.unpack_from(tree, start + i * _V2_NODE.size)
+                pending.append((children_start, children_count))
+                if not flags & (_V2_WDIR_TRACKED | _V2_P1_TRACKED | _V2_P2_INFO):
+                    continue
+                wdir, p1, p2 = flags & _V2_WDIR_TRACKED, flags & _V2_P1_TRACKED, flags & _V2_P2_INFO
+                if not wdir:
+                    state = 'r'
+                elif not p1  and  not p2:
+                    state = 'a'
+                elif p1  and  p2:
+                    state = 'm'
+                else:
+                    state = 'n'
+                if flags & _V2_HAS_MODE_AND_SIZE:
+                    mode = 0o120777   if flags & _V2_MODE_IS_SYMLINK   else (0o100755   if flags & _V2_MODE_EXEC_PERM   else 0o100644)
+                else:
+                    mode, size = -1, -1
+                if not flags & _V2_HAS_MTIME:
+                    mtime = -1
+                name = tree[path_start:path_start + path_length].decode('utf-8', 'replace')
+                copy_source = tree[copy_start:copy_start + copy_length].decode('utf-8', 'replace')   if copy_length   else None
+                self.entries[name] = DirstateEntry(state, mode, size, mtime, copy_source)
@@ -0,0 +1,103 @@
+import os
+import re
+import tempfile
+
+
+
+
+# Room left for the environment and hg's own arguments
+_ARGV_MARGIN = 8192
+
+
+def argv_limit():
+    """The maximum combined size of the arguments that may be passed to a new process, in bytes"""
+    if os.name == 'nt':
+        # CreateProcess limits the command line to 32767 characters
+        return 32767
+    try:
+        limit = os.sysconf(str('SC_ARG_MAX'))
+    except (AttributeError, ValueError, OSError):
+        limit = -1
+    return limit   if limit > 0   else 131072
+
+
+def fits_on_command_line(args):
+    """True if args, along with the current environment, can safely be passed on a command line"""
+    pointer_size = 8
+    size = sum([len(a.encode('utf-8')) + 1 + pointer_size   for a in args])
+    if os.name != 'nt':
+        size += sum([len(k) + len(v) + 2 + pointer_size   for k, v in os.environ.items()])
+    return size + _ARGV_MARGIN <= argv_limit()
+
+
+def write_listfile0(paths):
+    """Write paths to a new temporary file, NUL-separated, for use with hg's listfile0: pattern.
+    Returns the path of the file, which the caller must remove."""
+    fd, listfile_path = tempfile.mkstemp(prefix='hgapi_listfile', suffix='.txt')
+    with os.fdopen(fd, 'wb') as f:
+        f.write('\0'.join(paths).encode('utf-8'))
+    return listfile_path
+
+
+
+
+class FileOperationResult (object):
+    """The outcome of an operation applied to many files at once.
+    Available fields are:
+    succeeded - the paths that the operation was applied to, in the order given
+    failed - a dictionary mapping the paths that it could not be applied to to hg's explanation
+    warnings - messages from hg that could not be attributed to one of the paths
+    """
+    def __init__(self, succeeded=None, failed=None, warnings=None):
+        self.succeeded = list(succeeded)   if succeeded is not None   else []
+        self.failed = dict(failed)   if failed is not None   else {}
+        self.warnings = list(warnings)   if warnings is not None   else []
+
+
+    @property
+    def ok(self):
+        return len(self.failed) == 0
+
+
+    def __repr__(self):
+        return 'FileOperationResult(succeeded={0}, failed={1}, warnings={2})'.format(repr(self.succeeded),
+            repr(self.failed), repr(self.warnings))
+
+
+
+
+# Messages that hg add, remove, copy and move emit about individual files; the first group is the file
+_FILE_MESSAGE_PATTERNS = [
+    re.compile(r'^not removing (.+): (.+)$'),
+    re.compile(r'^(.+) (already tracked!)$'),
+    re.compile(r'^(.+): (.+)$'),
+]
+
+
+def _path_key(repo_path, path):
+    return os.path.normcase(os.path.normpath(os.path.join(repo_path, path)))
+
+
+def attribute_messages(repo_path, err, paths):
+    """Attribute the lines of hg's error output to the paths (relative to repo_path, or absolute) that they concern.
+    paths maps each path that hg might mention to the path that it should be reported under.
+    Returns a tuple (failed, warnings) as for FileOperationResult"""
+    keys = {}
+    for path, reported_as in paths.items():
+        keys[_path_key(repo_path, path)] = reported_as
+    failed = {}
+    warnings = []
+    for line in err.splitlines():
+        line = line.strip()
+        if line == '':
+            continue
+        for pattern in _FILE_MESSAGE_PATTERNS:
+            match = pattern.match(line)
+            if match is not None:
+                reported_as = keys.get(_path_key(repo_path, match.group(1)))
+                if reported_as is not None:
+                    failed[reported_as] = match.group(2)
+                    break
+        else:
+            warnings.append(line)
+    return failed, warnings
@@ -0,0 +1,223 @@
+import heapq
+from array import array
+
+
+
+
+_ABSENT = -2
+
+
+class ChangelogGraph (object):
+    """An in-memory index of the revision graph, built from the parents of a set of Revision objects, that
+    answers ancestry queries without running hg.
+
+    Revisions are identified by their local revision numbers. Parents that are not in the graph are treated as
+    absent, so a graph built from part of the history has its own roots. Revision numbers are topologically
+    ordered (a parent always has a lower number than its children), and each revision is given a generation
+    number (one more than that of its highest parent); both are used to prune searches.
+
+    The graph can be extended as new revisions arrive, e.g. from ChangelogMirror.refresh()::
+
+      graph = ChangelogGraph(mirror.refresh())
+      ...
+      graph.add(mirror.refresh())
+
+    Revision numbers change when history is rewritten, so the graph should be rebuilt after a strip
+    (i.e. when ChangelogMirror.resyncs increases).
+    """
+    def __init__(self, revisions=None):
+        # Indexed by revision number; _ABSENT marks numbers that are not in the graph
+        self.__p1 = array(str('i'))
+        self.__p2 = array(str('i'))
+        self.__gen = array(str('i'))
+        self.__children = {}
+        self.__heads = set()
+        self.__roots = set()
+        self.__size = 0
+        self.__gen_stale = False
+        if revisions is not None:
+            self.add(revisions)
+
+
+    def __len__(self):
+        return self.__size
+
+
+    def __contains__(self, rev):
+        return 0 <= rev < len(self.__p1)  and  self.__p1[rev] != _ABSENT
+
+
+    def parents(self, rev):
+        """The parents of rev that are in the graph"""
+        self.__check(rev)
+        return [p   for p in (self.__p1[rev], self.__p2[rev])   if p in self]
+
+
+    def children(self, rev):
+        self.__check(rev)
+        return sorted(self.__children.get(rev, []))
+
+
+    def generation(self, rev):
+        self.__check(rev)
+        self.__refresh_generations()
+        return self.__gen[rev]
+
+
+    def __check(self, rev):
+        if rev not in self:
+            raise KeyError('Revision {0} is not in the graph'.format(rev))
+
+
+    def add(self, revisions):
+        """Add revisions (objects with rev and parents attributes, such as Revision); those already present are ignored"""
+        for r in sorted(revisions, key=lambda r: r.rev):
+            self.add_revision(r.rev, r.parents)
+
+
+    def add_revision(self, rev, parents):
+        """Add a single revision, given its number and the numbers of its parents (-1 for none)"""
+        if rev in self:
+            return
+        parents = [p   for p in parents   if p >= 0]
+        p1 = parents[0]   if len(parents) > 0   else -1
+        p2 = parents[1]   if len(parents) > 1   else -1
+
+        if rev >= len(self.__p1):
+            extra = rev + 1 - len(self.__p1)
+            self.__p1.extend([_ABSENT] * extra)
+            self.__p2.extend([_ABSENT] * extra)
+            self.__gen.extend([0] * extra)
+        self.__p1[rev] = p1
+        self.__p2[rev] = p2
+        self.__size += 1
+
+        present_parents = [p   for p in (p1, p2)   if p in self]
+        self.__gen[rev] = 1 + max([self.__gen[p]   for p in present_parents] + [0])
+        for p in present_parents:
+            self.__children.setdefault(p, []).append(rev)
+            self.__heads.discard(p)
+        if not present_parents:
+            self.__roots.add(rev)
+
+        # Children of rev that arrived before it; they are no longer roots, and it is no longer a head
+        orphans = [c   for c in range(rev + 1, len(self.__p1))   if self.__p1[c] == rev  or  self.__p2[c] == rev]   if rev < len(self.__p1) - 1   else []
+        if orphans:
+            self.__children[rev] = orphans
+            self.__roots.difference_update(orphans)
+            # The generations of the descendants of the orphans are now wrong
+            self.__gen_stale = True
+        else:
+            self.__heads.add(rev)
+
+
+    def __refresh_generations(self):
+        if self.__gen_stale:
+            for rev in range(len(self.__p1)):
+                if self.__p1[rev] != _ABSENT:
+                    self.__gen[rev] = 1 + max([self.__gen[p]   for p in (self.__p1[rev], self.__p2[rev])   if p in self] + [0])
+            self.__gen_stale = False
+
+
+    def heads(self):
+        """Revisions with no children in the graph, in ascending order"""
+        return sorted(self.__heads)
+
+
+    def roots(self):
+        """Revisions with no parents in the graph, in ascending order"""
+        return sorted(self.__roots)
+
+
+    def is_ancestor(self, a, b):
+        """Determine if a is an ancestor of b; a revision is considered to be an ancestor of itself"""
+        self.__check(a)
+        self.__check(b)
+        if a == b:
+            return True
+        if a > b:
+            return False
+        self.__refresh_generations()
+        p1, p2, gen = self.__p1, self.__p2, self.__gen
+        gen_a = gen[a]
+        visited = set()
+        stack = [b]
+        while stack:
+            r = stack.pop()
+            for p in (p1[r], p2[r]):
+                if p == a:
+                    return True
+                # Anything numbered below a, or of a lower generation, cannot have a as an ancestor
+                if p > a  and  p not in visited  and  p1[p] != _ABSENT  and  gen[p] > gen_a:
+                    visited.add(p)
+                    stack.append(p)
+        return False
+
+
+    def ancestors(self, rev, inclusive=True):
+        """The ancestors of rev that are in the graph, in ascending order"""
+        self.__check(rev)
+        p1, p2 = self.__p1, self.__p2
+        visited = {rev}
+        stack = [rev]
+        while stack:
+            r = stack.pop()
+            for p in (p1[r], p2[r]):
+                if p >= 0  and  p not in visited  and  p1[p] != _ABSENT:
+                    visited.add(p)
+                    stack.append(p)
+        if not inclusive:
+            visited.discard(rev)
+        return sorted(visited)
+
+
+    def descendants(self, rev, inclusive=True):
+        """The descendants of rev, in ascending order"""
+        self.__check(rev)
+        visited = {rev}
+        stack = [rev]
+        while stack:
+            r = stack.pop()
+            for c in self.__children.get(r, []):
+                if c not in visited:
+                    visited.add(c)
+                    stack.append(c)
+        if not inclusive:
+            visited.discard(rev)
+        return sorted(visited)
+
+
+    def common_ancestor(self, a, b):
+        """The highest numbered common ancestor of a and b, or None if they have none in the graph.
+        This is always one of the heads of the set of common ancestors."""
+        self.__check(a)
+        self.__check(b)
+        p1, p2 = self.__p1, self.__p2
+        # Walk down from a and b together in descending revision order, marking which of them each
+        # revision descends from. A revision's marks are complete once it is popped, as all revisions that
+        # could mark it have higher numbers; the first with both marks is the answer.
+        if a == b:
+            return a
+        marks = {a: 1, b: 2}
+        heap = [-max(a, b), -min(a, b)]
+        # The number of queued revisions carrying each mark; once either reaches zero, no common ancestor
+        # can be found
+        queued = {1: 1, 2: 1, 3: 0}
+        while queued[1] + queued[3] > 0  and  queued[2] + queued[3] > 0:
+            r = -heapq.heappop(heap)
+            m = marks[r]
+            if m == 3:
+                return r
+            queued[m] -= 1
+            for p in (p1[r], p2[r]):
+                if p >= 0  and  p1[p] != _ABSENT:
+                    pm = marks.get(p)
+                    if pm is None:
+                        marks[p] = m
+                        queued[m] += 1
+                        heapq.heappush(heap, -p)
+                    elif pm | m != pm:
+                        marks[p] = 3
+                        queued[pm] -= 1
+                        queued[3] += 1
+        return None
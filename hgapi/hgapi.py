@@ -3,7 +3,6 @@ from __future__ import print_function, unicode_literals, with_statement
 import sys
 
 from subprocess import Popen, STDOUT, PIPE
-from datetime import datetime
 
 try:
     from ConfigParser import ConfigParser, NoOptionError
@@ -11,24 +10,69 @@ except: #python 3
     from configparser import ConfigParser, NoOptionError
 import re
 import os
+import struct
 import shutil
 
 try:
     from urllib import unquote
+    _unquote_to_bytes = unquote
 except: #python 3
-    from urllib.parse import unquote
+    from urllib.parse import unquote, unquote_to_bytes as _unquote_to_bytes
 
 try:
     import json #for reading logs
 except:
     import simplejson as json
 
+try:
+    _string_types = (str, unicode)
+except NameError: #python 3
+    _string_types = (str,)
+
 
 
 
 
-from revision import Revision
-from status import Status, ResolveState
+try:
+    from .sshmux import SSHSessionManager
+    from .repogroup import RepoGroup, RepoResult
+    from .streaming import stream_process, read_in_background, TransferProgress, TransferEvent, PROGRESS_CONFIG
+    from .fileops import FileOperationResult, fits_on_command_line, write_listfile0, attribute_messages
+    from .revision import Revision, LazyRevision, RevisionBatch
+    from .status import Status, ResolveState
+    from .cmdserver import CommandServer, CommandServerPool, CommandServerError, command_name, is_read_only_command
+    from .revcache import RevisionCache
+    from .changelog import ChangelogMirror, check_tip
+    from .revindex import RevisionIndex
+    from .revtable import RevisionTable
+    from .graph import ChangelogGraph
+    from .statuscache import StatusCache
+    from .watcher import WorkingCopyWatcher, WatcherUnavailableError
+    from . import hgrc
+    from .revlog import ChangelogReader, Revlog, RevlogError, RevlogUnsupportedError, supported_requirements, read_requirements
+    from . import dirstate
+    from . import branchmap
+    from . import revindex
+except (ImportError, ValueError): #not imported as part of the package
+    from sshmux import SSHSessionManager
+    from repogroup import RepoGroup, RepoResult
+    from streaming import stream_process, read_in_background, TransferProgress, TransferEvent, PROGRESS_CONFIG
+    from fileops import FileOperationResult, fits_on_command_line, write_listfile0, attribute_messages
+    from revision import Revision, LazyRevision, RevisionBatch
+    from status import Status, ResolveState
+    from cmdserver import CommandServer, CommandServerPool, CommandServerError, command_name, is_read_only_command
+    from revcache import RevisionCache
+    from changelog import ChangelogMirror, check_tip
+    from revindex import RevisionIndex
+    from revtable import RevisionTable
+    from graph import ChangelogGraph
+    from statuscache import StatusCache
+    from watcher import WorkingCopyWatcher, WatcherUnavailableError
+    import hgrc
+    from revlog import ChangelogReader, Revlog, RevlogError, RevlogUnsupportedError, supported_requirements, read_requirements
+    import dirstate
+    import branchmap
+    import revindex
 
 
 
@@ -38,32 +82,77 @@ PLATFORM_LINUX = 'linux'
 PLATFORM_MAC = 'mac'
 
 
+__platform = None
+
+
+def _os_name():
+    registry = getattr(sys, 'registry', None)
+    if registry is not None:
+        # Jython
+        return registry['os.name']
+    if sys.platform.startswith('win')  or  sys.platform == 'cygwin':
+        return 'Windows'
+    elif sys.platform.startswith('linux'):
+        return 'Linux'
+    elif sys.platform == 'darwin':
+        return 'Mac OS X'
+    return sys.platform
+
 def _get_platform():
-    os_name = sys.registry['os.name']
-    if os_name.startswith( 'Windows' ):
-        return PLATFORM_WINDOWS
-    elif os_name.startswith( 'Linux' ):
-        return PLATFORM_LINUX
-    elif os_name.startswith( 'Mac' ):
-        return PLATFORM_MAC
-    else:
-        raise ValueError, 'Unrecognized os.name \'{0}\''.format(os_name)
+    global __platform
+    if __platform is None:
+        os_name = _os_name()
+        if os_name.startswith( 'Windows' ):
+            __platform = PLATFORM_WINDOWS
+        elif os_name.startswith( 'Linux' ):
+            __platform = PLATFORM_LINUX
+        elif os_name.startswith( 'Mac' ):
+            __platform = PLATFORM_MAC
+        else:
+            raise ValueError('Unrecognized os.name \'{0}\''.format(os_name))
+    return __platform
+
+
+
 
+__ssh_session_manager = None
+
+
+def get_ssh_session_manager():
+    return __ssh_session_manager
+
+
+def set_ssh_session_manager(manager):
+    """Share SSH connections between remote commands through manager, an SSHSessionManager, or stop sharing them if
+    manager is None. Connections are only shared on platforms that use OpenSSH. While a manager is installed,
+    its ssh_executable is used instead of any ssh command configured for hg, with or without an SSH key."""
+    global __ssh_session_manager
+    __ssh_session_manager = manager
 
 
 
 def __platform_ssh_cmd(username, ssh_key_path, disable_host_key_checking):
+    """The ssh command for hg to use, or None to leave hg's configured ssh command in place"""
     platform = _get_platform()
     if platform == PLATFORM_WINDOWS:
+        if username is None  or  ssh_key_path is None:
+            return None
         return 'TortoisePLink.exe -ssh -l {0} -i "{1}"'.format(username, ssh_key_path)
-    elif platform == PLATFORM_LINUX:
-        insecure_option = ' -o UserKnownHostsFile=/dev/null -o StrictHostKeyChecking=no'   if disable_host_key_checking   else ''
-        return 'ssh -l {0} -i "{1}"{2}'.format(username, ssh_key_path, insecure_option)
-    elif platform == PLATFORM_MAC:
-        insecure_option = ' -o UserKnownHostsFile=/dev/null -o StrictHostKeyChecking=no'   if disable_host_key_checking   else ''
-        return 'ssh -l {0} -i "{1}"{2}'.format(username, ssh_key_path, insecure_option)
+    elif platform == PLATFORM_LINUX  or  platform == PLATFORM_MAC:
+        manager = __ssh_session_manager
+        if manager is None  and  (username is None  or  ssh_key_path is None):
+            return None
+        options = ''
+        if username is not None  and  ssh_key_path is not None:
+            options += ' -l {0} -i "{1}"'.format(username, ssh_key_path)
+        if disable_host_key_checking:
+            options += ' -o UserKnownHostsFile=/dev/null -o StrictHostKeyChecking=no'
+        if manager is not None:
+            # Connections are shared even without a key, e.g. when authenticating through ssh-agent or ~/.ssh/config
+            return '"{0}"{1} {2}'.format(manager.ssh_executable, options, manager.ssh_options(ssh_key_path))
+        return 'ssh{0}'.format(options)
     else:
-        raise ValueError, 'Unreckognized platform \'{0}\''.format(platform)
+        raise ValueError('Unreckognized platform \'{0}\''.format(platform))
 
 
 
@@ -86,8 +175,8 @@ def _hg_env():
     return env
 
 def _hg_config_options(username, ssh_key_path, disable_host_key_checking):
-    if username is not None  and  ssh_key_path is not None:
-        cmd = __platform_ssh_cmd(username, ssh_key_path, disable_host_key_checking)
+    cmd = __platform_ssh_cmd(username, ssh_key_path, disable_host_key_checking)
+    if cmd is not None:
         return ['--config', 'ui.ssh={0}'.format(cmd)]
     else:
         return []
@@ -122,6 +211,9 @@ class HGRemoveWarning (HGBaseError):
 class HGMoveError (HGBaseError):
     pass
 
+class HGWatcherUnavailableError (HGBaseError):
+    pass
+
 class HGCopyError (HGBaseError):
     pass
 
@@ -162,8 +254,15 @@ class _ReturnCodeHandler (object):
         return x
 
 
+    def accept_returncode(self, returncode):
+        """A copy of this handler that treats returncode as success"""
+        return self.map_returncode_to_exception(returncode, None)
+
+
     def _handle_return_code(self, cmd, err, out, returncode):
         exc_type = self.__exc_type_map.get(returncode, HGError)
+        if exc_type is None:
+            return True
         raise exc_type("Error running %s:\n\tErr: %s\n\tOut: %s\n\tExit: %s"
                       % (' '.join(cmd),err,out,returncode))
 
@@ -187,30 +286,226 @@ def _hg_cmd(return_code_handler, username, ssh_key_path, disable_host_key_checki
     return out
 
 
+# Log template with NUL-terminated fields. hg does not allow NUL in branch and tag names, but the author and
+# description are free text that can contain anything (e.g. from commit -l, import or convert), so they are
+# escaped with urlescape; see _unescape.
+_LOG_TEMPLATE = '{node}\\0{rev}\\0{author|urlescape}\\0{branch}\\0{p1rev}\\0{p2rev}\\0{date|isodate}\\0{tags}\\0{desc|urlescape}\\0'
+_LOG_FIELD_COUNT = 9
+
+
+def _unescape(field):
+    """Decode a field escaped with hg's urlescape filter"""
+    if '%' not in field:
+        return field
+    return _unquote_to_bytes(field.encode('ascii')).decode('utf-8')
+
+
+def _revision_from_fields(fields):
+    """Create a Revision object from the fields produced by _LOG_TEMPLATE"""
+    node, rev, author, branch, p1, p2, date, tags, desc = fields
+    parents = [int(p1)]   if p2 == '-1'   else [int(p1), int(p2)]
+    return Revision(node, int(rev), _unescape(author), branch, parents, date, tags, _unescape(desc))
+
+
+def _revisions_from_log(log):
+    """Create a list of Revision objects from log output produced with _LOG_TEMPLATE"""
+    fields = log.split('\0')
+    n = len(fields) - len(fields) % _LOG_FIELD_COUNT
+    return [_revision_from_fields(fields[i:i+_LOG_FIELD_COUNT])   for i in range(0, n, _LOG_FIELD_COUNT)]
+
+
+def _iter_log_records(chunks, field_count):
+    """Generator yielding lists of decoded fields from raw (bytes) chunks of log output whose fields are NUL-terminated"""
+    pending = b''
+    fields = []
+    for chunk in chunks:
+        parts = (pending + chunk).split(b'\0')
+        pending = parts.pop()
+        fields.extend(parts)
+        n = len(fields) - len(fields) % field_count
+        for i in range(0, n, field_count):
+            yield [f.decode('utf-8')   for f in fields[i:i+field_count]]
+        del fields[:n]
+
+
+def _iter_revisions_from_chunks(chunks):
+    """Generator yielding Revision objects from raw (bytes) chunks of log output produced with _LOG_TEMPLATE"""
+    for fields in _iter_log_records(chunks, _LOG_FIELD_COUNT):
+        yield _revision_from_fields(fields)
+
+
+# The fields fetched up front for lazy revisions, and those fetched on demand
+_LAZY_LOG_TEMPLATE = '{node}\\0{rev}\\0{branch}\\0{p1rev}\\0{p2rev}\\0'
+_LAZY_LOG_FIELD_COUNT = 5
+_LAZY_DETAIL_LOG_TEMPLATE = '{node}\\0{author|urlescape}\\0{date|isodate}\\0{tags}\\0{desc|urlescape}\\0'
+_LAZY_DETAIL_LOG_FIELD_COUNT = 5
+
+
+def _revset_for_revs(revs):
+    """A revset matching the given revision numbers, as compact as possible for mostly contiguous runs"""
+    ranges = []
+    for r in sorted(set(revs)):
+        if len(ranges) > 0  and  ranges[-1][1] == r - 1:
+            ranges[-1][1] = r
+        else:
+            ranges.append([r, r])
+    return ' + '.join(['{0}:{1}'.format(a, b)   if a != b   else str(a)   for a, b in ranges])
+
+
+def _split_log_records(log, field_count):
+    fields = log.split('\0')
+    n = len(fields) - len(fields) % field_count
+    return [fields[i:i+field_count]   for i in range(0, n, field_count)]
+
+
+# As _LOG_TEMPLATE, but with the date as seconds since the epoch and timezone offset
+_TABLE_LOG_TEMPLATE = '{node}\\0{rev}\\0{author|urlescape}\\0{branch}\\0{p1rev}\\0{p2rev}\\0{date|hgdate}\\0{tags}\\0{desc|urlescape}\\0'
+
+
+def _log_args(rev_identifier, limit, template, filename, kwargs):
+    """The arguments for a hg log command"""
+    cmds = ["log"]
+    if rev_identifier: cmds += ['-r', str(rev_identifier)]
+    if limit: cmds += ['-l', str(limit)]
+    if template: cmds += ['--template', str(template)]
+    if kwargs:
+        for key in kwargs:
+            cmds += [key, kwargs[key]]
+    if filename:
+        cmds.append(filename)
+    return cmds
+
+
+_STATUS_CODES = {'A': 'added', 'M': 'modified', 'R': 'removed', '!': 'missing', '?': 'untracked'}
+
+
+def _status_from_output(out):
+    """Create a Status object from the output of hg status"""
+    out = out.strip()
+    #default empty set
+    status = Status()
+    if not out: return status
+    lines = out.split("\n")
+    status_split = re.compile("^(.) (.*)$")
+
+    for change, path in [status_split.match(x).groups() for x in lines]:
+        getattr(status, _STATUS_CODES[change]).add(path)
+    return status
+
+
+def _revision_from_json(json_rev):
+    """Create a Revision object from a line of log output produced with Repo.rev_log_tpl"""
+    j = json.loads(json_rev)
+    j = {key : unquote(value)   for key, value in j.items()}
+    rev = int(j['rev'])
+    branch = j['branch']
+    branch = branch   if branch   else 'default'
+    jparents = j['parents']
+    if not jparents:
+        parents = [rev-1]
+    else:
+        parents = [int(p.split(':')[0])   for p in jparents.split()]
+    return Revision(j['node'], rev, j['author'], branch, parents, j['date'], j['tags'], j['desc'])
+
+
+def _revisions_from_json_log(log):
+    """Create a list of Revision objects from log output produced with Repo.rev_log_tpl.
+    Slower than _revisions_from_log; retained for compatibility and comparison."""
+    lines = log.split('\n')[:-1]
+    lines = [line.strip()   for line in lines]
+    return [_revision_from_json(line)   for line in lines   if len(line) > 0]
+
+
+
+
 class Repo(object):
     """
     A representation of a Mercurial repository
     """
 
-    __user_cfg_mod_date = None
-
-    def __init__(self, path, user=None, ssh_key_path=None, disable_host_key_checking=False, on_filesystem_modified=None):
-        """Create a Repo object from the repository at path"""
+    def __init__(self, path, user=None, ssh_key_path=None, disable_host_key_checking=False, on_filesystem_modified=None,
+                 use_cmdserver=False, cmdserver_pool_size=None, revision_cache_size=None, revision_index_dir=None,
+                 cache_status=False, watch_working_copy=False, native_config=False, lazy=False, native_revlog=False):
+        """Create a Repo object from the repository at path
+
+        use_cmdserver - if True, commands are run by a persistent 'hg serve --cmdserver pipe' process
+            rather than by launching hg for each command. Call close() to shut it down.
+        cmdserver_pool_size - if not None, commands are run by a thread-safe pool of this many command servers;
+            read-only commands run concurrently, while mutating commands are serialized. Implies use_cmdserver.
+        revision_cache_size - if not None, revision(), revisions() and indexing are served from an LRU cache
+            of up to this many Revision objects where possible. The cache is invalidated by history-rewriting
+            commands run through this Repo, but not by those run by other processes.
+        revision_index_dir - if not None, a directory in which to keep a persistent SQLite index of this repository's
+            revisions. revision(), revisions() and revisions_for() are served from it where possible. It is brought
+            up to date from the tip on first use, after mutating commands, and when asked for a revision it does
+            not have; call sync_revision_index() to pick up history rewritten by other processes.
+        cache_status - if True, hg_status() results are cached, and only recomputed when a fingerprint of the stat
+            information of .hg/dirstate and the working copy changes, when _notify_filesystem_modified() is called,
+            or after a mutating command.
+        watch_working_copy - if True, the working copy is watched for modifications from any source using inotify
+            (Linux only; HGWatcherUnavailableError is raised elsewhere). on_filesystem_modified is called (from the
+            watcher thread) shortly after they occur, and hg_status() only asks hg about the paths that have been
+            touched since it was last called, or does not run hg at all if none have. Modifications made by commands
+            run through this Repo are not reported by the watcher. Call close() to stop watching.
+        native_config - if True, the configuration is read by parsing the hgrc files that hg would read, rather than
+            by running hg showconfig
+        lazy - if True, the repository is validated by checking for .hg/requires and .hg/store rather than by running
+            hg status, and the configuration and extensions are only loaded when first needed. Together with the
+            cached hg_version(), this makes construction cheap enough to do per request.
+        native_revlog - if True, revision(), revisions() and hg_heads() read the changelog directly from .hg/store
+            rather than running hg, for revision numbers, full nodes, 'tip' and ranges of those. If the repository
+            has requirements that the reader does not support, or has obsolescence markers, hg is used as normal;
+            check uses_native_revlog. Repositories with zstd compressed revlogs (the default for hg installed with
+            pip) need the zstandard module or Mercurial's bundled copy of it; see revlog.ZSTD_AVAILABLE.
+        """
         # Call hg_version() to check that it is installed and that it works
         hg_version()
+        if lazy:
+            hg_dir = os.path.join(path, '.hg')
+            if not os.path.isfile(os.path.join(hg_dir, 'requires'))  or  not os.path.isdir(os.path.join(hg_dir, 'store')):
+                raise HGError('\'{0}\' is not a Mercurial repository'.format(path))
         self.path = path
-        self.__cfg_date = None
-        self.__cfg = None
+        self.__native_config = native_config
         self.user = user
         self.ssh_key_path = ssh_key_path
         self.disable_host_key_checking = disable_host_key_checking
         self.__on_filesystem_modified = on_filesystem_modified
-        # Call hg_status to check that the repo is valid
-        self.hg_status()
+        if cmdserver_pool_size is not None:
+            self.__cmdserver = CommandServerPool(get_hg_path(), path, _hg_env(), cmdserver_pool_size)
+        elif use_cmdserver:
+            self.__cmdserver = CommandServer(get_hg_path(), path, _hg_env())
+        else:
+            self.__cmdserver = None
+        self.__revision_cache = RevisionCache(revision_cache_size)   if revision_cache_size   else None
+        if revision_index_dir is not None:
+            if not revindex.is_available():
+                raise HGError('A revision index requires the sqlite3 module')
+            self.__revision_index = RevisionIndex(path, revision_index_dir)
+        else:
+            self.__revision_index = None
+        self.__revision_index_stale = True
+        self.__status_cache = StatusCache(path)   if cache_status   else None
+        self.__changelog_reader = None
+        self.__native_tags = (None, None)
+        self.__changelog_index = None
+        self.__branch_info = {}
+        if native_revlog:
+            try:
+                self.__changelog_reader = ChangelogReader(path)
+            except RevlogUnsupportedError:
+                pass
+        self.__watcher = None
+        self.__watched_status = None
+        if watch_working_copy:
+            try:
+                self.__watcher = WorkingCopyWatcher(path, on_modified=self._notify_filesystem_modified)
+            except WatcherUnavailableError as e:
+                raise HGWatcherUnavailableError(str(e))
         self.__extensions = set()
-        self.__refresh_extensions()
-
-        self.__revisions_by_index = []
+        if not lazy:
+            # Call hg_status to check that the repo is valid
+            self.hg_status()
+            self.__refresh_extensions()
 
  
     def __getitem__(self, rev=slice(0, 'tip')):
@@ -223,33 +518,130 @@ class Repo(object):
             return self.revisions(":".join([str(x)for x in (rev.start, rev.stop)]))
         return self.revision(rev)
 
-    def __hg_command(self, return_code_handler, args, stdout_listener=None):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        """Release resources held by the repo, such as the command server process"""
+        if self.__watcher is not None:
+            self.__watcher.close()
+        if self.__changelog_reader is not None:
+            self.__changelog_reader.close()
+        if self.__changelog_index is not None:
+            self.__changelog_index.close()
+        if self.__cmdserver is not None:
+            self.__cmdserver.close()
+        if self.__revision_index is not None:
+            self.__revision_index.close()
+
+    @property
+    def uses_cmdserver(self):
+        return self.__cmdserver is not None
+
+    @property
+    def cmdserver_pool_stats(self):
+        """Queue wait and execution time metrics (a CommandServerPoolStats) if a command server pool is in use, else None"""
+        if isinstance(self.__cmdserver, CommandServerPool):
+            return self.__cmdserver.stats
+        else:
+            return None
+
+    @property
+    def revision_cache(self):
+        """The RevisionCache, which carries hit and miss counters, or None if revision caching is disabled"""
+        return self.__revision_cache
+
+    @property
+    def uses_native_revlog(self):
+        """True if revisions are being read directly from the changelog"""
+        return self.__changelog_reader is not None
+
+    @property
+    def status_cache(self):
+        """The StatusCache, which carries hit and miss counters, or None if status caching is disabled"""
+        return self.__status_cache
+
+    def invalidate_revision_cache(self):
+        """Discard all cached revisions; needed if history has been rewritten by another process"""
+        if self.__revision_cache is not None:
+            self.__revision_cache.clear()
+
+
+    # Commands that renumber or remove revisions, or may tag existing ones
+    _HISTORY_REWRITING_COMMANDS = frozenset(['strip', 'rollback', 'rebase', 'histedit', 'prune', 'uncommit', 'fold',
+                                             'evolve', 'tag', 'pull', 'unbundle', 'import'])
+
+    def __command_completed(self, args):
+        """Called after every hg command, successful or not, to invalidate cached state"""
+        if not is_read_only_command(args):
+            self.__revision_index_stale = True
+            if self.__status_cache is not None:
+                self.__status_cache.invalidate()
+            if self.__watcher is not None:
+                self.__watcher.mark_all_dirty()
+        if self.__revision_cache is not None  and  not is_read_only_command(args):
+            if command_name(args) in self._HISTORY_REWRITING_COMMANDS  or  '--amend' in args:
+                self.__revision_cache.clear()
+            else:
+                # New changesets move the 'tip' tag
+                self.__revision_cache.discard_tagged()
+
+
+    def __hg_command(self, return_code_handler, args, stdout_listener=None, stderr_listener=None):
         """Run a hg command in path and return the result.
-        Throws on error."""
+        Throws on error.
+
+        stdout_listener and stderr_listener are as for stream_process; with a command server, stderr_listener is not used"""
+        return self.__hg_command_with_err(return_code_handler, args, stdout_listener, stderr_listener)[0]
+
+    def __hg_command_with_err(self, return_code_handler, args, stdout_listener=None, stderr_listener=None):
+        """As __hg_command, but returns a tuple (out, err, returncode), for commands whose error output is needed even
+        when return_code_handler accepts the return code"""
+        # Our own changes are accounted for by __command_completed, and reported by the methods that make them;
+        # read-only commands leave the working copy alone, so modifications made meanwhile are still reported
+        working_copy = not is_read_only_command(args)
+        if self.__watcher is not None:
+            self.__watcher.suppress_notifications(working_copy)
+        try:
+            return self.__run_hg_command(return_code_handler, args, stdout_listener, stderr_listener)
+        finally:
+            if self.__watcher is not None:
+                self.__watcher.resume_notifications(working_copy)
+            self.__command_completed(args)
+
+    def __run_hg_command(self, return_code_handler, args, stdout_listener, stderr_listener):
         assert return_code_handler is None  or  isinstance(return_code_handler, _ReturnCodeHandler)
         cmd = [get_hg_path(), "--cwd", self.path, "--encoding", "UTF-8"] + list(args)
 
-        if stdout_listener is None:
+        if self.__cmdserver is not None:
+            try:
+                out, err, returncode = self.__cmdserver.run_command(list(args), stdout_listener)
+            except CommandServerError as e:
+                raise HGCannotLaunchError(str(e))
+            if returncode:
+                if return_code_handler is None:
+                    return_code_handler = _default_return_code_handler
+                return_code_handler._handle_return_code(cmd, err, out, returncode)
+            return out, err, returncode
+
+        if stdout_listener is None  and  stderr_listener is None:
             proc = Popen(cmd, stdout=PIPE, stderr=PIPE, env=_hg_env())
             out, err = [x.decode("utf-8") for x in  proc.communicate()]
         else:
-            proc = Popen(cmd, stdout=PIPE, stderr=PIPE, env=_hg_env(), bufsize=-1)
-            out_lines = []
-            while proc.poll() is None:
-                x = proc.stdout.readline().decode('utf-8')
-                out_lines.append(x)
-                stdout_listener(x)
-            out = ''.join(out_lines)
-            err = proc.stderr.read().decode('utf-8')
+            proc = Popen(cmd, stdout=PIPE, stderr=PIPE, env=_hg_env())
+            out, err = stream_process(proc, stdout_listener, stderr_listener)
 
         if proc.returncode:
-            if return_code_handler is not None:
-                return_code_handler._handle_return_code(cmd, err, out, proc.returncode)
-            else:
-                _default_return_code_handler._handle_return_code(cmd, err, out, proc.returncode)
+            if return_code_handler is None:
+                return_code_handler = _default_return_code_handler
+            if return_code_handler._handle_return_code(cmd, err, out, proc.returncode):
+                return out, err, proc.returncode
             raise HGError("Error running %s:\n\tErr: %s\n\tOut: %s\n\tExit: %s"
                     % (' '.join(cmd),err,out,proc.returncode))
-        return out
+        return out, err, proc.returncode
 
     def hg_command(self, return_code_handler, *args):
         """Run a hg command in path and return the result.
@@ -268,6 +660,60 @@ class Repo(object):
         Adds SSH key path"""
         return self.__hg_command(return_code_handler, _hg_config_options(self.user, self.ssh_key_path, self.disable_host_key_checking) + list(args), stdout_listener)
 
+    def __hg_command_chunks(self, return_code_handler, args):
+        """Run a hg command in path and return a generator that yields its raw output (as bytes) as it is produced.
+        Throws on error, once the output has been consumed.
+
+        If the generator is closed before the output is exhausted, the hg process is killed."""
+        assert return_code_handler is None  or  isinstance(return_code_handler, _ReturnCodeHandler)
+        if return_code_handler is None:
+            return_code_handler = _default_return_code_handler
+
+        if self.__cmdserver is not None:
+            # The command server protocol delivers the output in one block
+            yield self.__hg_command(return_code_handler, args).encode('utf-8')
+            return
+
+        cmd = [get_hg_path(), "--cwd", self.path, "--encoding", "UTF-8"] + list(args)
+        proc = Popen(cmd, stdout=PIPE, stderr=PIPE, env=_hg_env())
+        # Drain stderr while stdout is being read, so that hg cannot block writing warnings or hook output
+        read_err = read_in_background(proc.stderr)
+        finished = False
+        try:
+            # os.read returns whatever is available, rather than waiting for a buffer to fill
+            fd = proc.stdout.fileno()
+            while True:
+                chunk = os.read(fd, 65536)
+                if not chunk:
+                    break
+                yield chunk
+            proc.wait()
+            finished = True
+        finally:
+            if not finished  and  proc.poll() is None:
+                proc.kill()
+                proc.wait()
+            err = read_err().decode('utf-8')
+            proc.stdout.close()
+            proc.stderr.close()
+
+        if proc.returncode:
+            return_code_handler._handle_return_code(cmd, err, '', proc.returncode)
+
+    def hg_command_lines(self, return_code_handler, *args):
+        """Run a hg command in path and return a generator that yields its output line by line, as it is produced.
+        Throws on error, once the output has been consumed.
+
+        If the generator is closed before the output is exhausted, the hg process is killed."""
+        pending = b''
+        for chunk in self.__hg_command_chunks(return_code_handler, args):
+            lines = (pending + chunk).split(b'\n')
+            pending = lines.pop()
+            for line in lines:
+                yield (line + b'\n').decode('utf-8')
+        if pending:
+            yield pending.decode('utf-8')
+
 
 
 
@@ -284,7 +730,7 @@ class Repo(object):
         """Write the repo configuration in the form of a ConfigParser object"""
         with open(os.path.join(self.path, '.hg', 'hgrc'), 'w') as f:
             config.write(f)
-        self.__cfg = None
+        hgrc.shared_config_cache.invalidate(self.__config_key())
 
     def is_extension_enabled(self, extension_name):
         """Determine if a named HG extension is enabled"""
@@ -315,7 +761,7 @@ class Repo(object):
         """Write the user HG configuration, in the form of a ConfigParser"""
         with open(os.path.expanduser(os.path.join('~', '.hgrc')), 'w') as f:
             config.write(f)
-        Repo.__user_cfg_mod_date = datetime.now()
+        hgrc.shared_config_cache.invalidate()
 
 
     def __refresh_extensions(self):
@@ -323,13 +769,67 @@ class Repo(object):
         self.__extensions = set(cfg.get('extensions', []))
 
 
+    def dirstate(self):
+        """Read the dirstate: the working directory's parents and branch, and the file table; returns a dirstate.Dirstate"""
+        try:
+            return dirstate.Dirstate(self.path)
+        except (dirstate.DirstateError, struct.error) as e:
+            raise HGError('Cannot read the dirstate: {0}'.format(e))
+
+    def working_copy_parents(self):
+        """The full node ids of the working directory's parents (two of them while a merge is in progress),
+        read from the dirstate"""
+        try:
+            p1, p2 = dirstate.read_parents(self.path)
+        except (dirstate.DirstateError, struct.error):
+            return self.hg_command(None, "parents", "--template", "{node}\n").split()   or  [dirstate.NULL_NODE]
+        return [p1]   if p2 == dirstate.NULL_NODE   else [p1, p2]
+
+    def working_copy_branch(self):
+        """The working directory's branch"""
+        return dirstate.read_branch(self.path)
+
+    def __changelog_revlog(self):
+        """The changelog, for looking up revision numbers of nodes, or None if it cannot be read directly"""
+        reader = self.__native_reader()
+        if reader is not None:
+            return reader.changelog
+        index = self.__changelog_index
+        try:
+            if index is None:
+                hg_dir = os.path.join(self.path, '.hg')
+                if not os.path.isfile(os.path.join(hg_dir, 'requires'))  or\
+                        not read_requirements(hg_dir).issubset(supported_requirements()):
+                    return None
+                index = self.__changelog_index = Revlog(os.path.join(hg_dir, 'store', '00changelog.i'))
+            else:
+                index.refresh()
+        except (IOError, OSError, RevlogError):
+            return None
+        return index
+
     def hg_id(self):
         """Get the output of the hg id command"""
-        res = self.hg_command(None, "id", "-i")
-        return res.strip("\n +")
-        
+        try:
+            p1, p2 = dirstate.read_parents(self.path)
+        except (dirstate.DirstateError, struct.error):
+            res = self.hg_command(None, "id", "-i")
+            return res.strip("\n +")
+        return p1[:12]   if p2 == dirstate.NULL_NODE   else '{0}+{1}'.format(p1[:12], p2[:12])
+
     def hg_rev(self):
         """Get the revision number of the current revision"""
+        try:
+            p1 = dirstate.read_parents(self.path)[0]
+        except (dirstate.DirstateError, struct.error):
+            p1 = None
+        if p1 is not None:
+            if p1 == dirstate.NULL_NODE:
+                return -1
+            changelog = self.__changelog_revlog()
+            rev = changelog.rev(p1)   if changelog is not None   else None
+            if rev is not None:
+                return rev
         res = self.hg_command(None, "id", "-n")
         str_rev = res.strip("\n +")
         return int(str_rev)
@@ -340,7 +840,10 @@ class Repo(object):
         rev_id - a string identifying the revision. If None, will use the current working directory
         """
         if rev_id is None:
-            rev_id = self.hg_id()
+            try:
+                return dirstate.read_parents(self.path)[0]
+            except (dirstate.DirstateError, struct.error):
+                rev_id = self.hg_id()
         res = self.hg_command(None, "log", "-r", rev_id, "--template", "{node}")
         return res.strip()
 
@@ -349,16 +852,7 @@ class Repo(object):
 
     def hg_log(self, rev_identifier=None, limit=None, template=None, filename=None, **kwargs):
         """Get repositiory log."""
-        cmds = ["log"]
-        if rev_identifier: cmds += ['-r', str(rev_identifier)]
-        if limit: cmds += ['-l', str(limit)]
-        if template: cmds += ['--template', str(template)]
-        if kwargs:
-            for key in kwargs:
-                cmds += [key, kwargs[key]]
-        if filename:
-            cmds.append(filename)
-        return self.hg_command(None, *cmds)
+        return self.hg_command(None, *_log_args(rev_identifier, limit, template, filename, kwargs))
 
 
 
@@ -377,72 +871,337 @@ class Repo(object):
         """
         if filenames is None:
             filenames = []
-        cmds = ['status'] + filenames
-        out = self.hg_command(None, *cmds).strip()
-        #default empty set
-        status = Status()
-        if not out: return status
-        lines = out.split("\n")
-        status_split = re.compile("^(.) (.*)$")
-
-        for change, path in [status_split.match(x).groups() for x in lines]:
-            getattr(status, self._status_codes[change]).add(path)
-        return status
-
-    _status_codes = {'A': 'added', 'M': 'modified', 'R': 'removed', '!': 'missing', '?': 'untracked'}
-    rev_log_tpl = '\{"node":"{node}","rev":"{rev}","author":"{author|urlescape}","branch":"{branches}","parents":"{parents}","date":"{date|isodate}","tags":"{tags}","desc":"{desc|urlescape}\"}\n'
+        if self.__watcher is not None  and  len(filenames) == 0:
+            return self.__hg_status_watched()
+        if self.__status_cache is not None:
+            return self.__status_cache.get(filenames, lambda: self.__hg_status(filenames))
+        return self.__hg_status(filenames)
 
+    # Beyond this many touched paths, running a full hg status is preferable
+    __WATCHED_STATUS_MAX_PATHS = 256
 
+    def __hg_status_watched(self):
+        dirty, all_dirty = self.__watcher.take_dirty()
+        try:
+            if all_dirty  or  self.__watched_status is None  or  len(dirty) > Repo.__WATCHED_STATUS_MAX_PATHS:
+                status = self.__hg_status([])
+            elif len(dirty) == 0:
+                status = self.__watched_status
+            else:
+                touched = self.__hg_status(['path:' + p   for p in sorted(dirty)])
+                prefixes = tuple([p + '/'   for p in dirty])
+                status = Status()
+                for name in ['added', 'modified', 'removed', 'untracked', 'missing']:
+                    previous = getattr(self.__watched_status, name)
+                    kept = {f   for f in previous   if f not in dirty  and  not f.startswith(prefixes)}
+                    setattr(status, name, kept | getattr(touched, name))
+        except:
+            # The touched paths have been taken from the watcher, so they would otherwise be forgotten
+            self.__watcher.mark_all_dirty()
+            raise
+        self.__watched_status = status
+        return status.copy()
+
+    def __hg_status(self, filenames):
+        out = self.__hg_file_command(None, ['status'], filenames)
+        return _status_from_output(out)
+
+    _status_codes = _STATUS_CODES
+    # Legacy log template; see _revisions_from_json_log
+    rev_log_tpl = '\{"node":"{node}","rev":"{rev}","author":"{author|urlescape}","branch":"{branches}","parents":"{parents}","date":"{date|isodate}","tags":"{tags}","desc":"{desc|urlescape}\"}\n'
+    # Log template used to build Revision objects; see _revisions_from_log
+    rev_log_fast_tpl = _LOG_TEMPLATE
 
-    @staticmethod
-    def __revision_from_json(json_rev):
-        """Create a Revision object from a JSON representation"""
-        j = json.loads(json_rev)
-        j = {key : unquote(value)   for key, value in j.items()}
-        rev = int(j['rev'])
-        branch = j['branch']
-        branch = branch   if branch   else 'default'
-        jparents = j['parents']
-        if not jparents:
-            parents = [rev-1]
-        else:
-            parents = [int(p.split(':')[0])   for p in jparents.split()]
-        return Revision(j['node'], rev, j['author'], branch, parents, j['date'], j['tags'], j['desc'])
 
 
+    __rev_number_pattern = re.compile(r'^\d+$')
+    __node_pattern = re.compile(r'^[0-9a-f]{40}$')
+    __rev_range_pattern = re.compile(r'^(\d+):(\d+)$')
 
-    @staticmethod
-    def __revision_from_log(log):
-        log = log.strip()
-        if len(log) > 0:
-            return Repo.__revision_from_json(log)
+    def __cached_revision(self, rev_identifier):
+        if self.__revision_cache is None:
+            return None
+        rev_identifier = str(rev_identifier)
+        if Repo.__rev_number_pattern.match(rev_identifier):
+            return self.__revision_cache.get_by_rev(int(rev_identifier))
+        elif Repo.__node_pattern.match(rev_identifier):
+            return self.__revision_cache.get_by_node(rev_identifier)
         else:
+            # Symbolic names such as 'tip' or branch names can move; always ask hg
             return None
 
-    @staticmethod
-    def __revisions_from_log(log):
-        lines = log.split('\n')[:-1]
-        lines = [line.strip()   for line in lines]
-        return [Repo.__revision_from_json(line)   for line in lines   if len(line) > 0]
+    def __cached_revisions(self, rev_identifier):
+        if self.__revision_cache is None:
+            return None
+        match = Repo.__rev_range_pattern.match(str(rev_identifier))
+        if match is not None:
+            start, stop = int(match.group(1)), int(match.group(2))
+            if start <= stop:
+                return self.__revision_cache.get_range(start, stop)
+        return None
+
+    def sync_revision_index(self):
+        """Bring the revision index up to date with the repository, adding new revisions from the tip,
+        or rebuilding it if history has been rewritten"""
+        index = self.__revision_index
+        if index is None:
+            return
+        # Held throughout, so that other threads cannot interleave lookups or additions with a reset and reload
+        with index.lock:
+            # Cleared first, so that commands completing meanwhile on other threads mark it stale again
+            self.__revision_index_stale = False
+            try:
+                self.__sync_revision_index(index)
+            except:
+                self.__revision_index_stale = True
+                raise
+
+    def __sync_revision_index(self, index):
+        tip_rev, still_present = check_tip(self, index.tip_rev, index.tip_node)
+        if not still_present:
+            index.reset()
+        if tip_rev > index.tip_rev:
+            batch = []
+            for rev in self.iter_revisions('{0}:{1}'.format(index.tip_rev + 1, tip_rev)):
+                batch.append(rev)
+                if len(batch) >= 1000:
+                    index.add(batch)
+                    batch = []
+            index.add(batch)
+        # Tags may have been added or moved without new revisions appearing below
+        tags_by_rev = {}
+        if tip_rev >= 0:
+            for line in self.hg_log(rev_identifier='tag() or tip', template='{rev}\t{tags}\n').split('\n'):
+                if line.strip() != '':
+                    rev, tags = line.split('\t', 1)
+                    tags_by_rev[int(rev)] = tags
+        index.set_tags(tags_by_rev)
+
+    def __indexed(self, lookup, may_be_newer):
+        """Perform lookup (a function of the index that returns None on a miss), syncing the index first if it is stale,
+        or if the lookup misses and may_be_newer() suggests that the revision(s) may be newer than the index"""
+        index = self.__revision_index
+        if index is None:
+            return None
+        synced = False
+        if self.__revision_index_stale:
+            self.sync_revision_index()
+            synced = True
+        result = lookup(index)
+        if result is None  and  not synced  and  may_be_newer(index):
+            self.sync_revision_index()
+            result = lookup(index)
+        return result
+
+    def __indexed_revision(self, rev_identifier):
+        rev_identifier = str(rev_identifier)
+        if Repo.__rev_number_pattern.match(rev_identifier):
+            n = int(rev_identifier)
+            return self.__indexed(lambda index: index.get_by_rev(n), lambda index: n > index.tip_rev)
+        elif Repo.__node_pattern.match(rev_identifier):
+            return self.__indexed(lambda index: index.get_by_node(rev_identifier), lambda index: True)
+        else:
+            return None
 
+    def __indexed_revisions(self, rev_identifier):
+        match = Repo.__rev_range_pattern.match(str(rev_identifier))
+        if match is not None:
+            start, stop = int(match.group(1)), int(match.group(2))
+            if start <= stop:
+                return self.__indexed(lambda index: index.get_range(start, stop), lambda index: stop > index.tip_rev)
+        return None
+
+    __native_range_pattern = re.compile(r'^(\d+|tip):(\d+|tip)$')
+
+    def __native_reader(self):
+        """The changelog reader, brought up to date, or None if it is not in use"""
+        reader = self.__changelog_reader
+        if reader is not None:
+            try:
+                reader.refresh()
+            except RevlogUnsupportedError:
+                # Obsolescence markers have appeared
+                reader.close()
+                self.__changelog_reader = reader = None
+        return reader
+
+    def __native_tags_by_node(self, reader):
+        tags = reader.tags_by_node()
+        if tags is None:
+            # hg's tags cache is stale; ask hg (which also refreshes the cache), at most once per tip
+            key = (reader.tip_rev, reader.tip_node())
+            if self.__native_tags[0] != key:
+                tags = {}
+                for line in self.hg_log(rev_identifier='tag() or tip', template='{node}\t{tags}\n').split('\n'):
+                    if line.strip() != '':
+                        node, names = line.split('\t', 1)
+                        tags[node] = names.split()
+                self.__native_tags = (key, tags)
+            tags = self.__native_tags[1]
+        return tags
+
+    def __native_rev_number(self, reader, rev_identifier):
+        if rev_identifier == 'tip':
+            return reader.tip_rev   if reader.tip_rev >= 0   else None
+        elif Repo.__rev_number_pattern.match(rev_identifier):
+            n = int(rev_identifier)
+            # Beyond the tip, hg would try the number as a node prefix
+            return n   if n <= reader.tip_rev   else None
+        elif Repo.__node_pattern.match(rev_identifier):
+            return reader.rev(rev_identifier)
+        return None
+
+    def __native_revision(self, rev_identifier):
+        reader = self.__native_reader()
+        if reader is None:
+            return None
+        try:
+            rev = self.__native_rev_number(reader, str(rev_identifier))
+            if rev is None:
+                return None
+            return reader.revision(rev, self.__native_tags_by_node(reader))
+        except RevlogError:
+            # e.g. a compression engine or revision flags that the reader does not support; hg can read it
+            return None
 
+    def __native_revisions(self, rev_identifier):
+        reader = self.__native_reader()
+        if reader is None:
+            return None
+        match = Repo.__native_range_pattern.match(str(rev_identifier))
+        if match is None:
+            return None
+        try:
+            start = self.__native_rev_number(reader, match.group(1))
+            stop = self.__native_rev_number(reader, match.group(2))
+            if start is None  or  stop is None:
+                return None
+            tags = self.__native_tags_by_node(reader)
+            step = 1   if start <= stop   else -1
+            return [reader.revision(rev, tags)   for rev in range(start, stop + step, step)]
+        except RevlogError:
+            return None
+
+    def __cache_revisions(self, revs):
+        if self.__revision_cache is not None:
+            for rev in revs:
+                self.__revision_cache.add(rev)
 
 
     def revision(self, rev_identifier):
         """Get the identified revision as a Revision object"""
-        out = self.hg_log(rev_identifier=str(rev_identifier), template=self.rev_log_tpl)
-        return Repo.__revision_from_log(out)
-
-    def revisions(self, rev_identifier):
-        """Returns a list of Revision objects for the given identifier"""
-        out = self.hg_log(rev_identifier=str(rev_identifier), template=self.rev_log_tpl)
-        return Repo.__revisions_from_log(out)
+        rev = self.__cached_revision(rev_identifier)
+        if rev is None:
+            rev = self.__native_revision(rev_identifier)
+            if rev is not None:
+                self.__cache_revisions([rev])
+        if rev is None:
+            rev = self.__indexed_revision(rev_identifier)
+            if rev is not None:
+                self.__cache_revisions([rev])
+        if rev is None:
+            out = self.hg_log(rev_identifier=str(rev_identifier), template=self.rev_log_fast_tpl)
+            revs = _revisions_from_log(out)
+            rev = revs[0]   if len(revs) > 0   else None
+            if rev is not None:
+                self.__cache_revisions([rev])
+        return rev
+
+    def revisions(self, rev_identifier, lazy=False):
+        """Returns a list of Revision objects for the given identifier.
+
+        If lazy is True, only the node, rev, branch and parents of each revision are fetched up front; the
+        first access to the author, date, tags or desc of any of them fetches those of all of them in one go"""
+        revs = self.__cached_revisions(rev_identifier)
+        if revs is None:
+            revs = self.__native_revisions(rev_identifier)
+            if revs is not None:
+                self.__cache_revisions(revs)
+        if revs is None:
+            revs = self.__indexed_revisions(rev_identifier)
+            if revs is not None:
+                self.__cache_revisions(revs)
+        if revs is None  and  lazy:
+            out = self.hg_log(rev_identifier=str(rev_identifier), template=_LAZY_LOG_TEMPLATE)
+            batch = RevisionBatch(self.__load_lazy_revision_fields, str(rev_identifier))
+            revs = []
+            for node, rev, branch, p1, p2 in _split_log_records(out, _LAZY_LOG_FIELD_COUNT):
+                parents = [int(p1)]   if p2 == '-1'   else [int(p1), int(p2)]
+                revs.append(LazyRevision(node, int(rev), branch, parents, batch))
+            self.__cache_revisions(revs)
+        if revs is None:
+            out = self.hg_log(rev_identifier=str(rev_identifier), template=self.rev_log_fast_tpl)
+            revs = _revisions_from_log(out)
+            self.__cache_revisions(revs)
+        return revs
+
+    def __load_lazy_revision_fields(self, rev_identifier, revs):
+        # Re-run the original query rather than listing the revisions, which could make for a huge command line
+        out = self.hg_log(rev_identifier=rev_identifier, template=_LAZY_DETAIL_LOG_TEMPLATE)
+        fields_by_node = {node: (_unescape(author), date, tags, _unescape(desc))
+                          for node, author, date, tags, desc in _split_log_records(out, _LAZY_DETAIL_LOG_FIELD_COUNT)}
+        missing = [r.rev   for r in revs   if r.node not in fields_by_node]
+        if len(missing) > 0:
+            # The query matches different revisions now (e.g. 'tip' has moved)
+            try:
+                out = self.hg_log(rev_identifier=_revset_for_revs(missing), template=_LAZY_DETAIL_LOG_TEMPLATE)
+            except HGError:
+                out = ''
+            for node, author, date, tags, desc in _split_log_records(out, _LAZY_DETAIL_LOG_FIELD_COUNT):
+                fields_by_node[node] = (_unescape(author), date, tags, _unescape(desc))
+        for r in revs:
+            if r.node not in fields_by_node:
+                raise HGError('Revision {0}:{1} is no longer in the repository'.format(r.rev, r.node))
+        return fields_by_node
 
 
     def revisions_for(self, filename, rev_identifier=None):
         """Returns a list of Revision objects for the given identifier"""
-        out = self.hg_log(rev_identifier=str(rev_identifier)   if rev_identifier is not None   else None, template=self.rev_log_tpl, filename=filename)
-        return Repo.__revisions_from_log(out)
+        if self.__revision_index is not None:
+            # Only the revision numbers are needed from hg; the rest comes from the index
+            out = self.hg_log(rev_identifier=str(rev_identifier)   if rev_identifier is not None   else None, template='{rev}\n', filename=filename)
+            rev_numbers = [int(line)   for line in out.split('\n')   if line.strip() != '']
+            revs = self.__indexed(lambda index: index.get_many(rev_numbers), lambda index: True)
+            if revs is not None:
+                return revs
+        out = self.hg_log(rev_identifier=str(rev_identifier)   if rev_identifier is not None   else None, template=self.rev_log_fast_tpl, filename=filename)
+        return _revisions_from_log(out)
+
+
+    def revision_table(self, rev_identifier, filename=None):
+        """Returns a RevisionTable for the given identifier; a compact, column-oriented alternative to revisions()
+        for analysing large histories. The log is streamed from hg, so it is never held in memory in its entirety."""
+        cmd = ['log', '-r', str(rev_identifier), '--template', _TABLE_LOG_TEMPLATE]
+        if filename:
+            cmd.append(filename)
+        table = RevisionTable()
+        for node, rev, author, branch, p1, p2, date, tags, desc in _iter_log_records(self.__hg_command_chunks(None, cmd), _LOG_FIELD_COUNT):
+            timestamp, tz_offset = date.split()
+            table.append(node, int(rev), _unescape(author), branch, int(p1), int(p2), float(timestamp), int(tz_offset), tags,
+                         _unescape(desc))
+        return table
+
+
+    def iter_revisions(self, rev_identifier, filename=None):
+        """Returns a generator that yields Revision objects for the given identifier as hg produces them.
+
+        Unlike revisions(), the log is never held in memory in its entirety, so this is suitable for
+        walking very large histories. Closing the generator early stops hg."""
+        cmd = ['log', '-r', str(rev_identifier), '--template', self.rev_log_fast_tpl]
+        if filename:
+            cmd.append(filename)
+        return _iter_revisions_from_chunks(self.__hg_command_chunks(None, cmd))
+
+
+    def changelog_graph(self, rev_identifier='0:tip'):
+        """Returns a ChangelogGraph of the revisions for the given identifier, for answering ancestry queries
+        in-process. Only revision numbers and parents are fetched from hg."""
+        graph = ChangelogGraph()
+        out = self.hg_command(None, 'log', '-r', str(rev_identifier), '--template', '{rev} {p1rev} {p2rev}\n')
+        records = [[int(x)   for x in line.split()]   for line in out.split('\n')   if line.strip() != '']
+        for rev, p1, p2 in sorted(records):
+            graph.add_revision(rev, [p1, p2])
+        return graph
 
 
     def hg_paths(self):
@@ -466,8 +1225,24 @@ class Repo(object):
 
     def hg_heads(self):
         """Gets a list with the node id's of all open heads"""
-        res = self.hg_command(self._heads_handler, "heads","--template", "{node}\n")
-        return [head for head in res.split("\n") if head]
+        memo = self.__branch_memo()
+        heads = memo.get('heads')   if memo is not None   else None
+        if heads is None:
+            reader = self.__native_reader()
+            if reader is not None:
+                heads = reader.heads()
+            else:
+                try:
+                    res = self.hg_command(self._heads_handler, "heads","--template", "{node}\n")
+                except HGHeadsNoHeads:
+                    heads = []
+                else:
+                    heads = [head for head in res.split("\n") if head]
+            if memo is not None:
+                memo['heads'] = heads
+        if len(heads) == 0:
+            raise HGHeadsNoHeads('No heads')
+        return list(heads)
 
 
 
@@ -495,6 +1270,122 @@ class Repo(object):
         self.hg_command(self._copy_handler, "copy", srcpath, destpath)
 
 
+    # Selections of more files than this are passed to hg in a list file (a listfile0: pattern) rather than
+    # on the command line
+    LISTFILE_THRESHOLD = 1000
+
+    def __file_pattern_args(self, paths):
+        """paths as arguments for hg: on the command line, or through a listfile0: pattern if there are more than
+        LISTFILE_THRESHOLD of them or they do not fit. Returns a tuple (args, listfile_path); the caller must remove
+        listfile_path if it is not None"""
+        if len(paths) <= self.LISTFILE_THRESHOLD  and  fits_on_command_line(paths):
+            return paths, None
+        listfile_path = write_listfile0(paths)
+        return ['listfile0:' + listfile_path], listfile_path
+
+    def __hg_file_command(self, return_code_handler, args, paths, trailing_args=None):
+        """Run a hg command on the files or patterns in paths, passing them in a list file if there are many of them.
+        Returns the output"""
+        file_args, listfile_path = self.__file_pattern_args(list(paths))
+        try:
+            return self.hg_command(return_code_handler, *(args + file_args + (trailing_args   or  [])))
+        finally:
+            if listfile_path is not None:
+                os.remove(listfile_path)
+
+    def __hg_file_command_with_err(self, return_code_handler, args, paths, trailing_args=None):
+        """As __hg_file_command, but returns a tuple (out, err, returncode); see __hg_command_with_err"""
+        file_args, listfile_path = self.__file_pattern_args(list(paths))
+        try:
+            return self.__hg_command_with_err(return_code_handler, args + file_args + (trailing_args   or  []))
+        finally:
+            if listfile_path is not None:
+                os.remove(listfile_path)
+
+    def __hg_bulk_file_operation(self, args, filepaths):
+        filepaths = list(filepaths)
+        if len(filepaths) == 0:
+            return FileOperationResult()
+        out, err, returncode = self.__hg_file_command_with_err(_ReturnCodeHandler().accept_returncode(1), args, filepaths)
+        failed, warnings = attribute_messages(self.path, err, {p: p   for p in filepaths})
+        return FileOperationResult([p   for p in filepaths   if p not in failed], failed, warnings)
+
+    def __hg_bulk_rename_operation(self, command, renames):
+        pairs = list(renames.items())   if isinstance(renames, dict)   else list(renames)
+        # Files that keep their names are moved/copied into their destination directories, one hg invocation per directory
+        by_dest_dir = {}
+        dest_dirs = []
+        singles = []
+        for src, dst in pairs:
+            name = os.path.basename(dst)
+            if name != ''  and  name == os.path.basename(src):
+                dest_dir = os.path.dirname(dst)   or   '.'
+                if dest_dir not in by_dest_dir:
+                    by_dest_dir[dest_dir] = []
+                    dest_dirs.append(dest_dir)
+                by_dest_dir[dest_dir].append((src, dst))
+            else:
+                singles.append([(src, dst)])
+        groups = []
+        for dest_dir in dest_dirs:
+            group = by_dest_dir[dest_dir]
+            if len(group) == 1:
+                singles.append(group)
+            else:
+                groups.append((dest_dir, group))
+        groups += [(None, group)   for group in singles]
+
+        failed = {}
+        warnings = []
+        # hg aborts (with return code 255) if none of the files of a group can be copied
+        handler = _ReturnCodeHandler().accept_returncode(1).accept_returncode(255)
+        for dest_dir, group in groups:
+            sources = [src   for src, dst in group]
+            if dest_dir is not None:
+                abs_dest_dir = os.path.join(self.path, dest_dir)
+                if not os.path.isdir(abs_dest_dir):
+                    os.makedirs(abs_dest_dir)
+                out, err, returncode = self.__hg_file_command_with_err(handler, [command], sources, [dest_dir])
+            else:
+                out, err, returncode = self.__hg_command_with_err(handler, [command, group[0][0], group[0][1]])
+            aborted = returncode == 255
+            if aborted  and  'abort: no files to copy' not in err:
+                raise HGError("Error running hg %s:\n\tErr: %s\n\tOut: %s\n\tExit: %s" % (command, err, out, returncode))
+            paths = {}
+            for src, dst in group:
+                paths[src] = paths[dst] = src
+            group_failed, group_warnings = attribute_messages(self.path, err, paths)
+            if aborted:
+                for src in sources:
+                    group_failed.setdefault(src, 'no files to copy')
+            failed.update(group_failed)
+            warnings += [w   for w in group_warnings   if not w.startswith('abort: no files to copy')]
+        return FileOperationResult([src   for src, dst in pairs   if src not in failed], failed, warnings)
+
+
+    def hg_add_many(self, filepaths):
+        """Add many files to the repo with as few hg invocations as possible (usually one), passing them
+        through a list file if they do not fit on the command line.
+
+        Returns a FileOperationResult; files that could not be added, e.g. because they do not exist or are already
+        tracked, are listed in its failed dictionary rather than causing an exception."""
+        return self.__hg_bulk_file_operation(['add'], filepaths)
+
+    def hg_remove_many(self, filepaths, force=False):
+        """Remove many files from the repo; see hg_add_many. Returns a FileOperationResult"""
+        return self.__hg_bulk_file_operation(['remove'] + (['--force']   if force   else []), filepaths)
+
+    def hg_move_many(self, renames):
+        """Move/rename many files in the repo. renames is a dictionary, or a sequence of tuples, mapping
+        source paths to destination paths. Files that keep their names are moved into each destination directory
+        with a single hg invocation. Returns a FileOperationResult whose paths are the source paths"""
+        return self.__hg_bulk_rename_operation('move', renames)
+
+    def hg_copy_many(self, copies):
+        """Copy many files in the repo; see hg_move_many. Returns a FileOperationResult"""
+        return self.__hg_bulk_rename_operation('copy', copies)
+
+
 
 
 
@@ -504,12 +1395,13 @@ class Repo(object):
         """Commit changes to the repository."""
         userspec = "-u" + user if user else "-u" + self.user if self.user else ""
         close = "--close-branch" if close_branch else ""
-        args = [close, userspec] + files
+        args = [close, userspec]
         # don't send a "" arg for userspec or close, which HG will
         # consider the files arg, committing all files instead of what
         # was passed in files kwarg
         args = [arg for arg in args if arg]
-        self.hg_command(self._commit_handler, "commit", "-m", message, *args)
+        # Large selections are passed in a list file, so that they are still committed in one go
+        self.__hg_file_command(self._commit_handler, ["commit", "-m", message] + args, files)
 
 
 
@@ -518,10 +1410,9 @@ class Repo(object):
         """Revert repository"""
 
         if all:
-            cmd = ["revert", "--all"]
+            self.hg_command(None, "revert", "--all")
         else:
-            cmd = ["revert"] + list(files)
-        self.hg_command(None, *cmd)
+            self.__hg_file_command(None, ["revert"], files)
         self._notify_filesystem_modified()
 
 
@@ -567,24 +1458,16 @@ class Repo(object):
             cmd.append(tool)
         if files is None:
             cmd.append('--all')
-        else:
-            cmd.extend(files)
         try:
-            self.hg_command(self._resolve_handler, *cmd)
+            self.__hg_file_command(self._resolve_handler, cmd, files   if files is not None   else [])
         finally:
             self._notify_filesystem_modified()
 
     def hg_resolve_mark_as_resolved(self, files=None):
-        cmd = ['resolve', '-m']
-        if files is not None:
-            cmd.extend(files)
-        self.hg_command(self._resolve_handler, *cmd)
+        self.__hg_file_command(self._resolve_handler, ['resolve', '-m'], files   if files is not None   else [])
 
     def hg_resolve_mark_as_unresolved(self, files=None):
-        cmd = ['resolve', '-u']
-        if files is not None:
-            cmd.extend(files)
-        self.hg_command(self._resolve_handler, *cmd)
+        self.__hg_file_command(self._resolve_handler, ['resolve', '-u'], files   if files is not None   else [])
 
     def hg_resolve_list(self):
         cmd = ['resolve', '-l']
@@ -602,7 +1485,7 @@ class Repo(object):
                 elif code == 'U':
                     state.unresolved.add(name)
                 else:
-                    raise ValueError, 'Unknown resolve code \'{0}\''.format(code)
+                    raise ValueError('Unknown resolve code \'{0}\''.format(code))
         return state
 
 
@@ -638,9 +1521,9 @@ class Repo(object):
         path = os.path.join(self.path, file)
         merge_path = path + suffix
         if not os.path.exists(path):
-            raise IOError, 'File \'{0}\' does not exist'.format(path)
+            raise IOError('File \'{0}\' does not exist'.format(path))
         if not os.path.exists(merge_path):
-            raise IOError, 'Merge file \'{0}\' does not exist'.format(merge_path)
+            raise IOError('Merge file \'{0}\' does not exist'.format(merge_path))
         shutil.copyfile(path, merge_path)
         self.hg_resolve_mark_as_resolved([file])
 
@@ -655,7 +1538,7 @@ class Repo(object):
         For each file in the input list, the existence of .base, .local, .other and .orig files it tested.
         If they exist, they are deleted
         """
-        if isinstance(files, str)  or  isinstance(files, unicode):
+        if isinstance(files, _string_types):
             files = [files]
 
         removed = False
@@ -674,20 +1557,30 @@ class Repo(object):
 
     _pull_handler = _ReturnCodeHandler().map_returncode_to_exception(1, HGUnresolvedFiles).map_returncode_to_exception(255, HGRepoUnrelated)
 
-    def hg_pull(self, progress_listener=None):
+    def hg_pull(self, progress_listener=None, transfer_listener=None, source=None):
+        """Pull from the default remote, or from source if given.
+
+        progress_listener - if not None, called with each line of hg's verbose output
+        transfer_listener - if not None, called with TransferEvent objects describing the progress of the transfer;
+            hg does not report the size of the data pulled from an ssh or http remote, so their bytes and throughput
+            are None
+        """
         def _stdout_listener(line):
             line = line.strip()
             if line != ''  and  line != '(run \'hg update\' to get a working copy)':
                 progress_listener(line)
         cmd = ['pull']
-        if progress_listener:
-            cmd.append('-v')
-        return self.hg_remote_command_with_stdout_listener(self._pull_handler, _stdout_listener   if progress_listener is not None   else None, *cmd)
+        if source is not None:
+            cmd.append(source)
+        return self.__hg_transfer_command(self._pull_handler, cmd, _stdout_listener   if progress_listener is not None   else None,
+                                          transfer_listener)
 
 
     _push_handler = _ReturnCodeHandler().map_returncode_to_exception(1, HGPushNothingToPushError).map_returncode_to_exception(255, HGRepoUnrelated)
 
-    def hg_push(self, force=False, progress_listener=None):
+    def hg_push(self, force=False, progress_listener=None, transfer_listener=None, destination=None):
+        """Push to the default remote, or to destination if given; progress_listener and transfer_listener are as
+        for hg_pull"""
         def _stdout_listener(line):
             line = line.strip()
             if line != '':
@@ -695,30 +1588,101 @@ class Repo(object):
         cmd = ['push']
         if force:
             cmd.append('--force')
-        if progress_listener:
-            cmd.append('-v')
-        return self.hg_remote_command_with_stdout_listener(self._push_handler, _stdout_listener   if progress_listener is not None   else None, *cmd)
-
+        if destination is not None:
+            cmd.append(destination)
+        return self.__hg_transfer_command(self._push_handler, cmd, _stdout_listener   if progress_listener is not None   else None,
+                                          transfer_listener)
+
+
+    def __hg_transfer_command(self, return_code_handler, cmd, stdout_listener, transfer_listener):
+        remote_options = _hg_config_options(self.user, self.ssh_key_path, self.disable_host_key_checking)
+        if stdout_listener is None  and  transfer_listener is None:
+            return self.hg_command(return_code_handler, *(remote_options + cmd))
+        if transfer_listener is None:
+            return self.__hg_command(return_code_handler, remote_options + cmd + ['-v'], stdout_listener)
+        progress = TransferProgress(transfer_listener)
+        def _transfer_stdout_listener(line):
+            progress.stdout_line(line)
+            if stdout_listener is not None:
+                stdout_listener(line)
+        result = self.__hg_command(return_code_handler, remote_options + PROGRESS_CONFIG + cmd + ['-v'],
+                                   _transfer_stdout_listener, progress.stderr_segment)
+        progress.finish()
+        return result
+
+
+
+    def __branch_memo(self):
+        """The branch table and heads memoized against the tip, filled in from hg's branch cache when it is valid;
+        a dictionary with optional 'branches' and 'heads' entries, discarded when the tip changes.
+        None if the changelog cannot be read directly."""
+        changelog = self.__changelog_revlog()
+        if changelog is None:
+            return None
+        tip_rev = len(changelog) - 1
+        tip_node = changelog.node(tip_rev)   if tip_rev >= 0   else dirstate.NULL_NODE
+        key = (tip_rev, tip_node, branchmap.obsstore_signature(self.path))
+        if self.__branch_info.get('key') != key:
+            self.__branch_info = {'key': key}
+            cache = branchmap.read_branch_cache(self.path, tip_rev, tip_node)
+            if cache is not None:
+                table = self.__branch_table_from_cache(changelog, cache)
+                if table is not None:
+                    self.__branch_info['branches'], self.__branch_info['heads'] = table
+        return self.__branch_info
 
+    @staticmethod
+    def __branch_table_from_cache(changelog, cache):
+        branches = []
+        open_heads = []
+        for name, heads in cache.items():
+            revs = [(changelog.rev(head.node), head)   for head in heads]
+            if None in [rev   for rev, head in revs]:
+                return None
+            revs.sort()
+            open_revs = [(rev, head)   for rev, head in revs   if not head.closed]
+            tip_rev, tip = open_revs[-1]   if len(open_revs) > 0   else revs[-1]
+            branches.append({'name': name, 'version': '{0}:{1}'.format(tip_rev, tip.node[:12]), 'rev': tip_rev,
+                             'node': tip.node, 'closed': len(open_revs) == 0, 'open_revs': [rev   for rev, head in open_revs]})
+            open_heads += open_revs
+        # A branch is active if one of its open heads has no children; only revisions after the oldest open head
+        # can be children of one
+        first = min([rev   for rev, head in open_heads])   if len(open_heads) > 0   else len(changelog)
+        parent_revs = set()
+        for rev in range(first + 1, len(changelog)):
+            parent_revs.update(changelog.parents(rev))
+        for branch in branches:
+            open_revs = branch.pop('open_revs')
+            branch['active'] = any([rev not in parent_revs   for rev in open_revs])
+        branches.sort(key=lambda b: (b['active'], b['rev'], b['name'], not b['closed']), reverse=True)
+        open_heads.sort(reverse=True)
+        return branches, [head.node   for rev, head in open_heads]
+
+    def __branches_from_hg(self):
+        branches = []
+        res = self.hg_command(None, 'branches', '--closed', '--template', '{branch}\\0{rev}\\0{node}\\0{active}\\0{closed}\\n')
+        for line in res.split('\n'):
+            if line != '':
+                name, rev, node, active, closed = line.split('\0')
+                branches.append({'name': name, 'version': '{0}:{1}'.format(rev, node[:12]), 'rev': int(rev),
+                                 'node': node, 'active': active == 'True', 'closed': closed == 'True'})
+        return branches
 
     def get_branches(self, active_only=False, show_closed=False):
-        """ Returns a list of branches from the repo, including versions """
-        cmd = ['branches']
-        if active_only:
-            cmd.append('--active')
-        if show_closed:
-            cmd.append('--closed')
-        branches = self.hg_command(None, *cmd)
-        branch_list = branches.strip().split("\n")
-        values = []
-        for branch in branch_list:
-            b = branch.partition(" ")
-            if not b:
-                continue
-            name = b[0].strip()
-            version = b[-1].strip()
-            values.append({'name':name, 'version':version})
-        return values
+        """ Returns a list of branches from the repo, including versions, most recent first, as listed by hg branches.
+
+        Each branch is a dictionary with the entries 'name', 'version' ('rev:short node' of the branch's tip),
+        'rev', 'node', 'active' (the branch has a head that is not merged into another branch) and 'closed'.
+        Read from hg's branch cache when it is up to date; results are memoized until the tip changes.
+        """
+        memo = self.__branch_memo()
+        branches = memo.get('branches')   if memo is not None   else None
+        if branches is None:
+            branches = self.__branches_from_hg()
+            if memo is not None:
+                memo['branches'] = branches
+        return [dict(branch)   for branch in branches
+                if (branch['active']  or  not active_only)  and  (not branch['closed']  or  show_closed)]
 
     def get_branch_names(self, active_only=False, show_closed=False):
         return [branch['name']   for branch in self.get_branches(active_only=active_only, show_closed=show_closed)]
@@ -775,7 +1739,7 @@ class Repo(object):
 
     def hg_rebase(self, source, destination):
         if not self.is_extension_enabled('rebase'):
-            raise HGExtensionDisabledError, 'rebase extension is disabled'
+            raise HGExtensionDisabledError('rebase extension is disabled')
         cmd = ['rebase', '--source', str(source), '--dest', str(destination)]
         return self.hg_command(self._rebase_handler, *cmd)
 
@@ -797,29 +1761,49 @@ class Repo(object):
 
     def read_config(self):
         """Read the configuration as seen with 'hg showconfig'
-        Is called by __init__ - only needs to be called explicitly
-        to reflect changes made since instantiation"""
+        Always runs hg; config(), configbool(), configlist() and is_extension_enabled() use a cached configuration
+        that is only re-read when one of the hgrc files that hg reads changes"""
+
+        sig = hgrc.shared_config_cache.signature(self.path, get_hg_path())
+        cfg = self.__read_config()
+        hgrc.shared_config_cache.put(self.__config_key(), cfg, sig)
+        return cfg
 
+    def __read_config(self):
+        if self.__native_config:
+            opts = _hg_config_options(self.user, self.ssh_key_path, self.disable_host_key_checking)
+            overrides = []
+            for option in opts[1::2]:
+                name, ign, value = option.partition('=')
+                section, ign, key = name.partition('.')
+                overrides.append((section, key, value))
+            try:
+                return hgrc.read_config(self.path, get_hg_path(), overrides)
+            except hgrc.ConfigParseError as e:
+                raise HGError(str(e))
         # Not technically a remote command, but use hg_remote_command so that the SSH key path config option is present
         res = self.hg_remote_command(None, "showconfig")
         cfg = {}
         for row in res.split("\n"):
+            if not row:
+                continue
             section, ign, value = row.partition("=")
             main, ign, sub = section.partition(".")
             sect_cfg = cfg.setdefault(main, {})
             sect_cfg[sub] = value.strip()
-        self.__cfg = cfg
-        self.__cfg_date = datetime.now()
         return cfg
 
 
+    def __config_key(self):
+        # The SSH options are passed to showconfig as --config options
+        manager = get_ssh_session_manager()
+        return (os.path.realpath(self.path), self.user, self.ssh_key_path, self.disable_host_key_checking, self.__native_config,
+                manager.control_dir   if manager is not None   else None)
+
     def __refresh_config(self):
-        if self.__cfg is None  or  \
-                (self.__cfg_date is not None and  \
-                Repo.__user_cfg_mod_date is not None and  \
-                self.__cfg_date < Repo.__user_cfg_mod_date):
-            self.read_config()
-        return self.__cfg
+        """Get the configuration, from the cache shared between Repo objects unless an hgrc file has changed"""
+        # Only read from, so the shared configuration need not be copied
+        return hgrc.shared_config_cache.get(self.__config_key(), self.path, self.__read_config, get_hg_path(), copy=False)
 
     def config(self, section, key):
         """Return the value of a configuration variable"""
@@ -854,56 +1838,81 @@ class Repo(object):
 
 
     def _notify_filesystem_modified(self):
+        if self.__status_cache is not None:
+            self.__status_cache.invalidate()
+        if self.__watcher is not None:
+            self.__watcher.notification_delivered()
         if self.__on_filesystem_modified is not None:
             self.__on_filesystem_modified()
 
 
     @staticmethod
-    def hg_init(path, user=None, ssh_key_path=None, disable_host_key_checking=False, on_filesystem_modified=None):
-        """Initialize a new repo"""
+    def hg_init(path, user=None, ssh_key_path=None, disable_host_key_checking=False, on_filesystem_modified=None, use_cmdserver=False,
+                cmdserver_pool_size=None, **repo_options):
+        """Initialize a new repo
+        repo_options - further keyword arguments for the Repo constructor, such as lazy or cache_status"""
         # Call hg_version() to check that it is installed and that it works
         hg_version()
         _hg_cmd(_default_return_code_handler, user, None, disable_host_key_checking, 'init', path)
-        repo = Repo(path, user, ssh_key_path=ssh_key_path, disable_host_key_checking=disable_host_key_checking, on_filesystem_modified=on_filesystem_modified)
+        repo = Repo(path, user, ssh_key_path=ssh_key_path, disable_host_key_checking=disable_host_key_checking, on_filesystem_modified=on_filesystem_modified,
+                    use_cmdserver=use_cmdserver, cmdserver_pool_size=cmdserver_pool_size, **repo_options)
         return repo
 
 
     _clone_handler = _ReturnCodeHandler().map_returncode_to_exception(255, HGCloneRepoNotFound)
 
     @staticmethod
-    def hg_clone(path, remote_uri, user=None, revision=None, ssh_key_path=None, disable_host_key_checking=False, on_filesystem_modified=None, ok_if_local_dir_exists=False):
-        """Clone an existing repo"""
+    def hg_clone(path, remote_uri, user=None, revision=None, ssh_key_path=None, disable_host_key_checking=False, on_filesystem_modified=None, ok_if_local_dir_exists=False, use_cmdserver=False,
+                 cmdserver_pool_size=None, **repo_options):
+        """Clone an existing repo
+        repo_options - further keyword arguments for the Repo constructor, such as lazy or cache_status"""
         # Call hg_version() to check that it is installed and that it works
         hg_version()
-        if os.path.exists(path):
-            if os.path.isdir(path):
-                if not ok_if_local_dir_exists:
-                    raise HGError, 'Local directory \'{0}\' already exists'.format(path)
-            else:
-                raise HGError, 'Cannot clone into \'{0}\'; it is not a directory'.format(path)
-        else:
-            os.makedirs(path)
+        _prepare_clone_path(path, ok_if_local_dir_exists)
         cmd = ['clone']
         if revision is not None:
             cmd.extend(['-r', revision])
         cmd.extend([remote_uri, path])
         _hg_cmd(Repo._clone_handler, user, ssh_key_path, disable_host_key_checking, *cmd)
-        repo = Repo(path, user, ssh_key_path=ssh_key_path, disable_host_key_checking=disable_host_key_checking, on_filesystem_modified=on_filesystem_modified)
+        repo = Repo(path, user, ssh_key_path=ssh_key_path, disable_host_key_checking=disable_host_key_checking, on_filesystem_modified=on_filesystem_modified,
+                    use_cmdserver=use_cmdserver, cmdserver_pool_size=cmdserver_pool_size, **repo_options)
         return repo
 
 
 
-def hg_version():
-    """Return version number of mercurial"""
+def _prepare_clone_path(path, ok_if_local_dir_exists):
+    """Create the directory to clone into, or check that an existing one may be used"""
+    if os.path.exists(path):
+        if os.path.isdir(path):
+            if not ok_if_local_dir_exists:
+                raise HGError('Local directory \'{0}\' already exists'.format(path))
+        else:
+            raise HGError('Cannot clone into \'{0}\'; it is not a directory'.format(path))
+    else:
+        os.makedirs(path)
+
+
+
+# hg version, keyed by the hg path
+_hg_versions = {}
+
+def hg_version(refresh=False):
+    """Return version number of mercurial
+    The version is only determined once for each hg path (see set_hg_path), unless refresh is True"""
+    hg_path = get_hg_path()
+    if not refresh  and  hg_path in _hg_versions:
+        return _hg_versions[hg_path]
     try:
         proc = Popen([get_hg_path(), "version"], stdout=PIPE, stderr=PIPE, env=_hg_env())
     except:
-        raise HGCannotLaunchError, 'Cannot launch hg executable'
+        raise HGCannotLaunchError('Cannot launch hg executable')
     out, err = [x.decode("utf-8") for x in  proc.communicate()]
     if proc.returncode:
-        raise HGCannotLaunchError, 'Cannot get hg version'
+        raise HGCannotLaunchError('Cannot get hg version')
     match = re.search('\s(([\w\.\-]+?)(\+[0-9]+)?)\)$', out.split("\n")[0])
-    return match.group(1)
+    version = match.group(1)
+    _hg_versions[hg_path] = version
+    return version
 
 
 
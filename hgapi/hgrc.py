@@ -0,0 +1,394 @@
+import glob
+import os
+import re
+import threading
+
+
+
+
+def _find_executable(name):
+    if os.path.dirname(name):
+        return name   if os.path.isfile(name)   else None
+    for d in os.environ.get('PATH', '').split(os.pathsep):
+        candidate = os.path.join(d, name)
+        if os.path.isfile(candidate):
+            return candidate
+    return None
+
+
+def _rc_dir_files(dir_path):
+    """The *.rc files of an hgrc.d-style directory, in the order in which hg reads them"""
+    try:
+        names = os.listdir(dir_path)
+    except OSError:
+        return []
+    return [os.path.join(dir_path, n)   for n in sorted(names)   if n.endswith('.rc')]
+
+
+def _mercurial_package_dirs():
+    """The directories of the importable mercurial package, found without importing it"""
+    try:
+        from importlib.util import find_spec
+    except ImportError:
+        import imp
+        try:
+            return [imp.find_module('mercurial')[1]]
+        except ImportError:
+            return []
+    try:
+        spec = find_spec('mercurial')
+    except (ImportError, ValueError):
+        return []
+    if spec is None  or  spec.submodule_search_locations is None:
+        return []
+    return list(spec.submodule_search_locations)
+
+
+def default_config_paths(hg_path='hg'):
+    """The directories holding the default configuration shipped within the mercurial package (e.g. merge tool
+    definitions), as a list of (path, is_directory) tuples. hg 5.2 and later keep it in mercurial/defaultrc,
+    earlier versions in mercurial/default.d. The mercurial package is located by import where possible, otherwise
+    relative to the installation prefix of hg."""
+    package_dirs = _mercurial_package_dirs()
+    if len(package_dirs) == 0:
+        hg_exe = _find_executable(hg_path)
+        if hg_exe is None:
+            return []
+        prefix = os.path.normpath(os.path.join(os.path.dirname(os.path.realpath(hg_exe)), '..'))
+        if os.name == 'nt':
+            patterns = [os.path.join(os.path.dirname(os.path.realpath(hg_exe)), 'lib', 'mercurial'),
+                        os.path.join(prefix, 'Lib', 'site-packages', 'mercurial')]
+        else:
+            patterns = [os.path.join(prefix, 'lib', 'python*', '*-packages', 'mercurial')]
+        package_dirs = [p   for pattern in patterns   for p in sorted(glob.glob(pattern))]
+    return [(os.path.join(d, name), True)   for d in package_dirs   for name in ('defaultrc', 'default.d')
+            if os.path.isdir(os.path.join(d, name))]
+
+
+def system_config_paths(hg_path='hg'):
+    """The system-wide configuration files and directories that hg reads, whether or not they exist,
+    as a list of (path, is_directory) tuples"""
+    paths = []
+    if os.name == 'nt':
+        hg_exe = _find_executable(hg_path)
+        if hg_exe is not None:
+            hg_dir = os.path.dirname(os.path.realpath(hg_exe))
+            paths += [(os.path.join(hg_dir, 'mercurial.ini'), False), (os.path.join(hg_dir, 'hgrc.d'), True)]
+        program_data = os.environ.get('PROGRAMDATA')
+        if program_data:
+            paths += [(os.path.join(program_data, 'Mercurial', 'mercurial.ini'), False)]
+    else:
+        etc_dirs = []
+        hg_exe = _find_executable(hg_path)
+        if hg_exe is not None:
+            # <install prefix>/etc/mercurial, relative to <install prefix>/bin/hg
+            etc_dirs.append(os.path.normpath(os.path.join(os.path.dirname(os.path.realpath(hg_exe)), '..', 'etc', 'mercurial')))
+        etc_dirs.append('/etc/mercurial')
+        for etc in etc_dirs:
+            paths += [(os.path.join(etc, 'hgrc'), False), (os.path.join(etc, 'hgrc.d'), True)]
+    return paths
+
+
+def user_config_paths():
+    """The per-user configuration files that hg reads, whether or not they exist"""
+    if os.name == 'nt':
+        home = os.path.expanduser('~')
+        paths = [os.path.join(home, 'mercurial.ini'), os.path.join(home, '.hgrc')]
+        profile = os.environ.get('USERPROFILE')
+        if profile  and  profile != home:
+            paths += [os.path.join(profile, 'mercurial.ini'), os.path.join(profile, '.hgrc')]
+        return paths
+    else:
+        paths = [os.path.expanduser(os.path.join('~', '.hgrc'))]
+        xdg = os.environ.get('XDG_CONFIG_HOME')  or  os.path.expanduser(os.path.join('~', '.config'))
+        paths.append(os.path.join(xdg, 'hg', 'hgrc'))
+        return paths
+
+
+def repo_config_paths(repo_path):
+    return [os.path.join(repo_path, '.hg', 'hgrc')]
+
+
+def _hgrcpath_paths(hgrcpath):
+    paths = []
+    for p in hgrcpath.split(os.pathsep):
+        if p:
+            p = os.path.expanduser(p)
+            paths.append((p, os.path.isdir(p)))
+    return paths
+
+
+def config_search_path(repo_path, hg_path='hg'):
+    """The configuration files and directories that hg reads for the repository at repo_path, in order, as a list of
+    (path, is_directory) tuples. If HGRCPATH is set, it replaces the default, system and user files, as it does for hg."""
+    hgrcpath = os.environ.get('HGRCPATH')
+    if hgrcpath is not None:
+        paths = _hgrcpath_paths(hgrcpath)
+    else:
+        paths = default_config_paths(hg_path) + system_config_paths(hg_path) + [(p, False)   for p in user_config_paths()]
+    return paths + [(p, False)   for p in repo_config_paths(repo_path)]
+
+
+
+
+# The environment variables that config_search_path depends on
+_SEARCH_PATH_ENV = ['HGRCPATH', 'PATH', 'HOME', 'USERPROFILE', 'XDG_CONFIG_HOME', 'PROGRAMDATA']
+
+
+def _stat_signature(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_ino, st.st_size, st.st_mtime)
+
+
+_include_pattern = re.compile(r'^%include\s+(\S|\S.*\S)\s*$')
+
+
+def _read_includes(path):
+    """The paths of the files that the configuration file at path %includes"""
+    includes = []
+    try:
+        with open(path, 'rb') as f:
+            lines = f.read().decode('utf-8', 'replace').splitlines()
+    except IOError:
+        return includes
+    base = os.path.dirname(path)
+    for line in lines:
+        match = _include_pattern.match(line)
+        if match is not None:
+            includes.append(_include_path(base, match.group(1)))
+    return includes
+
+
+def _include_path(base, inc):
+    return os.path.normpath(os.path.join(base, os.path.expandvars(os.path.expanduser(inc))))
+
+
+
+
+class ConfigParseError (Exception):
+    pass
+
+
+_section_pattern = re.compile(r'^\[([^\[]+)\]')
+_item_pattern = re.compile(r'^([^=\s][^=]*?)\s*=\s*((.*\S)?)')
+_continuation_pattern = re.compile(r'^\s+(\S|\S.*\S)\s*$')
+_empty_pattern = re.compile(r'^(;|#|\s*$)')
+_unset_pattern = re.compile(r'^%unset\s+(\S+)')
+
+# Configuration items that hg takes from environment variables, in order of increasing precedence
+_ENV_CONFIG_ITEMS = [('EDITOR', 'ui', 'editor'), ('VISUAL', 'ui', 'editor'), ('PAGER', 'pager', 'pager')]
+
+
+def parse_config_file(path, cfg, _including=None):
+    """Parse a Mercurial configuration file into cfg, a dictionary mapping section names to dictionaries
+    of items, following the same rules as hg: [section] headers, 'key = value' items, indented continuation lines,
+    comments starting with ';' or '#', '%include path' (relative to the including file) and '%unset key'.
+    Missing files are ignored. Raises ConfigParseError on malformed lines.
+
+    Multi-line values are joined with a literal backslash-n, as shown by hg showconfig."""
+    _including = _including   if _including is not None   else set()
+    try:
+        with open(path, 'rb') as f:
+            lines = f.read().decode('utf-8', 'replace').splitlines()
+    except IOError:
+        return cfg
+    _including.add(path)
+    section = ''
+    item = None
+    for line_number, line in enumerate(lines, 1):
+        if item is not None:
+            if line.startswith(';')  or  line.startswith('#'):
+                # Comments do not end a multi-line value
+                continue
+            match = _continuation_pattern.match(line)
+            if match is not None:
+                cfg[section][item] = cfg[section][item] + '\\n' + match.group(1)
+                continue
+            item = None
+        if _empty_pattern.match(line):
+            continue
+        match = _section_pattern.match(line)
+        if match is not None:
+            section = match.group(1)
+            cfg.setdefault(section, {})
+            continue
+        match = _item_pattern.match(line)
+        if match is not None:
+            item = match.group(1)
+            cfg.setdefault(section, {})[item] = match.group(2)   if match.group(2) is not None   else ''
+            continue
+        match = _unset_pattern.match(line)
+        if match is not None:
+            cfg.get(section, {}).pop(match.group(1), None)
+            continue
+        match = _include_pattern.match(line)
+        if match is not None:
+            inc = _include_path(os.path.dirname(path), match.group(1))
+            if inc not in _including:
+                parse_config_file(inc, cfg, _including)
+            continue
+        raise ConfigParseError('{0}:{1}: parse error: {2}'.format(path, line_number, line.strip()))
+    _including.discard(path)
+    return cfg
+
+
+def _parse_paths(paths, cfg):
+    for path, is_dir in paths:
+        if is_dir:
+            for p in _rc_dir_files(path):
+                parse_config_file(p, cfg)
+        else:
+            parse_config_file(path, cfg)
+
+
+def _apply_env_items(cfg):
+    for var, section, key in _ENV_CONFIG_ITEMS:
+        if os.environ.get(var):
+            cfg.setdefault(section, {})[key] = os.environ[var]
+
+
+def read_config(repo_path, hg_path='hg', overrides=None):
+    """Read the configuration that hg would use for the repository at repo_path, without running hg.
+    Returns a dictionary mapping section names to dictionaries of items, as Repo.read_config does.
+
+    Files are read in the same order as hg reads them (see config_search_path), with later files overriding
+    earlier ones. overrides is an optional list of (section, key, value) tuples applied last, as with
+    hg's --config option."""
+    cfg = {}
+    hgrcpath = os.environ.get('HGRCPATH')
+    if hgrcpath is not None:
+        _apply_env_items(cfg)
+        _parse_paths(_hgrcpath_paths(hgrcpath), cfg)
+    else:
+        _parse_paths(default_config_paths(hg_path) + system_config_paths(hg_path), cfg)
+        _apply_env_items(cfg)
+        _parse_paths([(p, False)   for p in user_config_paths()], cfg)
+    _parse_paths([(p, False)   for p in repo_config_paths(repo_path)], cfg)
+    if os.path.isdir(os.path.join(repo_path, '.hg')):
+        cfg.setdefault('bundle', {})['mainreporoot'] = os.path.realpath(repo_path)
+    for section, key, value in (overrides   or  []):
+        cfg.setdefault(section, {})[key] = value
+    # hg does not show empty sections
+    return {section: items   for section, items in cfg.items()   if items}
+
+
+
+
+def _copy_config(cfg):
+    return {section: dict(items)   for section, items in cfg.items()}
+
+
+
+
+class ConfigCache (object):
+    """Caches configurations read from hg, keyed on the stat signatures of every file that hg reads them from:
+    the system, user and repository files (see config_search_path) and the targets of their %include directives.
+
+    A cached configuration is used for as long as none of those files has been created, modified or deleted.
+    The search path itself is only worked out again when the environment variables that it depends on change, and
+    configuration directories are only listed again when their own stat signature changes.
+    Configurations are shared between Repo objects, so get() hands out copies unless asked not to.
+    The hits and misses counters record how often hg did not and did need to be run.
+    """
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__entries = {}
+        # path -> (signature, included paths), so that unchanged files are not re-read
+        self.__includes = {}
+        # (repo path, hg path, environment) -> search path
+        self.__search_paths = {}
+        # directory path -> (signature, *.rc files)
+        self.__dir_files = {}
+        self.hits = 0
+        self.misses = 0
+
+
+    def __search_path(self, repo_path, hg_path):
+        key = (repo_path, hg_path, tuple([os.environ.get(var)   for var in _SEARCH_PATH_ENV]))
+        paths = self.__search_paths.get(key)
+        if paths is None:
+            paths = config_search_path(repo_path, hg_path)
+            self.__search_paths[key] = paths
+        return paths
+
+
+    def __rc_dir_files(self, path, s):
+        entry = self.__dir_files.get(path)
+        if entry is None  or  entry[0] != s:
+            entry = (s, _rc_dir_files(path)   if s is not None   else [])
+            self.__dir_files[path] = entry
+        return entry[1]
+
+
+    def signature(self, repo_path, hg_path='hg'):
+        """The stat signatures of all configuration files that hg reads for the repository at repo_path"""
+        with self.__lock:
+            return self.__signature(repo_path, hg_path)
+
+
+    def __signature(self, repo_path, hg_path):
+        sig = [os.environ.get('HGRCPATH')]
+        visited = set()
+
+        def visit(path):
+            if path in visited:
+                return
+            visited.add(path)
+            s = _stat_signature(path)
+            sig.append((path, s))
+            if s is not None:
+                entry = self.__includes.get(path)
+                if entry is None  or  entry[0] != s:
+                    entry = (s, _read_includes(path))
+                    self.__includes[path] = entry
+                for inc in entry[1]:
+                    visit(inc)
+
+        for path, is_dir in self.__search_path(repo_path, hg_path):
+            if is_dir:
+                # Files being added to or removed from the directory change its signature
+                s = _stat_signature(path)
+                sig.append((path, s))
+                for p in self.__rc_dir_files(path, s):
+                    visit(p)
+            else:
+                visit(path)
+        return tuple(sig)
+
+
+    def get(self, key, repo_path, read_config, hg_path='hg', copy=True):
+        """Get the configuration for key, calling read_config() to read it from hg if there is no valid entry.
+        If copy is False, the cached configuration itself is returned, and must not be modified"""
+        with self.__lock:
+            sig = self.__signature(repo_path, hg_path)
+            entry = self.__entries.get(key)
+            if entry is not None  and  entry[0] == sig:
+                self.hits += 1
+                return _copy_config(entry[1])   if copy   else entry[1]
+            self.misses += 1
+        cfg = read_config()
+        self.put(key, cfg, sig)
+        return cfg
+
+
+    def put(self, key, cfg, sig):
+        """Store a copy of cfg for key"""
+        cfg = _copy_config(cfg)
+        with self.__lock:
+            self.__entries[key] = (sig, cfg)
+
+
+    def invalidate(self, key=None):
+        """Discard the entry for key, or all entries if key is None"""
+        with self.__lock:
+            if key is None:
+                self.__entries.clear()
+            else:
+                self.__entries.pop(key, None)
+
+
+# Shared by all Repo objects
+shared_config_cache = ConfigCache()
@@ -0,0 +1,309 @@
+import os
+import re
+import threading
+import time
+
+try:
+    from .hgapi import Repo, HGError
+    from .repogroup import RepoGroup
+except (ImportError, ValueError): #not imported as part of the package
+    from hgapi import Repo, HGError
+    from repogroup import RepoGroup
+
+
+
+
+# Outcomes of Mirror.sync()
+SYNC_CLONED = 'cloned'
+SYNC_PULLED = 'pulled'
+SYNC_UNCHANGED = 'unchanged'
+SYNC_FAILED = 'failed'
+
+
+
+
+class MirrorMetrics (object):
+    """Metrics for a Mirror. Times are as given by the mirror's clock, in seconds.
+    Available fields are::
+
+      checks - the number of times the upstream has been checked for changes
+      pulls - the number of pulls (and clones) made
+      skipped - the number of checks that found nothing to pull
+      failures, consecutive_failures - the number of failed syncs, in total and since the last success
+      changesets_fetched, bytes_fetched - totals over all pulls; bytes are those reported by hg, uncompressed
+      last_fetched - the number of changesets fetched by the last pull
+      last_pull_duration - how long the last pull took
+      last_check_time - when the upstream was last checked
+      last_sync_time - when the mirror was last known to match the upstream (None if never)
+      next_check_time - when the mirror is next due to be checked
+      last_error - the exception raised by the last failed sync, if the last sync failed
+      lag - the time since last_sync_time, as of when the metrics were taken (None if never in sync)
+    """
+    def __init__(self):
+        self.checks = 0
+        self.pulls = 0
+        self.skipped = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.changesets_fetched = 0
+        self.bytes_fetched = 0
+        self.last_fetched = None
+        self.last_pull_duration = None
+        self.last_check_time = None
+        self.last_sync_time = None
+        self.next_check_time = None
+        self.last_error = None
+        self.lag = None
+
+
+    def copy(self):
+        x = MirrorMetrics()
+        x.__dict__.update(self.__dict__)
+        return x
+
+
+    def __repr__(self):
+        return 'MirrorMetrics(checks={0}, pulls={1}, skipped={2}, failures={3}, changesets_fetched={4}, lag={5!r})'.format(
+            self.checks, self.pulls, self.skipped, self.failures, self.changesets_fetched, self.lag)
+
+
+
+
+class Mirror (object):
+    """A local mirror of the repository at upstream, kept in path.
+
+    sync() clones the upstream if the mirror does not exist yet, and otherwise pulls from it, but only when the
+    mirror does not have the upstream's tip yet; that check asks the upstream for a single node id. The mirror is due
+    to be synced again interval seconds after a successful sync. After a failed sync the delay starts at
+    retry_delay and doubles with each consecutive failure, up to max_retry_delay.
+    The working copy of the mirror is not updated.
+
+    Safe to use from multiple threads; syncs of one mirror do not overlap.
+    """
+    def __init__(self, upstream, path, interval=300, retry_delay=30, max_retry_delay=3600, user=None, ssh_key_path=None,
+                 disable_host_key_checking=False, clock=time.time):
+        self.upstream = upstream
+        self.path = path
+        self.interval = interval
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.user = user
+        self.ssh_key_path = ssh_key_path
+        self.disable_host_key_checking = disable_host_key_checking
+        self.__clock = clock
+        self.__repo = None
+        self.__sync_lock = threading.Lock()
+        self.__metrics_lock = threading.Lock()
+        self.__metrics = MirrorMetrics()
+        self.__metrics.next_check_time = clock()
+
+
+    @property
+    def repo(self):
+        """The Repo of the mirror; None until it has been cloned"""
+        if self.__repo is None  and  os.path.isdir(os.path.join(self.path, '.hg')):
+            self.__repo = Repo(self.path, self.user, ssh_key_path=self.ssh_key_path,
+                               disable_host_key_checking=self.disable_host_key_checking)
+        return self.__repo
+
+
+    @property
+    def metrics(self):
+        """A snapshot of the mirror's MirrorMetrics"""
+        with self.__metrics_lock:
+            metrics = self.__metrics.copy()
+        if metrics.last_sync_time is not None:
+            metrics.lag = max(0.0, self.__clock() - metrics.last_sync_time)
+        return metrics
+
+
+    def is_due(self, now=None):
+        now = now   if now is not None   else self.__clock()
+        with self.__metrics_lock:
+            return self.__metrics.next_check_time <= now
+
+
+    def retry_delay_after(self, consecutive_failures):
+        """The delay before retrying after the given number of consecutive failed syncs"""
+        return min(self.max_retry_delay, self.retry_delay * (2 ** (consecutive_failures - 1)))
+
+
+    def upstream_tip(self, repo):
+        """The node id of the upstream's tip, fetched through repo"""
+        out = repo.hg_remote_command(None, '--debug', 'identify', '--id', '-r', 'tip', self.upstream).strip()
+        if not re.match(r'^[0-9a-f]{40}$', out):
+            raise HGError('Unexpected output from hg identify: {0!r}'.format(out))
+        return out
+
+
+    def __is_known(self, repo, node):
+        # id() selects nothing, rather than failing, if the node is unknown
+        return repo.hg_command(None, 'log', '-r', 'id({0})'.format(node), '--template', '{node}').strip() != ''
+
+
+    def __pull(self, repo):
+        events = []
+        repo.hg_pull(transfer_listener=events.append, source=self.upstream)
+        final = events[-1]   if events   else None
+        changesets = final.changesets   if final is not None  and  final.changesets is not None   else 0
+        size = final.bytes   if final is not None  and  final.bytes is not None   else 0
+        return changesets, size
+
+
+    def __clone(self):
+        self.__repo = Repo.hg_clone(self.path, self.upstream, user=self.user, ssh_key_path=self.ssh_key_path,
+                                    disable_host_key_checking=self.disable_host_key_checking, ok_if_local_dir_exists=True)
+        out = self.__repo.hg_command(None, 'log', '-r', 'tip', '--template', '{rev}').strip()
+        return int(out) + 1, 0
+
+
+    def sync(self):
+        """Bring the mirror up to date with the upstream if it might not be. Returns SYNC_CLONED, SYNC_PULLED,
+        SYNC_UNCHANGED or SYNC_FAILED; the error of a failed sync is available as metrics.last_error"""
+        with self.__sync_lock:
+            t_start = self.__clock()
+            try:
+                repo = self.repo
+                if repo is None:
+                    outcome = SYNC_CLONED
+                    fetched, size = self.__clone()
+                elif self.__is_known(repo, self.upstream_tip(repo)):
+                    outcome = SYNC_UNCHANGED
+                    fetched, size = 0, 0
+                else:
+                    outcome = SYNC_PULLED
+                    fetched, size = self.__pull(repo)
+            except Exception as e:
+                # Recorded rather than raised, so that one mirror cannot stop a MirrorDaemon
+                self.__record_failure(t_start, e)
+                return SYNC_FAILED
+            self.__record_success(t_start, outcome, fetched, size)
+            return outcome
+
+
+    def __record_success(self, t_start, outcome, fetched, size):
+        now = self.__clock()
+        with self.__metrics_lock:
+            m = self.__metrics
+            m.checks += 1
+            m.last_check_time = t_start
+            if outcome == SYNC_UNCHANGED:
+                m.skipped += 1
+            else:
+                m.pulls += 1
+                m.changesets_fetched += fetched
+                m.bytes_fetched += size
+                m.last_fetched = fetched
+                m.last_pull_duration = now - t_start
+            # The mirror matched the upstream as of when it was checked
+            m.last_sync_time = t_start
+            m.consecutive_failures = 0
+            m.last_error = None
+            m.next_check_time = now + self.interval
+
+
+    def __record_failure(self, t_start, error):
+        now = self.__clock()
+        with self.__metrics_lock:
+            m = self.__metrics
+            m.checks += 1
+            m.last_check_time = t_start
+            m.failures += 1
+            m.consecutive_failures += 1
+            m.last_error = error
+            m.next_check_time = now + self.retry_delay_after(m.consecutive_failures)
+
+
+    def __repr__(self):
+        return 'Mirror({0!r}, {1!r})'.format(self.upstream, self.path)
+
+
+
+
+class MirrorDaemon (object):
+    """Keeps a set of Mirrors in sync, syncing each when it is due.
+
+    sync_due() syncs the mirrors that are due, up to max_workers at a time, and returns a dictionary mapping each
+    of them to the outcome of its sync. start() does so repeatedly on a background thread, waking when the next
+    mirror is due, until stop() is called.
+    """
+    def __init__(self, mirrors=None, max_workers=4, clock=time.time):
+        self.max_workers = max_workers
+        self.__clock = clock
+        self.__mirrors = list(mirrors)   if mirrors is not None   else []
+        self.__lock = threading.Lock()
+        self.__stop = threading.Event()
+        self.__wake = threading.Event()
+        self.__thread = None
+
+
+    @property
+    def mirrors(self):
+        with self.__lock:
+            return list(self.__mirrors)
+
+
+    def add(self, mirror):
+        with self.__lock:
+            self.__mirrors.append(mirror)
+        self.__wake.set()
+        return mirror
+
+
+    def remove(self, mirror):
+        with self.__lock:
+            self.__mirrors.remove(mirror)
+        self.__wake.set()
+
+
+    def metrics(self):
+        """A dictionary mapping the path of each mirror to a snapshot of its MirrorMetrics"""
+        return {m.path : m.metrics   for m in self.mirrors}
+
+
+    def sync_due(self):
+        now = self.__clock()
+        due = [m   for m in self.mirrors   if m.is_due(now)]
+        # RepoGroup.run hands the mirrors to the function as they are; it does not need them to be Repos
+        results = RepoGroup(due, max_workers=self.max_workers).run(lambda mirror: mirror.sync())
+        # Mirror.sync records its failures; anything else is reported as a failed sync too, rather than stopping
+        # the daemon
+        return {r.repo : r.value   if r.ok   else SYNC_FAILED   for r in results}
+
+
+    def next_due_time(self):
+        """The time at which the next mirror is due, or None if there are no mirrors"""
+        times = [m.metrics.next_check_time   for m in self.mirrors]
+        return min(times)   if times   else None
+
+
+    def start(self):
+        """Sync the mirrors on a background thread until stop() is called"""
+        if self.__thread is not None:
+            raise ValueError('Mirror daemon already started')
+        self.__stop.clear()
+        self.__thread = threading.Thread(target=self.__run)
+        self.__thread.daemon = True
+        self.__thread.start()
+
+
+    def stop(self, timeout=None):
+        """Stop the background thread, waiting for a sync in progress to complete"""
+        self.__stop.set()
+        self.__wake.set()
+        if self.__thread is not None:
+            self.__thread.join(timeout)
+            self.__thread = None
+
+
+    def __run(self):
+        while True:
+            # Clear before looking at the mirrors, so that a change made from here on wakes the wait below;
+            # stop() sets __stop before __wake, so it cannot be missed either
+            self.__wake.clear()
+            if self.__stop.is_set():
+                break
+            self.sync_due()
+            next_due = self.next_due_time()
+            delay = max(0.0, next_due - self.__clock())   if next_due is not None   else None
+            self.__wake.wait(delay)
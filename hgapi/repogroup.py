@@ -0,0 +1,244 @@
+import os
+import re
+import threading
+import time
+
+try:
+    from Queue import Queue
+except ImportError: #python 3
+    from queue import Queue
+
+try:
+    from urlparse import urlsplit
+except ImportError: #python 3
+    from urllib.parse import urlsplit
+
+
+
+
+# Remote URLs have a scheme; local paths, including Windows drive letters, do not
+_URL_PATTERN = re.compile(r'^[a-zA-Z][a-zA-Z0-9+.-]+://')
+
+
+def remote_host(url):
+    """The host name of a remote repository URL, lowercased; None for local paths and file: URLs"""
+    if url is None  or  not _URL_PATTERN.match(url):
+        return None
+    parts = urlsplit(url)
+    if parts.scheme == 'file':
+        return None
+    return parts.hostname   or  None
+
+
+# The host of a task that has not been looked up yet
+_UNRESOLVED = object()
+
+
+def _limit_key(url):
+    """The key that concurrent operations against url are limited by: its host, or for a local repository its path"""
+    host = remote_host(url)
+    if host is not None:
+        return host
+    if url.startswith('file://'):
+        url = urlsplit(url).path
+    return os.path.normcase(os.path.realpath(url))
+
+
+
+
+class RepoResult (object):
+    """The outcome of an operation on one repository of a RepoGroup.
+    Available fields are:
+    repo - the Repo (or other object) that the operation was run on
+    index - the position of the repo within the group
+    value - the return value of the operation; None if it failed
+    error - the exception raised by the operation, if any
+    elapsed - the time that the operation took, in seconds
+    """
+    __slots__ = ('repo', 'index', 'value', 'error', 'elapsed')
+
+    def __init__(self, repo, index, value, error, elapsed):
+        self.repo = repo
+        self.index = index
+        self.value = value
+        self.error = error
+        self.elapsed = elapsed
+
+
+    @property
+    def ok(self):
+        return self.error is None
+
+
+    def get(self):
+        """The value of the operation; raises its exception if it failed"""
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+
+    def __repr__(self):
+        outcome = 'error={0!r}'.format(self.error)   if self.error is not None   else 'value={0!r}'.format(self.value)
+        return 'RepoResult(path={0!r}, {1}, elapsed={2:.3f})'.format(getattr(self.repo, 'path', self.repo), outcome, self.elapsed)
+
+
+
+
+class RepoGroup (object):
+    """Runs operations over many repositories at once, on a bounded pool of threads.
+
+    The work is done by hg processes, so threads are sufficient to keep max_workers of them running at once.
+    Operations that contact a remote (see REMOTE_OPERATIONS) run at most max_per_host at a time against any one
+    host, taken from the source or destination argument if one is given (see REMOTE_ARGUMENTS), and otherwise from
+    each repo's default path; a local path counts as a host of its own. Operations on other hosts, and operations
+    that do not contact a remote, are not held up behind them.
+
+    map() and run() with a function accept any objects in place of Repos, and only hand them to the function.
+
+    Every method starts an operation on all of the repos and returns an iterator that yields a RepoResult for each
+    as it completes, in order of completion. An exception raised by one repo's operation is recorded in its result
+    rather than stopping the others. Use run() to wait for all of the results, in the order of the repos.
+    """
+    REMOTE_OPERATIONS = frozenset(['hg_pull', 'hg_push', 'hg_remote_command', 'hg_remote_command_with_stdout_listener'])
+    # The keyword argument of a remote operation that names the remote to use in place of the default path
+    REMOTE_ARGUMENTS = {'hg_pull': 'source', 'hg_push': 'destination'}
+
+    def __init__(self, repos, max_workers=8, max_per_host=2):
+        if max_workers < 1:
+            raise ValueError('max_workers must be at least 1')
+        if max_per_host is not None  and  max_per_host < 1:
+            raise ValueError('max_per_host must be at least 1, or None')
+        self.repos = list(repos)
+        self.max_workers = max_workers
+        self.max_per_host = max_per_host
+
+
+    def __len__(self):
+        return len(self.repos)
+
+    def __iter__(self):
+        return iter(self.repos)
+
+
+    def __host(self, repo, remote):
+        if remote is None:
+            try:
+                remote = repo.config('paths', 'default')
+            except Exception:
+                return None
+        return _limit_key(remote)   if remote   else None
+
+
+    def map(self, function, *args, **kwargs):
+        """Call function(repo, *args, **kwargs) for each repo; returns an iterator of RepoResults, as for apply().
+        Calls are not limited per host; use apply() for that."""
+        return self.__run(lambda repo: function(repo, *args, **kwargs), None, None)
+
+
+    def apply(self, operation, *args, **kwargs):
+        """Call the Repo method named operation on each repo; returns an iterator that yields a RepoResult for
+        each repo as it completes"""
+        remote = kwargs.get(self.REMOTE_ARGUMENTS.get(operation))
+        return self.__run(lambda repo: getattr(repo, operation)(*args, **kwargs), operation, remote)
+
+
+    def run(self, operation, *args, **kwargs):
+        """As apply(), but waits for all of the repos and returns a list of their RepoResults in the order of the
+        repos. operation may also be a function, as for map()"""
+        if callable(operation):
+            results = list(self.map(operation, *args, **kwargs))
+        else:
+            results = list(self.apply(operation, *args, **kwargs))
+        results.sort(key=lambda r: r.index)
+        return results
+
+
+    def __run(self, call, operation, remote):
+        # Tasks not yet started, as (index, repo, host); guarded by condition, along with running_per_host.
+        # Hosts are resolved by the workers, as reading a repo's configuration may run hg
+        limited = self.max_per_host is not None  and  operation in self.REMOTE_OPERATIONS
+        pending = [(index, repo, _UNRESOLVED   if limited   else None)   for index, repo in enumerate(self.repos)]
+        running_per_host = {}
+        condition = threading.Condition()
+        results = Queue()
+
+        def _take(host):
+            if host is None:
+                return True
+            if running_per_host.get(host, 0) < self.max_per_host:
+                running_per_host[host] = running_per_host.get(host, 0) + 1
+                return True
+            return False
+
+        def _next_task():
+            with condition:
+                while True:
+                    if len(pending) == 0:
+                        return None
+                    for i, (index, repo, host) in enumerate(pending):
+                        if host is _UNRESOLVED  or  _take(host):
+                            del pending[i]
+                            return index, repo, host
+                    # Every remaining repo is on a host that is at its limit
+                    condition.wait()
+
+        def _task_done(host):
+            if host is not None:
+                with condition:
+                    running_per_host[host] -= 1
+                    condition.notify_all()
+
+        def _worker():
+            while True:
+                task = _next_task()
+                if task is None:
+                    return
+                index, repo, host = task
+                if host is _UNRESOLVED:
+                    host = self.__host(repo, remote)
+                    with condition:
+                        if not _take(host):
+                            # Wait for the host's turn behind the other tasks
+                            pending.append((index, repo, host))
+                            condition.notify_all()
+                            continue
+                t_start = time.time()
+                try:
+                    value, error = call(repo), None
+                except Exception as e:
+                    value, error = None, e
+                finally:
+                    _task_done(host)
+                results.put(RepoResult(repo, index, value, error, time.time() - t_start))
+
+        count = len(pending)
+        for i in range(min(self.max_workers, count)):
+            worker = threading.Thread(target=_worker)
+            worker.daemon = True
+            worker.start()
+
+        def _completed():
+            for i in range(count):
+                yield results.get()
+        return _completed()
+
+
+    def hg_pull(self, **kwargs):
+        """Pull every repo; see Repo.hg_pull"""
+        return self.apply('hg_pull', **kwargs)
+
+    def hg_push(self, **kwargs):
+        """Push every repo; see Repo.hg_push"""
+        return self.apply('hg_push', **kwargs)
+
+    def hg_update(self, reference, clean=False):
+        """Update every repo to reference; see Repo.hg_update"""
+        return self.apply('hg_update', reference, clean=clean)
+
+    def hg_status(self):
+        """Get the status of every repo; see Repo.hg_status"""
+        return self.apply('hg_status')
+
+    def hg_id(self):
+        """Get the working copy id of every repo"""
+        return self.apply('hg_id')
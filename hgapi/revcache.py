@@ -0,0 +1,111 @@
+import threading
+from collections import OrderedDict
+try:
+    from .revision import LazyRevision
+except (ImportError, ValueError): #not imported as part of the package
+    from revision import LazyRevision
+
+
+
+
+class RevisionCache (object):
+    """A size-bounded, least-recently-used cache of Revision objects, keyed by both node and local revision number.
+
+    A changeset's node, author, date, description and parents never change. Its local revision number only
+    changes if history is rewritten (strip, rollback, rebase), and its tags change whenever a tag is added or moved
+    (every commit moves 'tip'). Use clear() and discard_tagged() respectively to account for those.
+
+    Safe for use from multiple threads.
+
+    Available counters are::
+
+      hits, misses
+    """
+    def __init__(self, max_size):
+        if max_size < 1:
+            raise ValueError('Revision cache size must be at least 1')
+        self.max_size = max_size
+        self.__by_node = OrderedDict()
+        self.__node_by_rev = {}
+        self.__lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+
+
+    def __len__(self):
+        with self.__lock:
+            return len(self.__by_node)
+
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return float(self.hits) / lookups   if lookups > 0   else 0.0
+
+
+    def get_by_node(self, node):
+        """Get the cached Revision whose node is node, or None"""
+        with self.__lock:
+            rev = self.__by_node.pop(node, None)
+            if rev is None:
+                self.misses += 1
+                return None
+            # Re-insert to mark as most recently used
+            self.__by_node[node] = rev
+            self.hits += 1
+            return rev
+
+
+    def get_by_rev(self, rev_number):
+        """Get the cached Revision whose local revision number is rev_number, or None"""
+        with self.__lock:
+            node = self.__node_by_rev.get(rev_number)
+            if node is None:
+                self.misses += 1
+                return None
+            return self.get_by_node(node)
+
+
+    def get_range(self, start, stop):
+        """Get the cached Revisions numbered start to stop inclusive, in that order, or None if any are missing"""
+        with self.__lock:
+            nodes = []
+            for rev_number in range(start, stop + 1):
+                node = self.__node_by_rev.get(rev_number)
+                if node is None:
+                    self.misses += 1
+                    return None
+                nodes.append(node)
+            revs = [self.get_by_node(node)   for node in nodes]
+            # Recency updates cannot evict anything, so all are present
+            return revs
+
+
+    def add(self, rev):
+        """Add a Revision to the cache, evicting the least recently used entries if it is full"""
+        with self.__lock:
+            self.__by_node.pop(rev.node, None)
+            self.__by_node[rev.node] = rev
+            self.__node_by_rev[rev.rev] = rev.node
+            while len(self.__by_node) > self.max_size:
+                node, evicted = self.__by_node.popitem(last=False)
+                if self.__node_by_rev.get(evicted.rev) == node:
+                    del self.__node_by_rev[evicted.rev]
+
+
+    def discard_tagged(self):
+        """Remove all revisions that carry tags, as the tags of a revision may have changed.
+        Lazy revisions whose tags have not been loaded yet are kept, as they will get the current tags."""
+        with self.__lock:
+            for node, rev in list(self.__by_node.items()):
+                if (not isinstance(rev, LazyRevision)  or  rev.is_loaded)  and  rev.tags:
+                    del self.__by_node[node]
+                    if self.__node_by_rev.get(rev.rev) == node:
+                        del self.__node_by_rev[rev.rev]
+
+
+    def clear(self):
+        """Remove all revisions; use after history has been rewritten"""
+        with self.__lock:
+            self.__by_node.clear()
+            self.__node_by_rev.clear()
@@ -0,0 +1,156 @@
+import os
+import hashlib
+import threading
+
+try:
+    import sqlite3
+except ImportError: # e.g. Jython
+    sqlite3 = None
+
+try:
+    from .revision import Revision
+except (ImportError, ValueError): #not imported as part of the package
+    from revision import Revision
+
+
+
+
+def is_available():
+    """Determine if the sqlite3 module needed by RevisionIndex can be imported"""
+    return sqlite3 is not None
+
+
+
+
+class RevisionIndex (object):
+    """A persistent SQLite index of the Revision fields of a repository, stored in a cache directory.
+
+    The index only stores what it is given; Repo keeps it in sync with the repository by adding
+    new revisions from the tip and resetting it if history has been rewritten.
+
+    The connection is shared by the threads that use the Repo, so every operation on it is made under a lock.
+    Hold lock (it is re-entrant) to make a sequence of operations atomic.
+    """
+    _SCHEMA_VERSION = '1'
+
+    def __init__(self, repo_path, cache_dir):
+        if sqlite3 is None:
+            raise ImportError('The sqlite3 module is not available')
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        key = hashlib.sha1(os.path.abspath(repo_path).encode('utf-8')).hexdigest()[:16]
+        self.db_path = os.path.join(cache_dir, 'hgapi-revindex-{0}.sqlite'.format(key))
+        self.__lock = threading.RLock()
+        self.__db = sqlite3.connect(self.db_path, check_same_thread=False)
+        self.__db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+        if self.__get_meta('schema_version') != self._SCHEMA_VERSION:
+            self.__db.execute('DROP TABLE IF EXISTS revisions')
+        self.__db.execute('CREATE TABLE IF NOT EXISTS revisions (rev INTEGER PRIMARY KEY, node TEXT UNIQUE, author TEXT, '
+                          'branch TEXT, parents TEXT, date TEXT, tags TEXT, desc TEXT)')
+        self.__set_meta('schema_version', self._SCHEMA_VERSION)
+        self.__db.commit()
+
+
+    @property
+    def lock(self):
+        return self.__lock
+
+
+    def close(self):
+        with self.__lock:
+            self.__db.close()
+
+
+    def __get_meta(self, key):
+        row = self.__db.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0]   if row is not None   else None
+
+    def __set_meta(self, key, value):
+        self.__db.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, value))
+
+
+    @property
+    def tip_rev(self):
+        """The highest revision number in the index, or -1 if it is empty"""
+        with self.__lock:
+            row = self.__db.execute('SELECT MAX(rev) FROM revisions').fetchone()
+            return row[0]   if row[0] is not None   else -1
+
+    @property
+    def tip_node(self):
+        with self.__lock:
+            row = self.__db.execute('SELECT node FROM revisions ORDER BY rev DESC LIMIT 1').fetchone()
+            return row[0]   if row is not None   else None
+
+
+    def __len__(self):
+        with self.__lock:
+            return self.__db.execute('SELECT COUNT(*) FROM revisions').fetchone()[0]
+
+
+    @staticmethod
+    def __revision_from_row(row):
+        node, rev, author, branch, parents, date, tags, desc = row
+        return Revision(node, rev, author, branch, [int(p)   for p in parents.split()], date, tags, desc)
+
+    __columns = 'node, rev, author, branch, parents, date, tags, desc'
+
+
+    def get_by_rev(self, rev_number):
+        with self.__lock:
+            row = self.__db.execute('SELECT {0} FROM revisions WHERE rev = ?'.format(self.__columns), (rev_number,)).fetchone()
+            return RevisionIndex.__revision_from_row(row)   if row is not None   else None
+
+    def get_by_node(self, node):
+        with self.__lock:
+            row = self.__db.execute('SELECT {0} FROM revisions WHERE node = ?'.format(self.__columns), (node,)).fetchone()
+            return RevisionIndex.__revision_from_row(row)   if row is not None   else None
+
+    def get_range(self, start, stop):
+        """Get the Revisions numbered start to stop inclusive, or None if any are missing"""
+        with self.__lock:
+            rows = self.__db.execute('SELECT {0} FROM revisions WHERE rev BETWEEN ? AND ? ORDER BY rev'.format(self.__columns),
+                                     (start, stop)).fetchall()
+            if len(rows) != stop - start + 1:
+                return None
+            return [RevisionIndex.__revision_from_row(row)   for row in rows]
+
+    def get_many(self, rev_numbers):
+        """Get the Revisions with the given numbers, in the same order, or None if any are missing"""
+        with self.__lock:
+            rev_numbers = list(rev_numbers)
+            by_rev = {}
+            # Stay well below SQLite's limit on the number of host parameters
+            for i in range(0, len(rev_numbers), 500):
+                chunk = rev_numbers[i:i+500]
+                query = 'SELECT {0} FROM revisions WHERE rev IN ({1})'.format(self.__columns, ', '.join(['?'] * len(chunk)))
+                for row in self.__db.execute(query, chunk):
+                    by_rev[row[1]] = RevisionIndex.__revision_from_row(row)
+            if len(by_rev) != len(set(rev_numbers)):
+                return None
+            return [by_rev[r]   for r in rev_numbers]
+
+
+    def add(self, revisions):
+        """Add (or replace) revisions"""
+        with self.__lock:
+            self.__db.executemany('INSERT OR REPLACE INTO revisions (rev, node, author, branch, parents, date, tags, desc) '
+                                  'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                                  [(r.rev, r.node, r.author, r.branch, ' '.join([str(p)   for p in r.parents]), r.date, r.tags, r.desc)
+                                   for r in revisions])
+            self.__db.commit()
+
+
+    def set_tags(self, tags_by_rev):
+        """Replace the tags of all revisions; tags_by_rev maps revision number to tags string for tagged revisions"""
+        with self.__lock:
+            self.__db.execute("UPDATE revisions SET tags = '' WHERE tags != ''")
+            self.__db.executemany('UPDATE revisions SET tags = ? WHERE rev = ?', [(tags, rev)   for rev, tags in tags_by_rev.items()])
+            self.__db.commit()
+
+
+    def reset(self):
+        """Remove all revisions; use when history has been rewritten"""
+        with self.__lock:
+            self.__db.execute('DELETE FROM revisions')
+            self.__db.commit()
@@ -6,6 +6,8 @@ class Revision(object):
 
     A Revision object is equal to any other object with the same value for node
     """
+    __slots__ = ('node', 'rev', 'author', 'branch', 'parents', 'date', 'tags', 'desc')
+
     def __init__(self, node, rev, author, branch, parents, date, tags, desc):
         self.node = node
         self.rev = rev
@@ -44,3 +46,73 @@ class Revision(object):
 
 
 
+class RevisionBatch (object):
+    """The LazyRevision objects produced by a single query, whose remaining fields are loaded together.
+
+    load_fields is a function that takes rev_identifier (that of the query) and a list of LazyRevision objects, and
+    returns a dictionary mapping their nodes to (author, date, tags, desc) tuples"""
+    def __init__(self, load_fields, rev_identifier):
+        self.__load_fields = load_fields
+        self.rev_identifier = rev_identifier
+        self.revisions = []
+
+
+    def load(self):
+        """Load the remaining fields of every revision in the batch that does not yet have them"""
+        pending = [r   for r in self.revisions   if not r.is_loaded]
+        if len(pending) > 0:
+            fields_by_node = self.__load_fields(self.rev_identifier, pending)
+            for r in pending:
+                r._set_fields(*fields_by_node[r.node])
+        self.revisions = []
+
+
+
+
+def _lazy_field(name):
+    slot = getattr(Revision, name)
+
+    def fget(self):
+        try:
+            return slot.__get__(self, type(self))
+        except AttributeError:
+            # Not loaded yet
+            self._batch.load()
+            return slot.__get__(self, type(self))
+
+    def fset(self, value):
+        slot.__set__(self, value)
+
+    return property(fget, fset)
+
+
+class LazyRevision (Revision):
+    """A Revision whose author, date, tags and desc are only fetched from hg when one of them is first accessed.
+    At that point, they are fetched for all the revisions of the same RevisionBatch in one go."""
+    __slots__ = ('_batch',)
+
+    author = _lazy_field('author')
+    date = _lazy_field('date')
+    tags = _lazy_field('tags')
+    desc = _lazy_field('desc')
+
+    def __init__(self, node, rev, branch, parents, batch):
+        self.node = node
+        self.rev = rev
+        self.branch = branch
+        self.parents = parents
+        self._batch = batch
+        batch.revisions.append(self)
+
+
+    @property
+    def is_loaded(self):
+        return self._batch is None
+
+
+    def _set_fields(self, author, date, tags, desc):
+        self.author = author
+        self.date = date
+        self.tags = tags
+        self.desc = desc
+        self._batch = None
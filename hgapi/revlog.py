@@ -0,0 +1,492 @@
+import binascii
+import codecs
+import errno
+import os
+import struct
+import zlib
+
+try:
+    import mmap
+except ImportError:
+    mmap = None
+
+try:
+    import zstandard
+except ImportError:
+    try:
+        # Mercurial bundles a copy of python-zstandard
+        from mercurial import zstd as zstandard
+    except ImportError:
+        zstandard = None
+
+try:
+    from .revision import Revision
+    from .revtable import isodate
+except (ImportError, ValueError): #not imported as part of the package
+    from revision import Revision
+    from revtable import isodate
+
+
+
+
+_INDEX_ENTRY = struct.Struct(str('>Qiiiiii20s12x'))
+_VERSION_HEADER = struct.Struct(str('>I'))
+_DELTA_HUNK = struct.Struct(str('>lll'))
+
+_REVLOGV1 = 1
+_FLAG_INLINE_DATA = 1 << 16
+_FLAG_GENERALDELTA = 1 << 17
+_KNOWN_FLAGS = _FLAG_INLINE_DATA | _FLAG_GENERALDELTA
+
+
+# Repository requirements that do not affect how the changelog is stored
+SUPPORTED_REQUIREMENTS = frozenset(['revlogv1', 'store', 'fncache', 'dotencode', 'generaldelta', 'sparserevlog',
+                                    'treemanifest', 'largefiles', 'lfs', 'share-safe'])
+
+# True if zstd compressed revlogs (the default for hg installed with pip) can be read; if not, repositories
+# with the revlog-compression-zstd requirement are not supported
+ZSTD_AVAILABLE = zstandard is not None
+
+
+def supported_requirements():
+    if zstandard is not None:
+        return SUPPORTED_REQUIREMENTS | frozenset(['revlog-compression-zstd'])
+    return SUPPORTED_REQUIREMENTS
+
+
+
+
+class RevlogError (Exception):
+    pass
+
+class RevlogUnsupportedError (RevlogError):
+    pass
+
+
+
+
+def _file_signature(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_ino, st.st_size, st.st_mtime)
+
+
+def _map_file(path):
+    """The contents of a file, memory mapped where possible (not on Windows, where mapped files cannot be truncated,
+    which would prevent hg from stripping)"""
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if mmap is not None  and  os.name != 'nt'  and  size > 0:
+            return mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+        return f.read()
+
+
+def _map_index(path):
+    """As _map_file, but a missing file (as in a new repository, before the first commit) reads as empty"""
+    try:
+        return _map_file(path)
+    except (IOError, OSError) as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return b''
+
+
+def _close_mapped(f):
+    if mmap is not None  and  isinstance(f, mmap.mmap):
+        f.close()
+
+
+def _decompress(chunk):
+    if len(chunk) == 0:
+        return chunk
+    t = chunk[0:1]
+    if t == b'x':
+        return zlib.decompress(chunk)
+    elif t == b'\0':
+        return chunk
+    elif t == b'u':
+        return chunk[1:]
+    elif t == b'(':
+        if zstandard is None:
+            raise RevlogUnsupportedError('zstd compressed revlog chunks require the zstandard module')
+        return zstandard.ZstdDecompressor().decompressobj().decompress(chunk)
+    raise RevlogError('Unknown revlog compression type {0!r}'.format(t))
+
+
+def apply_delta(text, delta):
+    """Apply a binary delta (as produced by Mercurial's bdiff) to text"""
+    pieces = []
+    last = 0
+    pos = 0
+    while pos < len(delta):
+        start, end, length = _DELTA_HUNK.unpack_from(delta, pos)
+        pos += _DELTA_HUNK.size
+        pieces.append(text[last:start])
+        pieces.append(delta[pos:pos + length])
+        pos += length
+        last = end
+    pieces.append(text[last:])
+    return b''.join(pieces)
+
+
+
+
+class Revlog (object):
+    """A read-only view of a version 1 (RevlogNG) revlog, with inline or separate data, with or without generaldelta.
+
+    The index is memory mapped where possible. Call refresh() to pick up revisions appended since it was opened;
+    if the revlog has been truncated (e.g. by a strip), it is reopened. A missing index file reads as an empty revlog.
+    """
+    def __init__(self, index_path, data_path=None):
+        self.index_path = index_path
+        self.data_path = data_path   if data_path is not None   else index_path[:-2] + '.d'
+        self.__node_to_rev = None
+        self.__load()
+
+
+    def __load(self):
+        self.__signature = _file_signature(self.index_path)
+        self.__index = _map_index(self.index_path)
+        self.__data = None
+        self.__data_signature = None
+        self.__offsets = []
+        self.__node_to_rev = None
+        if len(self.__index) > 0:
+            header = _VERSION_HEADER.unpack_from(self.__index, 0)[0]
+            version, flags = header & 0xFFFF, header & ~0xFFFF
+            if version != _REVLOGV1  or  flags & ~_KNOWN_FLAGS:
+                raise RevlogUnsupportedError('Unsupported revlog format {0:#x} in {1}'.format(header, self.index_path))
+            self.inline = bool(flags & _FLAG_INLINE_DATA)
+            self.generaldelta = bool(flags & _FLAG_GENERALDELTA)
+        else:
+            self.inline = False
+            self.generaldelta = False
+        self.__scan_offsets(0)
+
+
+    def __scan_offsets(self, position):
+        """Find the positions of the index entries from position onwards; with inline data, each entry is followed by its data"""
+        index = self.__index
+        n = len(index)
+        size = _INDEX_ENTRY.size
+        offsets = self.__offsets
+        if self.inline:
+            while position + size <= n:
+                offsets.append(position)
+                compressed_length = _INDEX_ENTRY.unpack_from(index, position)[1]
+                position += size + compressed_length
+        else:
+            offsets.extend(range(position, n - n % size, size))
+        self.__end = position   if self.inline   else n - n % size
+
+
+    def refresh(self):
+        """Pick up changes made to the revlog since it was opened; returns True if there were any"""
+        signature = _file_signature(self.index_path)
+        if signature == self.__signature:
+            return False
+        old_count = len(self.__offsets)
+        old_end = self.__end
+        old_last_node = self.node_bytes(old_count - 1)   if old_count > 0   else None
+        old_inline = self.inline
+        _close_mapped(self.__index)
+        self.__signature = signature
+        self.__index = _map_index(self.index_path)
+        if old_count > 0  and  len(self.__index) >= old_end  and  old_inline == bool(_VERSION_HEADER.unpack_from(self.__index, 0)[0] & _FLAG_INLINE_DATA)  and\
+                self.node_bytes(old_count - 1) == old_last_node:
+            # Appended to
+            self.__scan_offsets(old_end)
+            if self.__node_to_rev is not None:
+                for rev in range(old_count, len(self.__offsets)):
+                    self.__node_to_rev[self.node_bytes(rev)] = rev
+            _close_mapped(self.__data)
+            self.__data = None
+        else:
+            _close_mapped(self.__data)
+            self.__load()
+        return True
+
+
+    def __len__(self):
+        return len(self.__offsets)
+
+
+    def entry(self, rev):
+        """The index entry for rev: a tuple (offset, flags, compressed_length, uncompressed_length, base_rev, link_rev, p1, p2, node)
+        where node is binary"""
+        offset_flags, compressed_length, uncompressed_length, base_rev, link_rev, p1, p2, node = _INDEX_ENTRY.unpack_from(self.__index, self.__offsets[rev])
+        if rev == 0:
+            # The first four bytes of the first entry hold the version header instead; its offset is always 0
+            offset_flags &= 0xFFFF
+        return offset_flags >> 16, offset_flags & 0xFFFF, compressed_length, uncompressed_length, base_rev, link_rev, p1, p2, node
+
+
+    def node_bytes(self, rev):
+        pos = self.__offsets[rev] + 32
+        return bytes(self.__index[pos:pos + 20])
+
+
+    def node(self, rev):
+        return binascii.hexlify(self.node_bytes(rev)).decode('ascii')
+
+
+    def parents(self, rev):
+        e = self.entry(rev)
+        return e[6], e[7]
+
+
+    def rev(self, node):
+        """The revision number of a (hex) node, or None"""
+        if self.__node_to_rev is None:
+            self.__node_to_rev = {self.node_bytes(r): r   for r in range(len(self))}
+        return self.__node_to_rev.get(binascii.unhexlify(node))
+
+
+    def __chunk(self, rev):
+        offset, flags, compressed_length = self.entry(rev)[:3]
+        if self.inline:
+            start = self.__offsets[rev] + _INDEX_ENTRY.size
+            data = self.__index
+        else:
+            start = offset
+            signature = _file_signature(self.data_path)
+            if self.__data is None  or  signature != self.__data_signature:
+                self.__data = _map_file(self.data_path)
+                self.__data_signature = signature
+            data = self.__data
+        return _decompress(bytes(data[start:start + compressed_length]))
+
+
+    def __delta_chain(self, rev):
+        chain = []
+        while True:
+            e = self.entry(rev)
+            if e[1] != 0:
+                raise RevlogUnsupportedError('Revision {0} of {1} has unsupported flags {2:#x}'.format(rev, self.index_path, e[1]))
+            chain.append(rev)
+            base = e[4]
+            if base == rev  or  base == -1:
+                break
+            rev = base   if self.generaldelta   else rev - 1
+        chain.reverse()
+        return chain
+
+
+    def revision(self, rev):
+        """The full text of rev, as bytes"""
+        chain = self.__delta_chain(rev)
+        text = self.__chunk(chain[0])
+        for r in chain[1:]:
+            text = apply_delta(text, self.__chunk(r))
+        return text
+
+
+    def close(self):
+        _close_mapped(self.__index)
+        _close_mapped(self.__data)
+        self.__index = b''
+        self.__data = None
+
+
+
+
+def _unescape_extra(text):
+    if b'\\0' in text:
+        # Escaped NULs; protect escaped backslashes first
+        text = text.replace(b'\\\\', b'\\\\\n').replace(b'\\0', b'\0').replace(b'\n', b'')
+    return codecs.escape_decode(text)[0]
+
+
+def parse_changelog_entry(text):
+    """Parse the text of a changelog revision. Returns a tuple (manifest, user, timestamp, tz_offset, extra, files, desc)
+    where extra is a dictionary and text fields are unicode strings"""
+    if len(text) == 0:
+        return '0' * 40, '', 0.0, 0, {}, [], ''
+    header, sep, desc = text.partition(b'\n\n')
+    lines = header.split(b'\n')
+    manifest = lines[0].decode('ascii')
+    user = lines[1].decode('utf-8', 'replace')
+    date_parts = lines[2].split(b' ', 2)
+    timestamp, tz_offset = float(date_parts[0]), int(date_parts[1])
+    extra = {}
+    if len(date_parts) > 2:
+        for item in _unescape_extra(date_parts[2]).split(b'\0'):
+            k, ign, v = item.partition(b':')
+            extra[k.decode('utf-8', 'replace')] = v.decode('utf-8', 'replace')
+    files = [f.decode('utf-8', 'replace')   for f in lines[3:]]
+    # hg's {desc} strips the description, which may begin or end with whitespace when committed with -l
+    return manifest, user, timestamp, tz_offset, extra, files, desc.strip().decode('utf-8', 'replace')
+
+
+
+
+def _read_requirements_file(path):
+    try:
+        with open(path, 'rb') as f:
+            return set([line.strip().decode('ascii')   for line in f.read().split(b'\n')   if line.strip()])
+    except IOError:
+        return set()
+
+
+def read_requirements(hg_dir):
+    """The requirements of the repository whose .hg directory is hg_dir. In share-safe repositories (the default
+    since hg 5.7), .hg/requires only lists the working copy requirements; the rest are in .hg/store/requires"""
+    requirements = _read_requirements_file(os.path.join(hg_dir, 'requires'))
+    if 'share-safe' in requirements:
+        requirements |= _read_requirements_file(os.path.join(hg_dir, 'store', 'requires'))
+    return requirements
+
+
+class ChangelogReader (object):
+    """Reads a repository's changelog directly from .hg/store/00changelog.i (and .d), producing the same Revision objects
+    as hg log would.
+
+    Raises RevlogUnsupportedError if the repository has requirements that the reader does not support, or has an
+    obsolescence store (obsolete changesets are hidden by hg, which would change revision visibility).
+
+    Tags are read from hg's tags cache (.hg/cache/tags2-visible) and .hg/localtags; tags_by_node() returns None if
+    the cache is missing or out of date, in which case the tags must be obtained from hg.
+    """
+    def __init__(self, repo_path):
+        self.repo_path = repo_path
+        self.__hg_dir = os.path.join(repo_path, '.hg')
+        unsupported = read_requirements(self.__hg_dir) - supported_requirements()
+        if unsupported:
+            raise RevlogUnsupportedError('Unsupported repository requirements: {0}'.format(', '.join(sorted(unsupported))))
+        store = os.path.join(self.__hg_dir, 'store')
+        if not os.path.isdir(store):
+            raise RevlogUnsupportedError('Repositories without a store are not supported')
+        self.__store = store
+        self.__check_obsstore()
+        self.changelog = Revlog(os.path.join(store, '00changelog.i'))
+        self.__heads_key = None
+        self.__heads = None
+        # Per rev, extended as the changelog grows; see __extend_branch_data
+        self.__branches = []
+        self.__branch_names = {}
+        self.__closing = []
+        self.__head_revs = set()
+        self.__last_known_node = None
+
+
+    def __check_obsstore(self):
+        obsstore = os.path.join(self.__store, 'obsstore')
+        if os.path.exists(obsstore)  and  os.path.getsize(obsstore) > 0:
+            raise RevlogUnsupportedError('Repositories with obsolescence markers are not supported')
+
+
+    def refresh(self):
+        """Pick up changes to the changelog; raises RevlogUnsupportedError if the repository has gained obsolescence markers"""
+        self.__check_obsstore()
+        self.changelog.refresh()
+
+
+    @property
+    def tip_rev(self):
+        return len(self.changelog) - 1
+
+
+    def tip_node(self):
+        return self.changelog.node(self.tip_rev)   if len(self.changelog) > 0   else '0' * 40
+
+
+    def rev(self, node):
+        return self.changelog.rev(node)
+
+
+    def node(self, rev):
+        return self.changelog.node(rev)
+
+
+    def entry(self, rev):
+        """The parsed changelog entry of rev; see parse_changelog_entry"""
+        return parse_changelog_entry(self.changelog.revision(rev))
+
+
+    def revision(self, rev, tags_by_node):
+        """Create a Revision object for rev; tags_by_node maps nodes to sorted lists of tag names"""
+        manifest, user, timestamp, tz_offset, extra, files, desc = self.entry(rev)
+        node = self.changelog.node(rev)
+        p1, p2 = self.changelog.parents(rev)
+        parents = [p1]   if p2 == -1   else [p1, p2]
+        return Revision(node, rev, user, extra.get('branch', 'default'), parents, isodate(timestamp, tz_offset),
+                        ' '.join(tags_by_node.get(node, [])), desc)
+
+
+    def tags_by_node(self):
+        """Map nodes to the sorted lists of their tag names (including 'tip'), or None if hg's tags cache is not valid"""
+        tip_rev = self.tip_rev
+        tip_node = self.tip_node()
+        tags = {}
+        if tip_rev >= 0:
+            try:
+                with open(os.path.join(self.__hg_dir, 'cache', 'tags2-visible'), 'rb') as f:
+                    lines = f.read().decode('utf-8', 'replace').split('\n')
+            except IOError:
+                return None
+            header = lines[0].split()
+            if len(header) != 2  or  header[0] != str(tip_rev)  or  header[1] != tip_node:
+                # Stale, or made with filtered revisions
+                return None
+            # A tag's history is listed before its current node
+            for line in lines[1:]:
+                if line.strip():
+                    node, ign, name = line.partition(' ')
+                    tags[name.strip()] = node
+        try:
+            with open(os.path.join(self.__hg_dir, 'localtags'), 'rb') as f:
+                for line in f.read().decode('utf-8', 'replace').split('\n'):
+                    if line.strip():
+                        node, ign, name = line.partition(' ')
+                        tags[name.strip()] = node
+        except IOError:
+            pass
+        tags['tip'] = tip_node
+        by_node = {}
+        for name, node in tags.items():
+            if node != '0' * 40  and  self.changelog.rev(node) is not None:
+                by_node.setdefault(node, []).append(name)
+        for names in by_node.values():
+            names.sort()
+        return by_node
+
+
+    def __extend_branch_data(self):
+        """Bring the branch name, closing flag and head status of each rev up to date with the changelog,
+        reading only the entries that were added since the last call"""
+        n = len(self.changelog)
+        known = len(self.__branches)
+        if known > n  or  (known > 0  and  self.changelog.node(known - 1) != self.__last_known_node):
+            # The changelog was stripped or rewritten
+            self.__branches = []
+            self.__closing = []
+            self.__head_revs = set()
+            known = 0
+        for rev in range(known, n):
+            extra = self.entry(rev)[4]
+            branch = extra.get('branch', 'default')
+            self.__branches.append(self.__branch_names.setdefault(branch, branch))
+            self.__closing.append('close' in extra)
+            self.__head_revs.add(rev)
+            for p in self.changelog.parents(rev):
+                if p >= 0  and  self.__branches[p] == branch:
+                    self.__head_revs.discard(p)
+        if n > 0:
+            self.__last_known_node = self.changelog.node(n - 1)
+
+
+    def heads(self, closed=False):
+        """The nodes of the branch heads, most recent first, as listed by hg heads"""
+        key = (self.tip_rev, self.tip_node(), closed)
+        if key != self.__heads_key:
+            self.__extend_branch_data()
+            self.__heads = [self.changelog.node(rev)   for rev in sorted(self.__head_revs, reverse=True)
+                            if closed  or  not self.__closing[rev]]
+            self.__heads_key = key
+        return list(self.__heads)
+
+
+    def close(self):
+        self.changelog.close()
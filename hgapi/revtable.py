@@ -0,0 +1,253 @@
+import binascii
+import calendar
+import time
+from array import array
+from datetime import datetime
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    from .revision import Revision
+except (ImportError, ValueError): #not imported as part of the package
+    from revision import Revision
+
+
+
+
+def isodate(timestamp, tz_offset):
+    """Format a date in the same way as hg's isodate filter.
+    tz_offset is in seconds west of UTC, as in hg's internal date representation"""
+    t = time.gmtime(timestamp - tz_offset)
+    sign = '-'   if tz_offset > 0   else '+'
+    hours, minutes = divmod(abs(tz_offset) // 60, 60)
+    return '{0} {1}{2:02d}{3:02d}'.format(time.strftime('%Y-%m-%d %H:%M', t), sign, hours, minutes)
+
+
+def _to_timestamp(d):
+    """Convert a datetime (naive datetimes are taken to be UTC) or a number of seconds since the epoch to a float"""
+    if isinstance(d, datetime):
+        return float(calendar.timegm(d.utctimetuple()))
+    return float(d)
+
+
+
+
+class _DictionaryColumn (object):
+    """A column of strings stored as integer codes into a list of distinct values"""
+    def __init__(self):
+        self.values = []
+        self.codes = array(str('i'))
+        self.__code_by_value = {}
+
+
+    def append(self, value):
+        code = self.__code_by_value.get(value)
+        if code is None:
+            code = len(self.values)
+            self.values.append(value)
+            self.__code_by_value[value] = code
+        self.codes.append(code)
+
+
+    def code_of(self, value):
+        return self.__code_by_value.get(value)
+
+
+    def __getitem__(self, i):
+        return self.values[self.codes[i]]
+
+
+
+
+class _TextColumn (object):
+    """A column of mostly distinct strings, stored as UTF-8 in a single buffer rather than as one object each"""
+    def __init__(self):
+        self.__data = bytearray()
+        self.__ends = array(str('L'))
+
+
+    def append(self, value):
+        self.__data.extend(value.encode('utf-8'))
+        self.__ends.append(len(self.__data))
+
+
+    def __getitem__(self, i):
+        start = self.__ends[i - 1]   if i > 0   else 0
+        return bytes(self.__data[start:self.__ends[i]]).decode('utf-8')
+
+
+
+
+class RevisionTable (object):
+    """A compact, column-oriented table of revisions, for analysing large histories in bulk.
+
+    Revision numbers, parent revision numbers and dates are stored in arrays; authors and branches are
+    dictionary-encoded, descriptions are stored in a single buffer, and nodes are stored in binary. Rows are only
+    materialized as Revision objects when requested, by indexing or iterating.
+
+    Available columns are::
+
+      revs, p1, p2 - arrays of revision numbers (-1 for no parent)
+      p1_rows, p2_rows - arrays of the row indices of the parents, or -1 if they are not in the table
+      timestamps, tz_offsets - arrays of seconds since the epoch (UTC) and of seconds west of UTC
+      authors, branches - lists of the distinct values of each
+    """
+    def __init__(self):
+        self.revs = array(str('i'))
+        self.p1 = array(str('i'))
+        self.p2 = array(str('i'))
+        self.timestamps = array(str('d'))
+        self.tz_offsets = array(str('i'))
+        self.__nodes = bytearray()
+        self.__authors = _DictionaryColumn()
+        self.__branches = _DictionaryColumn()
+        self.__descs = _TextColumn()
+        # Few revisions are tagged
+        self.__tags_by_row = {}
+        # Row index of each revision number, or -1; rows may be in any order, and need not cover every revision
+        self.__row_by_rev = array(str('i'))
+
+
+    @property
+    def authors(self):
+        return list(self.__authors.values)
+
+    @property
+    def branches(self):
+        return list(self.__branches.values)
+
+
+    def __len__(self):
+        return len(self.revs)
+
+
+    def append(self, node, rev, author, branch, p1, p2, timestamp, tz_offset, tags, desc):
+        """Append a row; node is a hex string"""
+        row = len(self.revs)
+        self.revs.append(rev)
+        self.p1.append(p1)
+        self.p2.append(p2)
+        self.timestamps.append(timestamp)
+        self.tz_offsets.append(tz_offset)
+        self.__nodes.extend(binascii.unhexlify(node))
+        self.__authors.append(author)
+        self.__branches.append(branch)
+        self.__descs.append(desc)
+        if tags:
+            self.__tags_by_row[row] = tags
+        if rev >= len(self.__row_by_rev):
+            self.__row_by_rev.extend([-1] * (rev + 1 - len(self.__row_by_rev)))
+        self.__row_by_rev[rev] = row
+
+
+    @property
+    def p1_rows(self):
+        """An array of the row indices of the first parents, or -1 where they are not in the table"""
+        return array(str('i'), [self.__row_of_rev(p)   for p in self.p1])
+
+    @property
+    def p2_rows(self):
+        """An array of the row indices of the second parents, or -1 where they are not in the table"""
+        return array(str('i'), [self.__row_of_rev(p)   for p in self.p2])
+
+
+    def __row_of_rev(self, rev):
+        return self.__row_by_rev[rev]   if 0 <= rev < len(self.__row_by_rev)   else -1
+
+    def row_of_rev(self, rev):
+        """Get the row index of the revision numbered rev, or None"""
+        row = self.__row_of_rev(rev)
+        return row   if row >= 0   else None
+
+
+    def node(self, row):
+        return binascii.hexlify(bytes(self.__nodes[row*20:row*20+20])).decode('ascii')
+
+    def author(self, row):
+        return self.__authors[row]
+
+    def branch(self, row):
+        return self.__branches[row]
+
+    def desc(self, row):
+        return self.__descs[row]
+
+    def tags(self, row):
+        return self.__tags_by_row.get(row, '')
+
+    def date(self, row):
+        """The date of a row, in the same form as Revision.date"""
+        return isodate(self.timestamps[row], self.tz_offsets[row])
+
+
+    def __getitem__(self, row):
+        """Materialize a row as a Revision object"""
+        if row < 0:
+            row += len(self)
+        if row < 0  or  row >= len(self):
+            raise IndexError('RevisionTable row index out of range')
+        p2 = self.p2[row]
+        parents = [self.p1[row]]   if p2 == -1   else [self.p1[row], p2]
+        return Revision(self.node(row), self.revs[row], self.author(row), self.branch(row), parents, self.date(row),
+                        self.tags(row), self.desc(row))
+
+
+    def __iter__(self):
+        for row in range(len(self)):
+            yield self[row]
+
+
+    def filter_rows(self, date_from=None, date_to=None, branch=None, author=None):
+        """Get the indices of the rows that match all of the given criteria, in ascending order.
+
+        date_from, date_to - inclusive bounds, as datetimes (naive datetimes are taken to be UTC) or seconds since the epoch
+        branch, author - exact values to match
+        """
+        n = len(self)
+        if n == 0:
+            return []
+        branch_code = self.__branches.code_of(branch)   if branch is not None   else None
+        author_code = self.__authors.code_of(author)   if author is not None   else None
+        if (branch is not None  and  branch_code is None)  or  (author is not None  and  author_code is None):
+            return []
+        t_from = _to_timestamp(date_from)   if date_from is not None   else None
+        t_to = _to_timestamp(date_to)   if date_to is not None   else None
+
+        if numpy is not None:
+            mask = numpy.ones(n, dtype=bool)
+            if t_from is not None  or  t_to is not None:
+                timestamps = numpy.frombuffer(self.timestamps, dtype=numpy.float64)
+                if t_from is not None:
+                    mask &= timestamps >= t_from
+                if t_to is not None:
+                    mask &= timestamps <= t_to
+            if branch_code is not None:
+                mask &= numpy.frombuffer(self.__branches.codes, dtype=numpy.intc) == branch_code
+            if author_code is not None:
+                mask &= numpy.frombuffer(self.__authors.codes, dtype=numpy.intc) == author_code
+            return [int(i)   for i in numpy.nonzero(mask)[0]]
+        else:
+            timestamps = self.timestamps
+            branch_codes = self.__branches.codes
+            author_codes = self.__authors.codes
+            return [i   for i in range(n)
+                    if (t_from is None  or  timestamps[i] >= t_from)  and  (t_to is None  or  timestamps[i] <= t_to)  and
+                       (branch_code is None  or  branch_codes[i] == branch_code)  and
+                       (author_code is None  or  author_codes[i] == author_code)]
+
+
+    def take(self, rows):
+        """Create a new RevisionTable containing the given rows"""
+        t = RevisionTable()
+        for row in rows:
+            t.append(self.node(row), self.revs[row], self.author(row), self.branch(row), self.p1[row], self.p2[row],
+                     self.timestamps[row], self.tz_offsets[row], self.tags(row), self.desc(row))
+        return t
+
+
+    def filter(self, date_from=None, date_to=None, branch=None, author=None):
+        """Create a new RevisionTable containing the rows that match all of the given criteria; see filter_rows"""
+        return self.take(self.filter_rows(date_from=date_from, date_to=date_to, branch=branch, author=author))
@@ -0,0 +1,81 @@
+import hashlib
+import os
+import shutil
+import stat
+import tempfile
+import threading
+from subprocess import Popen, PIPE
+
+
+
+
+class SSHSessionManager (object):
+    """Shares SSH connections between the hg commands that use them, with OpenSSH's connection multiplexing.
+
+    The first command to connect to a host as a given user with a given key starts a master connection, which
+    later commands reuse, skipping the TCP connection and key exchange. Masters stay up for persist seconds after
+    their last use, or until close() is called. Their sockets are kept in control_dir, a new private directory
+    unless given.
+
+    ssh_executable is the ssh command to run; it must accept OpenSSH's options.
+    """
+    def __init__(self, control_dir=None, persist=60, ssh_executable='ssh'):
+        if control_dir is None:
+            # Kept short; socket paths are limited to around 100 bytes
+            control_dir = tempfile.mkdtemp(prefix='hgssh')
+            self.__owns_control_dir = True
+        else:
+            if not os.path.isdir(control_dir):
+                os.makedirs(control_dir)
+            self.__owns_control_dir = False
+        self.control_dir = control_dir
+        self.persist = persist
+        self.ssh_executable = ssh_executable
+        self.__lock = threading.Lock()
+        self.__closed = False
+
+
+    def control_path(self, ssh_key_path):
+        """The ControlPath pattern of the master sockets for connections made with ssh_key_path; ssh expands
+        the user, host and port, so there is one master per host, user and key"""
+        key_hash = hashlib.sha1(os.path.realpath(ssh_key_path).encode('utf-8')).hexdigest()[:8]   if ssh_key_path   else 'nokey'
+        return os.path.join(self.control_dir, '{0}-%r@%h:%p'.format(key_hash))
+
+
+    def ssh_options(self, ssh_key_path):
+        """The options to pass to ssh to share connections made with ssh_key_path, as a string for ui.ssh"""
+        if self.__closed:
+            raise ValueError('SSH session manager is closed')
+        return '-o ControlMaster=auto -o "ControlPath={0}" -o ControlPersist={1}'.format(self.control_path(ssh_key_path),
+                                                                                       int(self.persist))
+
+
+    def sockets(self):
+        """The paths of the master sockets that are currently open"""
+        try:
+            names = os.listdir(self.control_dir)
+        except OSError:
+            return []
+        paths = [os.path.join(self.control_dir, n)   for n in sorted(names)]
+        return [p   for p in paths   if stat.S_ISSOCK(os.lstat(p).st_mode)]
+
+
+    def close(self):
+        """Shut down the master connections, and remove the control directory if it was created by the manager"""
+        with self.__lock:
+            if self.__closed:
+                return
+            self.__closed = True
+        for socket_path in self.sockets():
+            # The host is required, but unused when talking to the master
+            Popen([self.ssh_executable, '-o', 'ControlPath={0}'.format(socket_path), '-O', 'exit', 'localhost'],
+                  stdout=PIPE, stderr=PIPE).communicate()
+        if self.__owns_control_dir:
+            shutil.rmtree(self.control_dir, ignore_errors=True)
+
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
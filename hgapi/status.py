@@ -15,6 +15,10 @@ class Status (object):
         self.missing = set(missing)   if missing is not None   else set()
 
 
+    def copy(self):
+        return Status(self.added, self.modified, self.removed, self.untracked, self.missing)
+
+
     def has_any_changes(self):
         return len(self.added) > 0  or  len(self.modified) > 0  or  len(self.removed) > 0  or\
                len(self.untracked) > 0  or  len(self.missing)  >  0
@@ -0,0 +1,190 @@
+import os
+import stat
+import struct
+import threading
+
+try:
+    from . import dirstate
+except (ImportError, ValueError): #not imported as part of the package
+    import dirstate
+
+
+
+
+def _stat_signature(path):
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return None
+    return (st.st_ino, st.st_size, st.st_mtime)
+
+
+def _add_with_ancestors(directories, filename):
+    d = os.path.dirname(filename.replace('\\', '/'))
+    while d not in directories:
+        directories.add(d)
+        d = os.path.dirname(d)
+
+
+def watched_directories(tracked, untracked):
+    """The directories (relative to the root of the working copy, with '' for the root itself) that hold the given
+    tracked and untracked files, along with their ancestors. Directories holding only ignored files are left out."""
+    directories = set([''])
+    for filename in tracked:
+        _add_with_ancestors(directories, filename)
+    for filename in untracked:
+        _add_with_ancestors(directories, filename)
+    return directories
+
+
+def _subtree_signature(top):
+    """The modification times of the directories below top, found without stat-ing any files; a file created anywhere
+    in the subtree changes the modification time of its directory"""
+    mtimes = []
+    for dir_path, dir_names, file_names in os.walk(top):
+        for d in dir_names:
+            try:
+                mtimes.append((os.path.relpath(os.path.join(dir_path, d), top), os.lstat(os.path.join(dir_path, d)).st_mtime))
+            except OSError:
+                continue
+    return tuple(sorted(mtimes))
+
+
+def _directory_signature(repo_path, directory, watched):
+    dir_path = os.path.join(repo_path, directory)
+    try:
+        names = os.listdir(dir_path)
+        st = os.lstat(dir_path)
+    except OSError:
+        return (directory, None)
+    entries = []
+    for name in sorted(names):
+        if directory == ''  and  name == '.hg':
+            continue
+        try:
+            st_entry = os.lstat(os.path.join(dir_path, name))
+        except OSError:
+            # Deleted while listing; the directory's modification time will reflect that
+            continue
+        entry = (name, st_entry.st_size, st_entry.st_mtime)
+        if watched is not None  and  stat.S_ISDIR(st_entry.st_mode):
+            child = directory + '/' + name   if directory   else name
+            if child not in watched:
+                # Not watched, as it only holds ignored files; a new file further down might not be ignored
+                entry += (_subtree_signature(os.path.join(dir_path, name)),)
+        entries.append(entry)
+    return (directory, st.st_mtime, tuple(entries))
+
+
+def working_copy_fingerprint(repo_path, directories=None):
+    """A snapshot of the stat information of a working copy; it changes whenever anything that could affect the
+    output of hg status is modified. Returns a tuple (dirstate, working_tree): the stat of .hg/dirstate, and the
+    modification time and size of each entry of the given directories (see watched_directories). The entries
+    include subdirectories, so files created in a directory that is not watched change its parent's entry; the
+    modification times of the directories nested within those that are not watched are included as well.
+    If directories is None, every file and directory of the working copy (outside .hg) is included."""
+    if directories is None:
+        # Every directory is walked, so none are left out
+        watched = None
+        directories = []
+        for dir_path, dir_names, file_names in os.walk(repo_path):
+            if dir_path == repo_path:
+                dir_names[:] = [d   for d in dir_names   if d != '.hg']
+            directories.append(os.path.relpath(dir_path, repo_path)   if dir_path != repo_path   else '')
+    else:
+        watched = set(directories)
+    tree = tuple([_directory_signature(repo_path, d, watched)   for d in sorted(directories)])
+    return _stat_signature(os.path.join(repo_path, '.hg', 'dirstate')), tree
+
+
+
+
+class StatusCache (object):
+    """Caches the results of hg status, keyed on the filenames that it was run with.
+
+    Each entry is stored along with the working copy fingerprint (see working_copy_fingerprint) taken
+    before hg was run, and is used for as long as the fingerprint stays the same. Only the directories that hold
+    tracked files (read from the dirstate) or untracked files (seen in earlier results) are fingerprinted in full;
+    within ignored trees such as build output, only the directories are stat'ed. hg status may itself rewrite the dirstate, to record that
+    files whose modification times were ambiguous are clean; if nothing else changed while it ran, the fingerprint
+    taken afterwards is stored instead. Call invalidate() to discard all entries, e.g. when the working copy is
+    known to have been modified.
+
+    Safe for use from multiple threads; hg is run without holding the lock, and a result is not stored if
+    invalidate() was called while it was being computed.
+
+    The hits and misses counters record how often hg did not and did need to be run.
+    """
+    def __init__(self, repo_path):
+        self.__repo_path = repo_path
+        self.__lock = threading.RLock()
+        self.__entries = {}
+        self.__generation = 0
+        # The untracked files seen by the last full status, and by partial ones since
+        self.__untracked = set()
+        # The directories holding tracked files, along with the dirstate signature that they were read for
+        self.__tracked_key = None
+        self.__tracked = None
+        self.hits = 0
+        self.misses = 0
+
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return float(self.hits) / total   if total > 0   else 0.0
+
+
+    def __len__(self):
+        with self.__lock:
+            return len(self.__entries)
+
+
+    def __directories(self):
+        """The directories to fingerprint, or None if the dirstate cannot be read"""
+        key = _stat_signature(os.path.join(self.__repo_path, '.hg', 'dirstate'))
+        if key != self.__tracked_key:
+            try:
+                tracked = dirstate.Dirstate(self.__repo_path).entries.keys()
+            except (dirstate.DirstateError, struct.error, ValueError, IndexError):
+                tracked = None
+            self.__tracked = watched_directories(tracked, [])   if tracked is not None   else None
+            self.__tracked_key = key
+        if self.__tracked is None:
+            return None
+        return self.__tracked | watched_directories([], self.__untracked)
+
+
+    def get(self, filenames, compute_status):
+        """Get the status for filenames (a list), calling compute_status() to run hg if there is no valid entry"""
+        key = tuple(filenames)
+        with self.__lock:
+            directories = self.__directories()
+            fingerprint = working_copy_fingerprint(self.__repo_path, directories)
+            entry = self.__entries.get(key)
+            if entry is not None  and  entry[0] == fingerprint:
+                self.hits += 1
+                # Status objects are mutable, so hand out copies
+                return entry[1].copy()
+            self.misses += 1
+            generation = self.__generation
+        status = compute_status()
+        with self.__lock:
+            if len(filenames) == 0:
+                # Untracked files that have since been deleted no longer need watching
+                self.__untracked = set(status.untracked)
+            else:
+                self.__untracked.update(status.untracked)
+            if generation == self.__generation:
+                after = working_copy_fingerprint(self.__repo_path, directories)
+                if after[1] == fingerprint[1]:
+                    # Store the fingerprint of the directories that will be watched from now on
+                    fingerprint = working_copy_fingerprint(self.__repo_path, self.__directories())
+                self.__entries[key] = (fingerprint, status)
+        return status.copy()
+
+
+    def invalidate(self):
+        with self.__lock:
+            self.__entries.clear()
+            self.__generation += 1
@@ -0,0 +1,252 @@
+import os
+import re
+import threading
+import time
+
+try:
+    from Queue import Queue
+except ImportError: #python 3
+    from queue import Queue
+
+
+
+
+_LINE_END = re.compile(b'(\n)')
+# hg redraws progress bars in place, separating them with carriage returns
+_SEGMENT_END = re.compile(b'(\r\n|\r|\n)')
+
+
+def _read_segments(stream, separator_pattern, kind, queue):
+    """Read stream until it is closed, putting (kind, segment, separator) tuples on queue; the segments are decoded.
+    Finishes by putting (kind, None, None)"""
+    try:
+        fd = stream.fileno()
+        pending = b''
+        while True:
+            chunk = os.read(fd, 65536)
+            if not chunk:
+                break
+            parts = separator_pattern.split(pending + chunk)
+            pending = parts.pop()
+            for i in range(0, len(parts), 2):
+                queue.put((kind, parts[i].decode('utf-8', 'replace'), parts[i + 1].decode('ascii')))
+        if pending:
+            queue.put((kind, pending.decode('utf-8', 'replace'), ''))
+    finally:
+        queue.put((kind, None, None))
+
+
+def read_in_background(stream):
+    """Read stream to its end on a separate thread, so that the process writing to it cannot block on a full pipe.
+    Returns a function that waits for the end of the stream and returns everything read from it, as bytes."""
+    chunks = []
+    def _read():
+        fd = stream.fileno()
+        while True:
+            chunk = os.read(fd, 65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    reader = threading.Thread(target=_read)
+    reader.daemon = True
+    reader.start()
+    def _result():
+        reader.join()
+        return b''.join(chunks)
+    return _result
+
+
+def stream_process(proc, stdout_listener=None, stderr_listener=None):
+    """Read the stdout and stderr of proc (a Popen with both piped) concurrently until both are closed, then wait
+    for it to exit. Reading both at once means that neither can fill its pipe and block the process.
+
+    stdout_listener, if not None, is called with every line of stdout, including its line ending, as it arrives.
+    stderr_listener, if not None, is called with every segment of stderr, including its ending; stderr is split at
+    carriage returns as well as line endings, so that progress bars are seen as they are redrawn. Segments for which
+    stderr_listener returns True are left out of the error output.
+    Both listeners are called from the calling thread, in the order in which the output arrives.
+
+    Returns a tuple (out, err) of text. If a listener raises, the process is killed and the exception propagates."""
+    queue = Queue()
+    readers = [threading.Thread(target=_read_segments, args=(proc.stdout, _LINE_END, 'out', queue)),
+               threading.Thread(target=_read_segments, args=(proc.stderr, _SEGMENT_END, 'err', queue))]
+    for reader in readers:
+        reader.daemon = True
+        reader.start()
+    out_parts = []
+    err_parts = []
+    open_streams = len(readers)
+    try:
+        while open_streams > 0:
+            kind, segment, separator = queue.get()
+            if segment is None:
+                open_streams -= 1
+            elif kind == 'out':
+                out_parts.append(segment + separator)
+                if stdout_listener is not None:
+                    stdout_listener(segment + separator)
+            elif stderr_listener is None  or  not stderr_listener(segment + separator):
+                err_parts.append(segment + separator)
+    except:
+        if proc.poll() is None:
+            proc.kill()
+        raise
+    finally:
+        for reader in readers:
+            reader.join()
+        proc.stdout.close()
+        proc.stderr.close()
+        proc.wait()
+    return ''.join(out_parts), ''.join(err_parts)
+
+
+
+
+# The phases of a pull or push, announced by hg's verbose output
+_PHASE_MESSAGES = [
+    (re.compile(r'^(pulling from|pushing to|comparing with) '), 'connecting'),
+    (re.compile(r'^(searching for changes|requesting all changes)$'), 'searching'),
+    (re.compile(r'^\d+ changesets found$'), 'bundling'),
+    (re.compile(r'^adding changesets$'), 'changesets'),
+    (re.compile(r'^adding manifests$'), 'manifests'),
+    (re.compile(r'^adding file changes$'), 'files'),
+    (re.compile(r'^added \d+ changesets with '), 'added'),
+    (re.compile(r'^no changes found$'), 'added'),
+]
+_FOUND_PATTERN = re.compile(r'^(\d+) changesets found$')
+_ADDED_PATTERN = re.compile(r'^added (\d+) changesets with (\d+) changes to (\d+) files')
+_BUNDLE_SIZE_HEADER = 'uncompressed size of bundle content:'
+_BUNDLE_SIZE_PATTERN = re.compile(r'^\s+(\d+)\s+\S')
+# Output of the hg at the other end of an ssh or http connection, forwarded by the local hg
+_REMOTE_PREFIX = 'remote: '
+# hg's progress bars, rendered with progress.format='topic number unit'
+_PROGRESS_BAR_PATTERN = re.compile(r'^(\S(?:.*\S)?) (\d+)(?:/(\d+))?(?: ([a-z]+))?$')
+
+# Configuration that makes hg render its progress bars on stderr in a form that TransferProgress understands
+PROGRESS_CONFIG = ['--config', 'progress.assume-tty=true', '--config', 'progress.delay=0', '--config', 'progress.refresh=0',
+                   '--config', 'progress.format=topic number unit', '--config', 'progress.width=1000']
+
+
+
+
+class TransferEvent (object):
+    """A progress update for a pull or push.
+    Available fields are:
+    phase - 'connecting', 'searching', 'bundling', 'changesets', 'manifests', 'files', 'added' or, for the final
+        event, 'done'. While hg shows a progress bar, phase is the bar's topic instead; this may be any topic that hg
+        or an extension reports, such as 'changesets', 'manifests', 'files' or 'bundling', and is None before the
+        first phase is known
+    position, total, unit - the progress within the phase, from hg's progress bar (None if unknown)
+    changesets - the number of changesets being transferred, once known (else None)
+    bytes - the uncompressed size of the data being transferred, once known (else None). hg only reports it when
+        the bundle is built locally: for pushes, and for pulls from a local path or file: URL. For pulls from an
+        ssh or http remote it is always None.
+    elapsed - the time since the transfer started, in seconds
+    throughput - bytes per second over the transfer so far; None until the size is known, so always None for
+        pulls from an ssh or http remote
+    message - the line of hg's output that caused the event, if any
+    """
+    __slots__ = ('phase', 'position', 'total', 'unit', 'changesets', 'bytes', 'elapsed', 'throughput', 'message')
+
+    def __init__(self, phase, position, total, unit, changesets, bytes, elapsed, throughput, message):
+        self.phase = phase
+        self.position = position
+        self.total = total
+        self.unit = unit
+        self.changesets = changesets
+        self.bytes = bytes
+        self.elapsed = elapsed
+        self.throughput = throughput
+        self.message = message
+
+
+    def __repr__(self):
+        return 'TransferEvent(phase={0!r}, position={1!r}, total={2!r}, unit={3!r}, changesets={4!r}, bytes={5!r}, ' \
+               'elapsed={6:.3f}, throughput={7!r})'.format(self.phase, self.position, self.total, self.unit,
+                                                           self.changesets, self.bytes, self.elapsed, self.throughput)
+
+
+
+
+class TransferProgress (object):
+    """Turns the output of hg pull -v or hg push -v (with PROGRESS_CONFIG) into TransferEvent objects, passed to
+    listener. Feed it with stdout_line() and stderr_segment(), and call finish() once hg has exited, to emit the
+    final 'done' event."""
+    def __init__(self, listener, clock=time.time):
+        self.__listener = listener
+        self.__clock = clock
+        self.__start = clock()
+        self.__in_bundle_sizes = False
+        self.phase = None
+        self.changesets = None
+        self.files = None
+        self.bytes = None
+
+
+    @property
+    def elapsed(self):
+        return self.__clock() - self.__start
+
+    @property
+    def throughput(self):
+        elapsed = self.elapsed
+        if self.bytes is None  or  elapsed <= 0.0:
+            return None
+        return self.bytes / elapsed
+
+
+    def __emit(self, position=None, total=None, unit=None, message=None):
+        self.__listener(TransferEvent(self.phase, position, total, unit, self.changesets, self.bytes, self.elapsed,
+                                      self.throughput, message))
+
+
+    def stdout_line(self, line):
+        line = line.rstrip('\r\n')
+        if line.startswith(_REMOTE_PREFIX):
+            # When pushing over ssh or http, the remote hg reports adding the changesets
+            line = line[len(_REMOTE_PREFIX):]
+        if self.__in_bundle_sizes:
+            match = _BUNDLE_SIZE_PATTERN.match(line)
+            if match is not None:
+                self.bytes = (self.bytes   or  0) + int(match.group(1))
+                return
+            self.__in_bundle_sizes = False
+        if line == _BUNDLE_SIZE_HEADER:
+            self.__in_bundle_sizes = True
+            return
+        match = _FOUND_PATTERN.match(line)
+        if match is not None:
+            self.changesets = int(match.group(1))
+        match = _ADDED_PATTERN.match(line)
+        if match is not None:
+            self.changesets = int(match.group(1))
+            self.files = int(match.group(3))
+        for pattern, phase in _PHASE_MESSAGES:
+            if pattern.match(line):
+                self.phase = phase
+                self.__emit(message=line)
+                return
+
+
+    def stderr_segment(self, segment):
+        """Process a segment of stderr, including its ending; returns True if it was a progress bar.
+        hg draws and clears its progress bars by returning to the start of the line, so only segments ending in a
+        lone carriage return can be progress bars; anything else, such as an error from ssh, is left alone."""
+        if not segment.endswith('\r'):
+            return False
+        segment = segment.strip()
+        if segment == '':
+            # Progress bars are cleared with spaces
+            return True
+        match = _PROGRESS_BAR_PATTERN.match(segment)
+        if match is None:
+            return False
+        topic, position, total, unit = match.groups()
+        self.phase = topic
+        self.__emit(int(position), int(total)   if total is not None   else None, unit)
+        return True
+
+
+    def finish(self):
+        self.phase = 'done'
+        self.__emit()
@@ -1,6 +1,7 @@
 from __future__ import with_statement
 import unittest, doctest
 import os, shutil, os.path
+import sys, time
 import tempfile
 import zipfile
 import hgapi
@@ -806,6 +807,1450 @@ class TestHgAPI(unittest.TestCase):
             shutil.rmtree(main_clone_path)
 
 
+    def test_360_cmdserver(self):
+        with hgapi.Repo(self._test_dir_path, user=self._user, use_cmdserver=True) as cs_repo:
+            self.assertTrue(cs_repo.uses_cmdserver)
+            self.assertEqual(self.repo.hg_id(), cs_repo.hg_id())
+            self.assertEqual(self.repo.hg_status(), cs_repo.hg_status())
+            self.assertEqual(self.repo.hg_heads(), cs_repo.hg_heads())
+            self.assertEqual(self.repo.revision('tip').desc, cs_repo.revision('tip').desc)
+            self.assertEqual(self.repo[0:'tip'], cs_repo[0:'tip'])
+            # Errors are mapped to exceptions in the same way
+            self.assertRaises(hgapi.HGError, lambda: cs_repo.revision('no_such_revision'))
+            self.assertRaises(hgapi.HGCommitNoChanges, lambda: cs_repo.hg_commit('nothing'))
+
+            # Modifications made through the command server are visible to other processes
+            with open(self._test_file('file8.txt'), 'w') as out:
+                out.write('created via the command server')
+            cs_repo.hg_add('file8.txt')
+            self.assertEqual({'file8.txt'}, self.repo.hg_status().added)
+            cs_repo.hg_commit('Added file8.txt')
+            self.assertEqual(self.repo.hg_node(), cs_repo.hg_node())
+            self.assertEqual('Added file8.txt', self.repo['tip'].desc)
+
+
+    def test_361_cmdserver_pool(self):
+        import threading
+        with hgapi.Repo(self._test_dir_path, user=self._user, cmdserver_pool_size=3) as pool_repo:
+            expected_heads = self.repo.hg_heads()
+            original_branch = self.repo.hg_branch()
+            results = []
+            errors = []
+            def reader():
+                try:
+                    for i in range(3):
+                        # hg_heads may be answered from hg's branch cache, so run hg heads directly
+                        results.append(pool_repo.hg_command(None, 'heads', '--template', '{node}\n').split())
+                except Exception as e:
+                    errors.append(e)
+            threads = [threading.Thread(target=reader)   for i in range(6)]
+            for t in threads:
+                t.start()
+            # A mutating command issued while the readers are running
+            pool_repo.hg_branch('pool_branch')
+            for t in threads:
+                t.join()
+            pool_repo.hg_branch(original_branch)
+
+            self.assertEqual([], errors)
+            self.assertEqual([expected_heads] * 18, results)
+            stats = pool_repo.cmdserver_pool_stats
+            # The reads issued by __init__ are counted as well
+            self.assertTrue(stats.reads >= 18)
+            # Both hg_branch calls set the branch, so are serialized as writes
+            self.assertEqual(2, stats.writes)
+            self.assertTrue(stats.total_exec_time > 0.0)
+            self.assertTrue(stats.max_queue_wait >= stats.mean_queue_wait)
+
+        # A thread holding a read lock may read again while a writer waits
+        import cmdserver
+        lock = cmdserver._ReadWriteLock()
+        lock.acquire_read()
+        writer = threading.Thread(target=lambda: (lock.acquire_write(), lock.release_write()))
+        writer.start()
+        time.sleep(0.1)
+        self.assertTrue(writer.is_alive())
+        nested = threading.Thread(target=lambda: (lock.acquire_read(), lock.release_read()))
+        lock.acquire_read()
+        lock.release_read()
+        # Other threads wait for the writer
+        nested.start()
+        time.sleep(0.1)
+        self.assertTrue(nested.is_alive())
+        lock.release_read()
+        writer.join(10)
+        nested.join(10)
+        self.assertFalse(writer.is_alive()  or  nested.is_alive())
+
+        # Commands that contact a remote are readers, unless they write a bundle
+        self.assertTrue(cmdserver.is_read_only_command(['incoming']))
+        self.assertTrue(cmdserver.is_read_only_command(['outgoing']))
+        self.assertFalse(cmdserver.is_read_only_command(['incoming', '--bundle', 'in.hg']))
+        self.assertTrue(cmdserver.is_read_only_command(['--config', 'ui.verbose=true', 'log']))
+
+
+    def test_370_iter_revisions(self):
+        all_revs = self.repo.revisions('0:tip')
+        streamed = self.repo.iter_revisions('0:tip')
+        self.assertFalse(isinstance(streamed, list))
+        streamed = list(streamed)
+        self.assertEqual(all_revs, streamed)
+        self.assertEqual([r.desc   for r in all_revs], [r.desc   for r in streamed])
+        self.assertEqual(self.repo.revisions_for('file2.txt', '0:tip'), list(self.repo.iter_revisions('0:tip', filename='file2.txt')))
+
+        # Stopping early
+        gen = self.repo.iter_revisions('0:tip')
+        self.assertEqual(all_revs[0], next(gen))
+        gen.close()
+
+        self.assertRaises(hgapi.HGError, lambda: list(self.repo.iter_revisions('no_such_revision')))
+
+        # More error output than a pipe holds, written before any output; hg must not block on it
+        hook = 'pre-log={0} -c "import sys; sys.stderr.write(\'w\' * 200000)"'.format(sys.executable)
+        lines = list(self.repo.hg_command_lines(None, '--config', 'hooks.' + hook, 'log', '-r', '0', '--template', '{rev}\n'))
+        self.assertEqual(['0'], [l.strip()   for l in lines])
+
+
+    def test_380_revision_cache(self):
+        cached_repo = hgapi.Repo(self._test_dir_path, user=self._user, revision_cache_size=100)
+        cache = cached_repo.revision_cache
+        all_revs = cached_repo[0:'tip']
+        self.assertEqual(len(all_revs), len(cache))
+
+        # Served from the cache, by number, node and range
+        hits = cache.hits
+        self.assertEqual(all_revs[3], cached_repo[3])
+        self.assertEqual(all_revs[3], cached_repo.revision(all_revs[3].node))
+        self.assertEqual(all_revs[2:6], cached_repo.revisions('2:5'))
+        self.assertEqual(hits + 2 + 4, cache.hits)
+
+        # A new commit moves the tip tag
+        old_tip = all_revs[-1]
+        self.assertTrue('tip' in old_tip.tags)
+        with open(self._test_file('file8.txt'), 'a') as out:
+            out.write('more content')
+        cached_repo.hg_commit('Modified file8.txt')
+        self.assertFalse('tip' in cached_repo.revision(old_tip.node).tags)
+        new_tip = cached_repo.revision(old_tip.rev + 1)
+        self.assertEqual('Modified file8.txt', new_tip.desc)
+
+        # Rolling back renumbers history, so the cache is cleared
+        cached_repo.hg_command(None, 'rollback')
+        self.assertEqual(0, len(cache))
+        # Looked up by node; a revision number beyond the tip could be taken as a node prefix by hg
+        self.assertRaises(hgapi.HGError, lambda: cached_repo.revision(new_tip.node))
+        self.repo.hg_revert(all=True)
+
+        # Concurrent lookups and additions keep the cache bounded and consistent
+        import threading
+        import revcache
+        small_cache = revcache.RevisionCache(3)
+        def churn():
+            for i in range(200):
+                rev = all_revs[i % len(all_revs)]
+                small_cache.add(rev)
+                found = small_cache.get_by_rev(rev.rev)
+                self.assertTrue(found is None  or  found.node == rev.node)
+        threads = [threading.Thread(target=churn)   for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(3, len(small_cache))
+
+
+    def test_390_changelog_mirror(self):
+        mirror = hgapi.ChangelogMirror(self.repo)
+        added = mirror.refresh()
+        self.assertEqual(self.repo[0:'tip'], added)
+        self.assertEqual(self.repo['tip'].node, mirror.tip_node)
+
+        # Nothing changed
+        self.assertEqual([], mirror.refresh())
+        self.assertEqual(len(added), mirror.revisions_fetched)
+
+        # Only the new revision is fetched
+        with open(self._test_file('file8.txt'), 'a') as out:
+            out.write('mirrored content')
+        self.repo.hg_commit('Mirrored change')
+        added = mirror.refresh()
+        self.assertEqual(['Mirrored change'], [r.desc   for r in added])
+        self.assertEqual(len(mirror.revisions) - 1, mirror.tip_rev)
+
+        # Replace the tip; the mirror must notice and resync
+        self.repo.hg_command(None, 'rollback')
+        self.repo.hg_commit('Replacement change')
+        added = mirror.refresh()
+        self.assertEqual(1, mirror.resyncs)
+        self.assertEqual(self.repo[0:'tip'], mirror.revisions)
+        self.assertEqual('Replacement change', mirror.revisions[-1].desc)
+
+
+    def test_400_revision_index(self):
+        index_dir = tempfile.mkdtemp(prefix='testhgapi_index')
+        try:
+            all_revs = self.repo[0:'tip']
+            tip_rev = all_revs[-1].rev
+            with hgapi.Repo(self._test_dir_path, revision_index_dir=index_dir) as idx_repo:
+                indexed = idx_repo.revisions('0:{0}'.format(tip_rev))
+                self.assertEqual(all_revs, indexed)
+                self.assertEqual([(r.desc, r.author, r.branch, r.parents, r.date, r.tags)   for r in all_revs],
+                                 [(r.desc, r.author, r.branch, r.parents, r.date, r.tags)   for r in indexed])
+                self.assertEqual(all_revs[3].desc, idx_repo.revision(3).desc)
+                self.assertEqual(self.repo.revisions_for('file2.txt'), idx_repo.revisions_for('file2.txt'))
+
+            # A new Repo reads the existing index; revisions committed by others are picked up on demand
+            with open(self._test_file('file8.txt'), 'a') as out:
+                out.write('indexed content')
+            self.repo.hg_commit('Indexed change')
+            with hgapi.Repo(self._test_dir_path, revision_index_dir=index_dir) as idx_repo:
+                self.assertEqual('Indexed change', idx_repo.revision(tip_rev + 1).desc)
+                self.assertEqual('tip', idx_repo.revision(tip_rev + 1).tags)
+                self.assertEqual('', idx_repo.revision(tip_rev).tags)
+
+                # History rewritten by another process
+                self.repo.hg_command(None, 'rollback')
+                self.repo.hg_commit('Replacement indexed change')
+                idx_repo.sync_revision_index()
+                self.assertEqual('Replacement indexed change', idx_repo.revision(tip_rev + 1).desc)
+
+            # The index is shared by the threads that use a Repo
+            import threading
+            import revindex
+            index = revindex.RevisionIndex(self._test_dir_path, index_dir)
+            revs = self.repo[0:'tip']
+            errors = []
+            def _use_index():
+                try:
+                    for i in range(50):
+                        index.add(revs)
+                        self.assertEqual(revs, index.get_many([r.rev   for r in revs]))
+                        self.assertEqual(revs[-1].rev, index.tip_rev)
+                except Exception as e:
+                    errors.append(e)
+            threads = [threading.Thread(target=_use_index)   for i in range(4)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            self.assertEqual([], errors)
+            # Holding the lock keeps other threads from resetting the index meanwhile
+            with index.lock:
+                resetter = threading.Thread(target=index.reset)
+                resetter.start()
+                resetter.join(0.2)
+                self.assertTrue(resetter.is_alive())
+                self.assertEqual(revs[-1].rev, index.tip_rev)
+            resetter.join()
+            self.assertEqual(-1, index.tip_rev)
+            index.close()
+        finally:
+            shutil.rmtree(index_dir)
+
+
+    def test_410_log_formats(self):
+        # The fast and legacy log formats produce identical revisions
+        json_revs = hgapi._revisions_from_json_log(self.repo.hg_log(rev_identifier='0:tip', template=self.repo.rev_log_tpl))
+        fast_revs = self.repo[0:'tip']
+        self.assertEqual([(r.node, r.rev, r.author, r.branch, r.parents, r.date, r.tags, r.desc)   for r in json_revs],
+                         [(r.node, r.rev, r.author, r.branch, r.parents, r.date, r.tags, r.desc)   for r in fast_revs])
+
+        import benchmark
+        rates = benchmark.benchmark_log_parsing(self.repo, repeat=1)
+        self.assertTrue(rates['json'] > 0.0)
+        self.assertTrue(rates['fast'] > 0.0)
+
+        # Free-text fields may contain anything, including NUL and the escape character
+        def fields(revs):
+            return [(r.node, r.rev, r.author, r.branch, r.parents, r.date, r.tags, r.desc)   for r in revs]
+        repo_path = tempfile.mkdtemp(prefix='testhgapi_nul')
+        try:
+            nul_repo = hgapi.Repo.hg_init(repo_path, user=self._user)
+            message_path = os.path.join(repo_path, '.hg', 'message.txt')
+            for i, message in enumerate([b'before\0after 100%', b'second\n\0\0', b'd\xc3\xa9j\xc3\xa0 vu']):
+                with open(os.path.join(repo_path, 'file.txt'), 'w') as out:
+                    out.write(str(i))
+                if i == 0:
+                    nul_repo.hg_add('file.txt')
+                with open(message_path, 'wb') as out:
+                    out.write(message)
+                nul_repo.hg_command(None, 'commit', '-l', message_path, '-u', 'user 100%')
+            revs = nul_repo[0:'tip']
+            self.assertEqual([u'before\0after 100%', u'second\n\0\0', u'd\u00e9j\u00e0 vu'], [r.desc   for r in revs])
+            self.assertEqual([0, 1, 2], [r.rev   for r in revs])
+            self.assertEqual(fields(revs), fields(nul_repo.iter_revisions('0:tip')))
+            self.assertEqual(fields(revs), fields(nul_repo.revision_table('0:tip')))
+            self.assertEqual(fields(revs), fields(nul_repo.revisions('0:tip', lazy=True)))
+        finally:
+            shutil.rmtree(repo_path)
+
+
+    def test_420_revision_table(self):
+        all_revs = self.repo[0:'tip']
+        table = self.repo.revision_table('0:tip')
+        self.assertEqual(len(all_revs), len(table))
+        self.assertEqual([(r.node, r.rev, r.author, r.branch, r.parents, r.date, r.tags, r.desc)   for r in all_revs],
+                         [(r.node, r.rev, r.author, r.branch, r.parents, r.date, r.tags, r.desc)   for r in table])
+        self.assertEqual(all_revs[-1], table[-1])
+        self.assertEqual(list(table.p1_rows), [r.parents[0]   for r in all_revs])
+        # Rows in reverse order, and not covering every revision
+        partial = self.repo.revision_table('reverse(1:tip)')
+        self.assertEqual(len(all_revs) - 1, len(partial))
+        self.assertEqual([len(all_revs) - 1 - r   for r in range(1, len(all_revs))], [partial.row_of_rev(r)   for r in range(1, len(all_revs))])
+        self.assertEqual(None, partial.row_of_rev(0))
+        self.assertEqual(None, partial.row_of_rev(len(all_revs)))
+        self.assertEqual([partial.row_of_rev(p)   if p > 0   else -1   for p in partial.p1], list(partial.p1_rows))
+
+        # Filtering, with and without numpy
+        import revtable
+        numpy = revtable.numpy
+        try:
+            for np in [numpy, None]:
+                revtable.numpy = np
+                self.assertEqual([r.rev   for r in all_revs   if r.branch == 'test_branch'],
+                                 list(table.filter(branch='test_branch').revs))
+                self.assertEqual([r.rev   for r in all_revs   if r.author == 'test'],
+                                 table.filter_rows(author='test'))
+                self.assertEqual([], table.filter_rows(author='nobody'))
+                # Restrict the dates to those of the first revision
+                first = table.timestamps[0]
+                self.assertEqual([0], table.filter_rows(date_from=first - 1, date_to=first, author=all_revs[0].author)[:1])
+                self.assertEqual(len(table), len(table.filter_rows(date_from=0)))
+        finally:
+            revtable.numpy = numpy
+
+        # Empty and non-ASCII descriptions survive the text column
+        small = revtable.RevisionTable()
+        for i, desc in enumerate([u'', u'd\u00e9j\u00e0 vu', u'multi\nline']):
+            small.append(all_revs[0].node, i, 'test', 'default', -1, -1, 0, 0, '', desc)
+        self.assertEqual([u'', u'd\u00e9j\u00e0 vu', u'multi\nline'], [r.desc   for r in small])
+
+
+    def test_430_changelog_graph(self):
+        def hg_revs(revset):
+            return [int(l)   for l in self.repo.hg_log(rev_identifier=revset, template='{rev}\n').split()]
+
+        graph = self.repo.changelog_graph()
+        all_revs = self.repo[0:'tip']
+        self.assertEqual(len(all_revs), len(graph))
+        self.assertEqual(sorted(hg_revs('heads(all())')), graph.heads())
+        self.assertEqual(sorted(hg_revs('roots(all())')), graph.roots())
+        for r in all_revs:
+            self.assertEqual(sorted(hg_revs('ancestors({0})'.format(r.rev))), graph.ancestors(r.rev))
+            self.assertEqual(sorted(hg_revs('descendants({0})'.format(r.rev))), graph.descendants(r.rev))
+        for a in all_revs:
+            for b in all_revs:
+                self.assertEqual(a.rev in graph.ancestors(b.rev), graph.is_ancestor(a.rev, b.rev))
+                common = set(graph.ancestors(a.rev)) & set(graph.ancestors(b.rev))
+                self.assertEqual(max(common), graph.common_ancestor(a.rev, b.rev))
+        heads = graph.heads()
+        self.assertTrue(graph.common_ancestor(heads[0], heads[-1]) in
+                        hg_revs('heads(ancestors({0}) and ancestors({1}))'.format(heads[0], heads[-1])))
+
+        # Built incrementally, with children arriving before their parents
+        partial = hgapi.ChangelogGraph()
+        for r in reversed(all_revs[:-2]):
+            partial.add_revision(r.rev, r.parents)
+        partial.add(all_revs[-2:])
+        self.assertEqual(graph.heads(), partial.heads())
+        self.assertEqual([graph.generation(r.rev)   for r in all_revs], [partial.generation(r.rev)   for r in all_revs])
+        self.assertEqual(graph.ancestors(all_revs[-1].rev), partial.ancestors(all_revs[-1].rev))
+
+
+    def test_440_lazy_revisions(self):
+        all_revs = self.repo[0:'tip']
+        lazy_revs = self.repo.revisions('0:tip', lazy=True)
+        self.assertEqual(all_revs, lazy_revs)
+        self.assertEqual([(r.node, r.rev, r.branch, r.parents)   for r in all_revs],
+                         [(r.node, r.rev, r.branch, r.parents)   for r in lazy_revs])
+        self.assertFalse(lazy_revs[0].is_loaded)
+
+        # Accessing one revision's description loads the remaining fields of the whole query
+        self.assertEqual(all_revs[1].desc, lazy_revs[1].desc)
+        self.assertTrue(all([r.is_loaded   for r in lazy_revs]))
+        self.assertEqual([(r.author, r.date, r.tags, r.desc)   for r in all_revs],
+                         [(r.author, r.date, r.tags, r.desc)   for r in lazy_revs])
+
+        # Revisions that disappear before they are loaded
+        with open(self._test_file('file8.txt'), 'a') as out:
+            out.write('lazy content')
+        self.repo.hg_commit('Lazy change')
+        lazy_tip = self.repo.revisions('tip', lazy=True)[0]
+        self.repo.hg_command(None, 'rollback')
+        self.repo.hg_revert(all=True)
+        self.assertRaises(hgapi.HGError, lambda: lazy_tip.desc)
+
+        # Revisions that the query no longer matches are still loaded
+        lazy_tip = self.repo.revisions('tip', lazy=True)[0]
+        with open(self._test_file('file8.txt'), 'a') as out:
+            out.write('lazy content')
+        self.repo.hg_commit('Lazy change')
+        self.assertEqual(all_revs[-1].desc, lazy_tip.desc)
+        self.repo.hg_command(None, 'rollback')
+        self.repo.hg_revert(all=True)
+
+
+    def test_450_status_cache(self):
+        # hg status may rewrite the dirstate, so run it through the other repo first
+        expected = self.repo.hg_status()
+        cached_repo = hgapi.Repo(self._test_dir_path, user=self._user, cache_status=True)
+        cache = cached_repo.status_cache
+        status = cached_repo.hg_status()
+        self.assertEqual(expected, status)
+
+        # Nothing has changed, so hg is not run again
+        hits = cache.hits
+        self.assertEqual(status, cached_repo.hg_status())
+        self.assertEqual(hits + 1, cache.hits)
+
+        # Modifying the working copy changes the fingerprint
+        with open(self._test_file('file8.txt'), 'a') as out:
+            out.write('status cache content')
+        misses = cache.misses
+        self.assertTrue('file8.txt' in cached_repo.hg_status().modified)
+        self.assertEqual(misses + 1, cache.misses)
+
+        # Mutating commands and notifications invalidate the cache
+        cached_repo.hg_status()
+        self.assertEqual(1, len(cache))
+        cached_repo.hg_revert(all=True)
+        self.assertEqual(0, len(cache))
+        self.assertFalse('file8.txt' in cached_repo.hg_status().modified)
+        cached_repo._notify_filesystem_modified()
+        self.assertEqual(0, len(cache))
+        self.assertTrue(cache.hit_rate > 0.0)
+
+        # Only directories with tracked or untracked files are fingerprinted in full; in ignored trees, only the
+        # directories are stat'ed
+        repo_path = tempfile.mkdtemp(prefix='testhgapi_status')
+        try:
+            ignoring_repo = hgapi.Repo.hg_init(repo_path, user=self._user)
+            with open(os.path.join(repo_path, '.hgignore'), 'w') as out:
+                out.write('\\.o$\n')
+            ignoring_repo.hg_add('.hgignore')
+            ignoring_repo.hg_commit('Ignore objects')
+            os.makedirs(os.path.join(repo_path, 'build', 'objects'))
+            with open(os.path.join(repo_path, 'build', 'objects', 'a.o'), 'w') as out:
+                out.write('object')
+            cached_repo = hgapi.Repo(repo_path, user=self._user, cache_status=True)
+            cache = cached_repo.status_cache
+            self.assertEqual(hgapi.Status(), cached_repo.hg_status())
+            cached_repo.hg_status()
+            hits = cache.hits
+            with open(os.path.join(repo_path, 'build', 'objects', 'a.o'), 'a') as out:
+                out.write('rebuilt')
+            self.assertEqual(hgapi.Status(), cached_repo.hg_status())
+            self.assertEqual(hits + 1, cache.hits)
+            # A file that is not ignored, created deep within a tree that only holds ignored files
+            os.makedirs(os.path.join(repo_path, 'build', 'objects', 'sub'))
+            with open(os.path.join(repo_path, 'build', 'objects', 'sub', 'new.c'), 'w') as out:
+                out.write('source')
+            self.assertEqual(set(['build/objects/sub/new.c']), cached_repo.hg_status().untracked)
+            shutil.rmtree(os.path.join(repo_path, 'build', 'objects', 'sub'))
+            self.assertEqual(hgapi.Status(), cached_repo.hg_status())
+
+            # New untracked files, in new directories, and in directories that only hold untracked files
+            os.makedirs(os.path.join(repo_path, 'src'))
+            with open(os.path.join(repo_path, 'src', 'new.txt'), 'w') as out:
+                out.write('new')
+            self.assertEqual(set(['src/new.txt']), cached_repo.hg_status().untracked)
+            self.assertEqual(set(['src/new.txt']), cached_repo.hg_status().untracked)
+            os.makedirs(os.path.join(repo_path, 'src', 'sub'))
+            with open(os.path.join(repo_path, 'src', 'sub', 'other.txt'), 'w') as out:
+                out.write('other')
+            self.assertEqual(set(['src/new.txt', 'src/sub/other.txt']), cached_repo.hg_status().untracked)
+            self.assertEqual(set(['src/sub/other.txt']), cached_repo.hg_status(['src/sub']).untracked)
+
+            # Deleted untracked trees stop being fingerprinted after the next full status
+            import statuscache
+            shutil.rmtree(os.path.join(repo_path, 'src'))
+            self.assertEqual(hgapi.Status(), cached_repo.hg_status())
+            fingerprinted = []
+            directory_signature = statuscache._directory_signature
+            statuscache._directory_signature = lambda path, d, watched: fingerprinted.append(d)  or  directory_signature(path, d, watched)
+            try:
+                self.assertEqual(hgapi.Status(), cached_repo.hg_status())
+            finally:
+                statuscache._directory_signature = directory_signature
+            self.assertEqual([''], sorted(set(fingerprinted)))
+
+            # Results computed while the cache is invalidated are not stored
+            def invalidating_status():
+                cache.invalidate()
+                return hgapi.Status()
+            cache.invalidate()
+            self.assertEqual(hgapi.Status(), cache.get([], invalidating_status))
+            self.assertEqual(0, len(cache))
+
+            # A dirstate truncated while hg rewrites it makes the whole working copy be fingerprinted
+            dirstate_path = os.path.join(repo_path, '.hg', 'dirstate')
+            with open(dirstate_path, 'rb') as f:
+                dirstate_data = f.read()
+            try:
+                with open(dirstate_path, 'wb') as f:
+                    f.write(dirstate_data[:50])
+                truncated_cache = statuscache.StatusCache(repo_path)
+                self.assertEqual(hgapi.Status(), truncated_cache.get([], lambda: hgapi.Status()))
+            finally:
+                with open(dirstate_path, 'wb') as f:
+                    f.write(dirstate_data)
+        finally:
+            shutil.rmtree(repo_path)
+
+
+    def test_460_watcher(self):
+        import threading
+        import watcher
+        if not watcher.is_available():
+            self.assertRaises(hgapi.HGWatcherUnavailableError, lambda: hgapi.Repo(self._test_dir_path, watch_working_copy=True))
+            return
+        modified = threading.Event()
+        with hgapi.Repo(self._test_dir_path, user=self._user, watch_working_copy=True,
+                        on_filesystem_modified=modified.set) as watched_repo:
+            self.assertEqual(self.repo.hg_status(), watched_repo.hg_status())
+            # Nothing touched
+            self.assertEqual(self.repo.hg_status(), watched_repo.hg_status())
+
+            # Modifications by other processes are noticed
+            modified.clear()
+            with open(self._test_file('file8.txt'), 'a') as out:
+                out.write('watched content')
+            os.mkdir(self._test_file('watched_dir'))
+            with open(self._test_file('watched_dir/new.txt'), 'w') as out:
+                out.write('new')
+            status = watched_repo.hg_status()
+            self.assertTrue('file8.txt' in status.modified)
+            self.assertTrue('watched_dir/new.txt' in status.untracked)
+            self.assertEqual(self.repo.hg_status(), status)
+            self.assertTrue(modified.wait(5.0))
+
+            # Commands run through the repo are accounted for, and reported by the repo rather than by the watcher
+            modified.clear()
+            shutil.rmtree(self._test_file('watched_dir'))
+            self.assertTrue(modified.wait(5.0))
+            modified.clear()
+            watched_repo.hg_revert(all=True)
+            self.assertTrue(modified.is_set())
+            modified.clear()
+            self.assertFalse('file8.txt' in watched_repo.hg_status().modified)
+            time.sleep(1.0)
+            self.assertFalse(modified.is_set())
+            self.assertEqual(self.repo.hg_status(), watched_repo.hg_status())
+
+        # Modifications made while commands run are reported once the commands finish, unless the caller reports them
+        modified.clear()
+        w = watcher.WorkingCopyWatcher(self._test_dir_path, on_modified=modified.set, debounce=0.05)
+        try:
+            # Read-only commands only hide changes to .hg
+            w.suppress_notifications(working_copy=False)
+            with open(self._test_file('file8.txt'), 'a') as out:
+                out.write('during read')
+            self.assertTrue(modified.wait(5.0))
+            w.resume_notifications(working_copy=False)
+            modified.clear()
+            w.suppress_notifications()
+            with open(self._test_file('file8.txt'), 'a') as out:
+                out.write('during write')
+            time.sleep(0.5)
+            self.assertFalse(modified.is_set())
+            w.resume_notifications()
+            self.assertTrue(modified.wait(5.0))
+            modified.clear()
+            w.suppress_notifications()
+            with open(self._test_file('file8.txt'), 'a') as out:
+                out.write('reported')
+            time.sleep(0.2)
+            w.resume_notifications()
+            w.notification_delivered()
+            time.sleep(0.5)
+            self.assertFalse(modified.is_set())
+        finally:
+            w.close()
+        self.repo.hg_revert(all=True)
+
+        # A failing callback does not stop the watcher
+        calls = []
+        def on_modified():
+            calls.append(True)
+            if len(calls) == 1:
+                raise RuntimeError('callback failure')
+            modified.set()
+        modified.clear()
+        watcher._log.disabled = True
+        try:
+            with hgapi.Repo(self._test_dir_path, user=self._user, watch_working_copy=True,
+                            on_filesystem_modified=on_modified) as watched_repo:
+                for i in range(2):
+                    with open(self._test_file('file8.txt'), 'a') as out:
+                        out.write('watched content')
+                    for j in range(50):
+                        if len(calls) > i:
+                            break
+                        time.sleep(0.1)
+                self.assertTrue(modified.wait(5.0))
+                watched_repo.hg_revert(all=True)
+        finally:
+            watcher._log.disabled = False
+
+
+    def test_470_config_cache(self):
+        import hgrc
+        cache = hgrc.shared_config_cache
+        other_repo = hgapi.Repo(self._test_dir_path, user=self._user)
+        self.repo.config('ui', 'username')
+        hits, misses = cache.hits, cache.misses
+        # Shared between Repo objects for the same path
+        self.assertEqual(self.repo.config('ui', 'username'), other_repo.config('ui', 'username'))
+        self.assertEqual((hits + 2, misses), (cache.hits, cache.misses))
+        # The search path is not worked out again
+        search_path = hgrc.config_search_path
+        def no_search(*args):
+            raise AssertionError('config_search_path called')
+        hgrc.config_search_path = no_search
+        try:
+            self.repo.config('ui', 'username')
+        finally:
+            hgrc.config_search_path = search_path
+
+        # Changing a configuration that has been handed out does not affect the shared one
+        username = other_repo.config('ui', 'username')
+        self.repo.read_config()['ui']['username'] = 'changed'
+        self.assertEqual(username, other_repo.config('ui', 'username'))
+        private_cache = hgrc.ConfigCache()
+        private_cache.get('key', self._test_dir_path, lambda: {'section': {'item': 'one'}})['section']['item'] = 'two'
+        private_cache.get('key', self._test_dir_path, None)['section']['item'] = 'three'
+        self.assertEqual('one', private_cache.get('key', self._test_dir_path, None)['section']['item'])
+
+        # External edits to the repo config and to %include targets are picked up
+        hgrc_path = os.path.join(self._test_dir_path, '.hg', 'hgrc')
+        include_path = os.path.join(self._test_dir_path, '.hg', 'hgapi_included.rc')
+        with open(hgrc_path, 'rb') as f:
+            original = f.read()
+        try:
+            with open(include_path, 'w') as f:
+                f.write('[hgapi_test]\nincluded = one\n')
+            with open(hgrc_path, 'ab') as f:
+                f.write(b'\n%include hgapi_included.rc\n')
+            self.assertEqual('one', other_repo.config('hgapi_test', 'included'))
+            with open(include_path, 'w') as f:
+                f.write('[hgapi_test]\nincluded = second\n')
+            self.assertEqual('second', other_repo.config('hgapi_test', 'included'))
+            self.assertEqual('second', self.repo.config('hgapi_test', 'included'))
+        finally:
+            with open(hgrc_path, 'wb') as f:
+                f.write(original)
+            os.remove(include_path)
+        self.assertEqual(None, self.repo.config('hgapi_test', 'included'))
+
+
+    def test_480_native_config(self):
+        hgrc_path = os.path.join(self._test_dir_path, '.hg', 'hgrc')
+        include_path = os.path.join(self._test_dir_path, '.hg', 'hgapi_native.rc')
+        with open(hgrc_path, 'rb') as f:
+            original = f.read()
+        try:
+            with open(include_path, 'w') as f:
+                f.write('[hgapi_included]\nkey=value\n')
+            with open(hgrc_path, 'ab') as f:
+                f.write(b'\n[hgapi_native]\n'
+                        b'multi = first\n'
+                        b'; a comment\n'
+                        b'   second  \n'
+                        b'empty =\n'
+                        b'list = a, b,c\n'
+                        b'flag = off\n'
+                        b'gone = 1\n'
+                        b'%unset gone\n'
+                        b'%include hgapi_native.rc\n'
+                        b'after = include\n'
+                        b'[test]\n'
+                        b'stuff.verbose = true\n')
+            native_repo = hgapi.Repo(self._test_dir_path, user=self._user, native_config=True)
+            # Differential: the native reader gives the same results as hg showconfig
+            self.assertEqual(self.repo.read_config(), native_repo.read_config())
+            self.assertEqual('first\\nsecond', native_repo.config('hgapi_native', 'multi'))
+            self.assertEqual(None, native_repo.config('hgapi_native', 'gone'))
+            self.assertEqual('include', native_repo.config('hgapi_native', 'after'))
+            self.assertEqual('value', native_repo.config('hgapi_included', 'key'))
+            self.assertTrue(native_repo.configbool('test', 'stuff.verbose'))
+            self.assertEqual(self.repo.configlist('hgapi_native', 'list'), native_repo.configlist('hgapi_native', 'list'))
+
+            with open(hgrc_path, 'ab') as f:
+                f.write(b'not a valid line\n')
+            self.assertRaises(hgapi.HGError, native_repo.read_config)
+        finally:
+            with open(hgrc_path, 'wb') as f:
+                f.write(original)
+            os.remove(include_path)
+
+
+    def test_490_lazy_construction(self):
+        # hg_version is only determined once per hg path
+        self.assertEqual(hgapi.hg_version(), hgapi._hg_versions[hgapi.get_hg_path()])
+        self.assertEqual(hgapi.hg_version(), hgapi.hg_version(refresh=True))
+
+        lazy_repo = hgapi.Repo(self._test_dir_path, user=self._user, lazy=True)
+        self.assertEqual(self.repo.hg_status(), lazy_repo.hg_status())
+        self.assertEqual(self.repo.is_extension_enabled('rebase'), lazy_repo.is_extension_enabled('rebase'))
+        self.assertEqual(self.repo.config('ui', 'username'), lazy_repo.config('ui', 'username'))
+
+        # The factories take the same options as the constructor
+        factory_path = tempfile.mkdtemp(prefix='testhgapi_factory')
+        try:
+            with hgapi.Repo.hg_clone(os.path.join(factory_path, 'clone'), self._test_dir_path, user=self._user, lazy=True,
+                                     cache_status=True, revision_cache_size=10) as clone:
+                self.assertTrue(clone.status_cache is not None)
+                self.assertTrue(clone.revision_cache is not None)
+            with hgapi.Repo.hg_init(os.path.join(factory_path, 'init'), user=self._user, lazy=True, native_revlog=True) as init:
+                self.assertEqual(-1, init['tip'].rev)
+        finally:
+            shutil.rmtree(factory_path)
+
+        not_a_repo = tempfile.mkdtemp(prefix='testhgapi_notrepo')
+        try:
+            self.assertRaises(hgapi.HGError, lambda: hgapi.Repo(not_a_repo, lazy=True))
+        finally:
+            shutil.rmtree(not_a_repo)
+
+
+    def test_500_native_revlog(self):
+        import revlog
+        def fields(revs):
+            return [(r.node, r.rev, r.author, r.branch, r.parents, r.date, r.tags, r.desc)   for r in revs]
+
+        with hgapi.Repo(self._test_dir_path, user=self._user, native_revlog=True) as native_repo:
+            self.assertTrue(native_repo.uses_native_revlog)
+            all_revs = self.repo[0:'tip']
+            self.assertEqual(fields(all_revs), fields(native_repo[0:'tip']))
+            self.assertEqual(fields(self.repo.revisions('3:1')), fields(native_repo.revisions('3:1')))
+            self.assertEqual(fields([self.repo['tip']]), fields([native_repo['tip']]))
+            self.assertEqual(fields([self.repo[all_revs[2].node]]), fields([native_repo[all_revs[2].node]]))
+            self.assertEqual(self.repo.hg_heads(), native_repo.hg_heads())
+
+            # New revisions are picked up
+            with open(self._test_file('file8.txt'), 'a') as out:
+                out.write('native content')
+            self.repo.hg_commit('Native change')
+            self.assertEqual(fields(self.repo[0:'tip']), fields(native_repo[0:'tip']))
+            self.assertEqual(self.repo.hg_heads(), native_repo.hg_heads())
+
+            # Descriptions are stripped, as by hg's {desc}
+            message_path = os.path.join(self._test_dir_path, '.hg', 'hgapi_message.txt')
+            with open(message_path, 'w') as f:
+                f.write('  leading space desc\n\nbody\t \n\n')
+            with open(self._test_file('file8.txt'), 'a') as out:
+                out.write('whitespace')
+            self.repo.hg_command(None, 'commit', '-l', message_path, '-u', self._user)
+            os.remove(message_path)
+            self.assertEqual('leading space desc\n\nbody', self.repo['tip'].desc)
+            self.assertEqual(fields([self.repo['tip']]), fields([native_repo['tip']]))
+
+        # Heads are extended from the previous tip, reading only the new changelog entries
+        def hg_heads():
+            return self.repo.hg_command(None, 'heads', '--template', '{node}\n').split()
+        reader = revlog.ChangelogReader(self._test_dir_path)
+        self.assertEqual(hg_heads(), reader.heads())
+        entries_read = []
+        read_entry = reader.entry
+        reader.entry = lambda rev: entries_read.append(rev)  or  read_entry(rev)
+        with open(self._test_file('file8.txt'), 'a') as out:
+            out.write('heads')
+        self.repo.hg_commit('Heads change')
+        reader.refresh()
+        self.assertEqual(hg_heads(), reader.heads())
+        self.assertEqual([reader.tip_rev], entries_read)
+        reader.close()
+
+        # Revisions that the reader cannot decode are read by hg
+        def unsupported(self, rev, tags_by_node):
+            raise revlog.RevlogUnsupportedError('unsupported')
+        supported = revlog.ChangelogReader.revision
+        revlog.ChangelogReader.revision = unsupported
+        try:
+            with hgapi.Repo(self._test_dir_path, user=self._user, native_revlog=True) as native_repo:
+                self.assertEqual(fields([self.repo['tip']]), fields([native_repo['tip']]))
+                self.assertEqual(fields(self.repo[0:'tip']), fields(native_repo[0:'tip']))
+        finally:
+            revlog.ChangelogReader.revision = supported
+
+        # Delta chains and separate data files, checked against hg debugdata
+        manifest = revlog.Revlog(os.path.join(self._test_dir_path, '.hg', 'store', '00manifest.i'))
+        for rev in range(len(manifest)):
+            self.assertEqual(self.repo.hg_command(None, 'debugdata', '-m', str(rev)).encode('utf-8'), manifest.revision(rev))
+        manifest.close()
+        # A description too large to keep the changelog inline
+        import hashlib
+        message_path = os.path.join(self._test_dir_path, '.hg', 'hgapi_message.txt')
+        with open(message_path, 'w') as f:
+            f.write('\n'.join([hashlib.sha1(str(i).encode('ascii')).hexdigest()   for i in range(8000)]))
+        with open(self._test_file('file8.txt'), 'a') as out:
+            out.write('long description')
+        self.repo.hg_command(None, 'commit', '-l', message_path, '-u', self._user)
+        os.remove(message_path)
+        with hgapi.Repo(self._test_dir_path, user=self._user, native_revlog=True) as native_repo:
+            self.assertTrue(os.path.exists(os.path.join(self._test_dir_path, '.hg', 'store', '00changelog.d')))
+            self.assertEqual(fields(self.repo[0:'tip']), fields(native_repo[0:'tip']))
+
+        # Unsupported requirements fall back to hg
+        requires_path = os.path.join(self._test_dir_path, '.hg', 'requires')
+        with open(requires_path, 'rb') as f:
+            requires = f.read()
+        try:
+            with open(requires_path, 'ab') as f:
+                f.write(b'hgapi-unknown-feature\n')
+            self.assertRaises(revlog.RevlogUnsupportedError, lambda: revlog.ChangelogReader(self._test_dir_path))
+        finally:
+            with open(requires_path, 'wb') as f:
+                f.write(requires)
+
+        # A new repository has no changelog file until the first commit
+        empty_path = tempfile.mkdtemp(prefix='testhgapi_empty')
+        try:
+            empty_repo = hgapi.Repo.hg_init(empty_path, user=self._user)
+            # With hg's default configuration, share-safe moves the store requirements to .hg/store/requires
+            requirements = revlog.read_requirements(os.path.join(empty_path, '.hg'))
+            self.assertTrue('revlogv1' in requirements)
+            if 'share-safe' in requirements:
+                with open(os.path.join(empty_path, '.hg', 'requires'), 'rb') as f:
+                    self.assertFalse(b'revlogv1' in f.read())
+            with hgapi.Repo(empty_path, user=self._user, native_revlog=True) as native_repo:
+                self.assertEqual(revlog.ZSTD_AVAILABLE  or  'revlog-compression-zstd' not in requirements, native_repo.uses_native_revlog)
+                if not native_repo.uses_native_revlog:
+                    return
+                self.assertEqual(fields([empty_repo['tip']]), fields([native_repo['tip']]))
+                self.assertEqual(-1, native_repo['tip'].rev)
+                self.assertRaises(hgapi.HGHeadsNoHeads, native_repo.hg_heads)
+                with open(os.path.join(empty_path, 'first.txt'), 'w') as out:
+                    out.write('first')
+                empty_repo.hg_add('first.txt')
+                empty_repo.hg_commit('First')
+                self.assertEqual(fields(empty_repo[0:'tip']), fields(native_repo[0:'tip']))
+                self.assertEqual(empty_repo.hg_heads(), native_repo.hg_heads())
+        finally:
+            shutil.rmtree(empty_path)
+
+
+    def test_510_dirstate(self):
+        import revlog
+        def hg_parents():
+            return self.repo.hg_command(None, 'parents', '--template', '{node}\n').split()
+
+        self.assertEqual(self.repo.hg_command(None, 'id', '-i').strip('\n +'), self.repo.hg_id())
+        self.assertEqual(int(self.repo.hg_command(None, 'id', '-n').strip('\n +')), self.repo.hg_rev())
+        self.assertEqual(self.repo.hg_command(None, 'log', '-r', '.', '--template', '{node}'), self.repo.hg_node())
+        self.assertEqual(hg_parents(), self.repo.working_copy_parents())
+        self.assertEqual(self.repo.hg_branch(), self.repo.working_copy_branch())
+
+        # hg_rev looks the working copy parent up in the changelog, without running hg
+        with hgapi.Repo(self._test_dir_path, user=self._user) as repo:
+            commands = []
+            hg_command = repo.hg_command
+            def counting_hg_command(return_code_handler, *args):
+                commands.append(args)
+                return hg_command(return_code_handler, *args)
+            repo.hg_command = counting_hg_command
+            self.assertEqual(self.repo.hg_rev(), repo.hg_rev())
+            requirements = revlog.read_requirements(os.path.join(self._test_dir_path, '.hg'))
+            if requirements.issubset(revlog.supported_requirements()):
+                self.assertEqual([], commands)
+
+        # The file table agrees with hg
+        state = self.repo.dirstate()
+        self.assertEqual(1, state.version)
+        self.assertEqual(set(self.repo.hg_command(None, 'manifest').split('\n')) - {''}, set(state.entries.keys()))
+        self.repo.hg_command(None, 'copy', 'file8.txt', 'file8_copy.txt')
+        state = self.repo.dirstate()
+        self.assertEqual('a', state.entries['file8_copy.txt'].state)
+        self.assertEqual('file8.txt', state.entries['file8_copy.txt'].copy_source)
+        self.repo.hg_revert(all=True)
+        os.remove(self._test_file('file8_copy.txt'))
+
+        # Merges in progress have two parents
+        tip = self.repo['tip']
+        self.repo.hg_update(tip.parents[0])
+        with open(self._test_file('file_dirstate.txt'), 'w') as out:
+            out.write('other head')
+        self.repo.hg_add('file_dirstate.txt')
+        self.repo.hg_commit('Other head')
+        self.assertEqual(self.repo.hg_command(None, 'id', '-n').strip('\n +'), str(self.repo.hg_rev()))
+        self.repo.hg_merge(tip.node)
+        self.assertEqual(2, len(self.repo.working_copy_parents()))
+        self.assertEqual(hg_parents(), self.repo.working_copy_parents())
+        self.assertEqual(self.repo.hg_command(None, 'id', '-i').strip('\n +'), self.repo.hg_id())
+        self.assertEqual(self.repo.dirstate().parents, self.repo.working_copy_parents())
+        self.repo.hg_commit('Merge other head')
+        self.assertEqual(self.repo['tip'].node, self.repo.hg_node())
+        self.assertEqual(self.repo['tip'].rev, self.repo.hg_rev())
+
+
+    def test_520_branch_cache(self):
+        current = self.repo.hg_branch()
+        self.repo.hg_branch('branch with spaces')
+        with open(self._test_file('file_branch.txt'), 'w') as out:
+            out.write('branch with spaces')
+        self.repo.hg_add('file_branch.txt')
+        self.repo.hg_commit('Branch with spaces')
+        self.repo.hg_commit('Close branch with spaces', close_branch=True)
+        self.repo.hg_update(current)
+
+        def hg_branches():
+            res = self.repo.hg_command(None, 'branches', '--closed', '--template', '{branch}\t{rev}:{node|short}\n')
+            return [tuple(line.split('\t'))   for line in res.split('\n')   if line]
+
+        cache_path = os.path.join(self._test_dir_path, '.hg', 'cache', 'branch2-served')
+        with hgapi.Repo(self._test_dir_path, user=self._user) as repo:
+            commands = []
+            hg_command = repo.hg_command
+            def counting_hg_command(return_code_handler, *args):
+                commands.append(args)
+                return hg_command(return_code_handler, *args)
+            repo.hg_command = counting_hg_command
+
+            # Read from hg's branch cache
+            self.assertTrue(os.path.exists(cache_path))
+            branches = repo.get_branches(show_closed=True)
+            self.assertEqual(hg_branches(), [(b['name'], b['version'])   for b in branches])
+            self.assertEqual(self.repo.hg_command(None, 'heads', '--template', '{node}\n').split(), repo.hg_heads())
+            self.assertTrue([b['closed']   for b in branches   if b['name'] == 'branch with spaces'][0])
+            self.assertFalse('branch with spaces' in repo.get_branch_names())
+            self.assertEqual([], commands)
+
+            # Without a valid cache, hg is run once per tip
+            with open(self._test_file('file_branch.txt'), 'a') as out:
+                out.write('default')
+            self.repo.hg_add('file_branch.txt')
+            self.repo.hg_commit('Change on {0}'.format(current))
+            os.remove(cache_path)
+            branches = repo.get_branches(show_closed=True)
+            self.assertEqual(hg_branches(), [(b['name'], b['version'])   for b in branches])
+            self.assertEqual(branches, repo.get_branches(show_closed=True))
+            self.assertEqual([b['name']   for b in branches   if b['active']], repo.get_branch_names(active_only=True))
+            self.assertEqual(1, len(commands))
+
+        # A repository made by hg init with the default configuration (share-safe, where the store requirements
+        # are in .hg/store/requires)
+        import revlog
+        default_path = tempfile.mkdtemp(prefix='testhgapi_default')
+        try:
+            default_repo = hgapi.Repo.hg_init(default_path, user=self._user)
+            with open(os.path.join(default_path, 'file.txt'), 'w') as out:
+                out.write('default')
+            default_repo.hg_add('file.txt')
+            default_repo.hg_commit('Default')
+            expected = default_repo.get_branches()
+            with hgapi.Repo(default_path, user=self._user) as repo:
+                commands = []
+                hg_command = repo.hg_command
+                def counting_hg_command(return_code_handler, *args):
+                    commands.append(args)
+                    return hg_command(return_code_handler, *args)
+                repo.hg_command = counting_hg_command
+                self.assertEqual(expected, repo.get_branches())
+                self.assertEqual(default_repo.hg_command(None, 'heads', '--template', '{node}\n').split(), repo.hg_heads())
+                if revlog.read_requirements(os.path.join(default_path, '.hg')).issubset(revlog.supported_requirements()):
+                    self.assertEqual([], commands)
+        finally:
+            shutil.rmtree(default_path)
+
+
+    def test_530_bulk_file_operations(self):
+        names = ['bulk/file{0}.txt'.format(i)   for i in range(40)] + ['bulk/with space.txt']
+        os.mkdir(self._test_file('bulk'))
+        for name in names:
+            with open(self._test_file(name), 'w') as out:
+                out.write(name)
+
+        result = self.repo.hg_add_many(names[:20] + ['bulk/missing.txt'])
+        self.assertEqual(names[:20], result.succeeded)
+        self.assertEqual(['bulk/missing.txt'], list(result.failed.keys()))
+        self.assertFalse(result.ok)
+        # Passed through a list file when they do not fit on the command line
+        fits_on_command_line = hgapi.fits_on_command_line
+        hgapi.fits_on_command_line = lambda args: False
+        try:
+            result = self.repo.hg_add_many(names[19:])
+        finally:
+            hgapi.fits_on_command_line = fits_on_command_line
+        self.assertEqual(names[20:], result.succeeded)
+        self.assertEqual({'bulk/file19.txt': 'already tracked!'}, result.failed)
+        self.assertEqual(set(names), self.repo.hg_status().added)
+        self.repo.hg_commit('Bulk add')
+
+        result = self.repo.hg_move_many({'bulk/file0.txt': 'bulk2/file0.txt', 'bulk/file1.txt': 'bulk2/file1.txt',
+                                         'bulk/file2.txt': 'bulk/renamed2.txt', 'bulk/nothere.txt': 'bulk2/nothere.txt'})
+        self.assertEqual(['bulk/nothere.txt'], list(result.failed.keys()))
+        self.assertEqual({'bulk2/file0.txt', 'bulk2/file1.txt', 'bulk/renamed2.txt'}, self.repo.hg_status().added)
+        result = self.repo.hg_copy_many([('bulk/file3.txt', 'bulk/file4.txt'), ('bulk/file5.txt', 'bulk3/file5.txt')])
+        self.assertEqual(['bulk/file5.txt'], result.succeeded)
+        self.assertTrue('not overwriting' in result.failed['bulk/file3.txt'])
+        # hg aborts when none of the files can be copied
+        result = self.repo.hg_copy_many([('bulk/nothere.txt', 'bulk4/nothere.txt')])
+        self.assertEqual([], result.succeeded)
+        self.assertEqual(['bulk/nothere.txt'], list(result.failed.keys()))
+
+        result = self.repo.hg_remove_many(names[10:] + ['bulk/untracked.txt'])
+        self.assertEqual(names[10:], result.succeeded)
+        self.assertEqual(set(names[10:] + names[:3]), self.repo.hg_status().removed)
+        self.repo.hg_commit('Bulk changes')
+
+
+    def test_540_listfile_selections(self):
+        with hgapi.Repo(self._test_dir_path, user=self._user) as repo:
+            repo.LISTFILE_THRESHOLD = 2
+            commands = []
+            hg_command = repo.hg_command
+            def recording_hg_command(return_code_handler, *args):
+                commands.append(args)
+                return hg_command(return_code_handler, *args)
+            repo.hg_command = recording_hg_command
+
+            names = ['bulk/file{0}.txt'.format(i)   for i in range(3, 8)]
+            for name in names:
+                with open(self._test_file(name), 'a') as out:
+                    out.write('listfile')
+            status = repo.hg_status(names[:4])
+            self.assertEqual(set(names[:4]), status.modified)
+            repo.hg_revert(False, *names[3:])
+            self.assertEqual(set(names[:3]), repo.hg_status().modified)
+            repo.hg_commit('Listfile commit', files=names[:3])
+            self.assertFalse(repo.hg_status().has_modified_files())
+            self.assertEqual(set(names[:3]), set(repo.hg_command(None, 'log', '-r', 'tip', '--template', '{files}').split()))
+            listfile_commands = [args[0]   for args in commands   if [a   for a in args   if a.startswith('listfile0:')]]
+            self.assertEqual(['status', 'commit'], listfile_commands)
+            repo.hg_revert(all=True)
+
+
+    def test_550_async_repo(self):
+        if sys.version_info < (3, 5):
+            self.skipTest('asyncio requires Python 3.5')
+        import asyncio
+        from asyncrepo import AsyncRepo
+        clone_path = tempfile.mkdtemp(prefix='testhgapi_async')
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        run = loop.run_until_complete
+        try:
+            repo = AsyncRepo(self._test_dir_path, user=self._user)
+            self.assertEqual(self.repo.hg_status(), run(repo.hg_status()))
+            self.assertEqual(self.repo.hg_id(), run(repo.hg_id()))
+            self.assertEqual(self.repo.hg_node(), run(repo.hg_node()))
+            self.assertEqual([(r.node, r.desc)   for r in self.repo.revisions('0:tip')],
+                             [(r.node, r.desc)   for r in run(repo.revisions('0:tip'))])
+            self.assertRaises(hgapi.HGError, lambda: run(repo.hg_log(rev_identifier='no-such-revision')))
+            self.assertEqual(self.repo['tip'].node, run(repo.revision('tip')).node)
+            # As with Repo, an identifier that selects no revisions gives None
+            self.assertEqual(None, self.repo.revision('none()'))
+            self.assertEqual(None, run(repo.revision('none()')))
+
+            # Timeouts and cancellation kill hg
+            slow = ['--config', 'hooks.pre-identify=sleep 10', 'identify']
+            started = time.time()
+            self.assertRaises(asyncio.TimeoutError, lambda: run(repo.hg_command(None, *slow, timeout=0.5)))
+            task = loop.create_task(repo.hg_command(None, *slow))
+            run(asyncio.sleep(0.5))
+            task.cancel()
+            self.assertRaises(asyncio.CancelledError, lambda: run(task))
+            self.assertTrue(time.time() - started < 5.0)
+
+            # Progress as an async iterator
+            # An existing directory is treated as by Repo.hg_clone
+            self.assertRaises(hgapi.HGError, lambda: run(AsyncRepo.hg_clone(clone_path, self._test_dir_path, user=self._user)))
+            clone = run(AsyncRepo.hg_clone(clone_path, self._test_dir_path, user=self._user, ok_if_local_dir_exists=True))
+            self.assertEqual(self.repo.hg_node('tip'), run(clone.hg_node('tip')))
+            with open(self._test_file('file_async.txt'), 'w') as out:
+                out.write('async')
+            self.repo.hg_add('file_async.txt')
+            self.repo.hg_commit('Async pull')
+            progress = clone.hg_pull_progress()
+            lines = []
+            while True:
+                try:
+                    lines.append(run(progress.__anext__()))
+                except StopAsyncIteration:
+                    break
+            run(progress)
+            self.assertTrue(len(lines) > 0)
+            self.assertEqual(self.repo.hg_node('tip'), run(clone.hg_node('tip')))
+        finally:
+            asyncio.set_event_loop(None)
+            loop.close()
+            shutil.rmtree(clone_path, ignore_errors=True)
+
+    def test_560_transfer_progress(self):
+        import streaming
+        from subprocess import Popen, PIPE
+        # Large amounts of stderr output do not block, and the last, unterminated, line is delivered
+        proc = Popen([sys.executable, '-c', 'import sys; sys.stderr.write("e" * 200000); sys.stdout.write("a\\nb")'],
+                     stdout=PIPE, stderr=PIPE)
+        lines = []
+        out, err = streaming.stream_process(proc, lines.append)
+        self.assertEqual(['a\n', 'b'], lines)
+        self.assertEqual('a\nb', out)
+        self.assertEqual(200000, len(err))
+
+        clone_path = tempfile.mkdtemp(prefix='testhgapi_transfer')
+        try:
+            clone = hgapi.Repo.hg_clone(clone_path, self._test_dir_path, user=self._user, ok_if_local_dir_exists=True)
+            with open(self._test_file('file_transfer.txt'), 'w') as out:
+                out.write('transfer')
+            self.repo.hg_add('file_transfer.txt')
+            self.repo.hg_commit('Transfer')
+
+            events = []
+            lines = []
+            clone.hg_pull(progress_listener=lines.append, transfer_listener=events.append)
+            self.assertTrue('adding changesets' in lines)
+            phases = [e.phase   for e in events]
+            self.assertTrue('changesets' in phases  and  'files' in phases)
+            self.assertEqual('done', phases[-1])
+            self.assertEqual(1, events[-1].changesets)
+            self.assertTrue(events[-1].bytes > 0)
+            self.assertTrue(events[-1].throughput > 0.0)
+            self.assertEqual(self.repo.hg_node('tip'), clone.hg_node('tip'))
+
+            clone.hg_update('tip')
+            with open(os.path.join(clone_path, 'file_transfer.txt'), 'a') as out:
+                out.write('pushed')
+            clone.hg_commit('Transfer back')
+            events = []
+            clone.hg_push(transfer_listener=events.append)
+            self.assertEqual('done', events[-1].phase)
+            self.assertEqual(1, events[-1].changesets)
+            self.assertEqual(clone.hg_node('tip'), self.repo.hg_node('tip'))
+            self.repo.hg_update('tip')
+
+            # Over ssh; the remote hg's messages are forwarded, but hg does not report the size of pulled data
+            local_ssh = os.path.join(clone_path, '.hg', 'localssh')
+            with open(local_ssh, 'w') as out:
+                out.write('#!{0}\n'.format(sys.executable))
+                out.write('import subprocess, sys\n')
+                out.write('args = sys.argv[1:]\n')
+                out.write('while args[0].startswith("-"):\n')
+                out.write('    args = args[2:]   if args[0] in ("-l", "-i", "-o", "-p")   else args[1:]\n')
+                out.write('sys.exit(subprocess.call(" ".join(args[1:]), shell=True))\n')
+            os.chmod(local_ssh, 0o755)
+            remote = 'ssh://localhost/' + self._test_dir_path
+            with open(os.path.join(clone_path, '.hg', 'hgrc'), 'a') as out:
+                out.write('\n[ui]\nssh = {0}\n[paths]\ndefault-push = {1}\n'.format(local_ssh, remote))
+            with open(self._test_file('file_transfer.txt'), 'a') as out:
+                out.write('remote')
+            self.repo.hg_commit('Transfer over ssh')
+            events = []
+            clone.hg_pull(transfer_listener=events.append, source=remote)
+            phases = [e.phase   for e in events]
+            self.assertTrue('changesets' in phases  and  'added' in phases)
+            self.assertEqual(1, events[-1].changesets)
+            self.assertEqual(None, events[-1].bytes)
+            self.assertEqual(None, events[-1].throughput)
+            self.assertEqual(self.repo.hg_node('tip'), clone.hg_node('tip'))
+
+            clone.hg_update('tip')
+            with open(os.path.join(clone_path, 'file_transfer.txt'), 'a') as out:
+                out.write('pushed over ssh')
+            clone.hg_commit('Transfer back over ssh')
+            events = []
+            clone.hg_push(transfer_listener=events.append)
+            phases = [e.phase   for e in events]
+            self.assertTrue('changesets' in phases  and  'added' in phases)
+            self.assertTrue([e   for e in events   if e.message == 'adding changesets'])
+            self.assertEqual(1, events[-1].changesets)
+            self.assertTrue(events[-1].bytes > 0)
+            self.assertTrue(events[-1].throughput > 0.0)
+            self.assertEqual(clone.hg_node('tip'), self.repo.hg_node('tip'))
+            self.repo.hg_update('tip')
+
+            # Only progress bars are taken out of the error output; errors that end in a number are kept
+            progress = streaming.TransferProgress(events.append)
+            self.assertTrue(progress.stderr_segment('changesets 1/2 chunks\r'))
+            # Topics that TransferProgress does not know of, such as ones added by extensions, are passed on as phases
+            self.assertTrue(progress.stderr_segment('fetching largefiles 3 files\r'))
+            self.assertEqual(('fetching largefiles', 3, None, 'files'), (events[-1].phase, events[-1].position, events[-1].total, events[-1].unit))
+            self.assertFalse(progress.stderr_segment('remote: error code 255\n'))
+            fake_ssh = os.path.join(clone_path, '.hg', 'fakessh')
+            with open(fake_ssh, 'w') as out:
+                out.write('#!{0}\n'.format(sys.executable))
+                out.write('import sys\n')
+                out.write('sys.stderr.write("ssh: connect to host example.com port 22\\n")\n')
+                out.write('sys.exit(255)\n')
+            os.chmod(fake_ssh, 0o755)
+            with open(os.path.join(clone_path, '.hg', 'hgrc'), 'a') as out:
+                out.write('\n[ui]\nssh = {0}\n'.format(fake_ssh))
+            events = []
+            try:
+                clone.hg_pull(transfer_listener=events.append, source='ssh://example.com/repo')
+                self.fail('pull from an unreachable host succeeded')
+            except hgapi.HGBaseError as e:
+                self.assertTrue('ssh: connect to host example.com port 22' in str(e))
+            self.assertFalse([e   for e in events   if e.phase  and  e.phase.startswith('ssh')])
+        finally:
+            shutil.rmtree(clone_path)
+
+
+    def test_570_repo_group(self):
+        import repogroup
+        self.assertEqual('example.com', repogroup.remote_host('ssh://user@Example.com:2222/repo'))
+        self.assertEqual(None, repogroup.remote_host('/tmp/repo'))
+        self.assertEqual(None, repogroup.remote_host('file:///tmp/repo'))
+        self.assertEqual(None, repogroup.remote_host('C:\\repos\\repo'))
+
+        # Remote operations are limited per host, without holding up other hosts
+        class _FakeRepo (object):
+            def __init__(self, path, host):
+                self.path = path
+                self.host = host
+                self.default = 'ssh://{0}/{1}'.format(host, path)
+            def config(self, section, key):
+                config_threads.add(threading.current_thread())
+                return self.default
+            def hg_pull(self, source=None):
+                host = repogroup.remote_host(source)   if source is not None   else self.host
+                with lock:
+                    running[host] = running.get(host, 0) + 1
+                    peak[host] = max(peak.get(host, 0), running[host])
+                time.sleep(0.05)
+                with lock:
+                    running[host] -= 1
+                if self.path == 'a3':
+                    raise hgapi.HGRepoUnrelated('unrelated')
+                return self.path
+        import threading
+        lock = threading.Lock()
+        running = {}
+        peak = {}
+        config_threads = set()
+        fakes = [_FakeRepo('a{0}'.format(i), 'a')   for i in range(6)] + [_FakeRepo('b{0}'.format(i), 'b')   for i in range(3)]
+        results = hgapi.RepoGroup(fakes, max_workers=5, max_per_host=2).run('hg_pull')
+        self.assertEqual([f.path   for f in fakes], [r.repo.path   for r in results])
+        self.assertEqual({'a': 2, 'b': 2}, peak)
+        # Hosts are looked up by the workers, not one by one before any work starts
+        self.assertFalse(threading.current_thread() in config_threads)
+        self.assertEqual(['a0', 'a1', 'a2', None, 'a4', 'a5', 'b0', 'b1', 'b2'], [r.value   for r in results])
+        self.assertTrue(isinstance(results[3].error, hgapi.HGRepoUnrelated))
+        self.assertRaises(hgapi.HGRepoUnrelated, results[3].get)
+        # An explicit source is limited by its own host, rather than the default paths'
+        peak.clear()
+        results = hgapi.RepoGroup(fakes, max_workers=5, max_per_host=2).run('hg_pull', source='ssh://upstream.example.com/repo')
+        self.assertEqual({'upstream.example.com': 2}, peak)
+        # map() and run() with a function accept objects other than Repos
+        results = hgapi.RepoGroup(['x', 'y']).run(lambda name: name.upper())
+        self.assertEqual(['X', 'Y'], [r.value   for r in results])
+        self.assertTrue(repr(results[0]).startswith("RepoResult(path='x', value='X'"))
+
+        # Real repositories; the last has no default path to pull from
+        clone_paths = [tempfile.mkdtemp(prefix='testhgapi_group')   for i in range(4)]
+        try:
+            clones = [hgapi.Repo.hg_clone(p, self._test_dir_path, user=self._user, ok_if_local_dir_exists=True)   for p in clone_paths[:3]]
+            with open(self._test_file('file_group.txt'), 'w') as out:
+                out.write('group')
+            self.repo.hg_add('file_group.txt')
+            self.repo.hg_commit('Group')
+            broken = hgapi.Repo.hg_init(clone_paths[3], user=self._user)
+            group = hgapi.RepoGroup(clones + [broken], max_workers=4)
+            completed = list(group.hg_pull())
+            self.assertEqual(4, len(completed))
+            self.assertEqual([0, 1, 2, 3], sorted([r.index   for r in completed]))
+            for r in completed:
+                self.assertEqual(r.index != 3, r.ok)
+            self.assertTrue(isinstance([r   for r in completed   if r.index == 3][0].error, hgapi.HGRepoUnrelated))
+            results = group.run('hg_update', 'tip')
+            self.assertEqual([True, True, True, True], [r.ok   for r in results])
+            tip = self.repo.hg_node('tip')
+            self.assertEqual([tip] * 3, [r.value   for r in hgapi.RepoGroup(clones).run(lambda repo: repo.hg_node('tip'))])
+            # The clones share a local default path, so they push one at a time
+            results = hgapi.RepoGroup(clones, max_per_host=1).run('hg_push')
+            self.assertTrue(all([isinstance(r.error, hgapi.HGPushNothingToPushError)   for r in results]))
+        finally:
+            for p in clone_paths:
+                shutil.rmtree(p)
+
+
+    def test_580_ssh_session_manager(self):
+        import json, socket
+        if sys.platform.startswith('linux'):
+            self.assertEqual(hgapi.PLATFORM_LINUX, hgapi._get_platform())
+        work_dir = tempfile.mkdtemp(prefix='testhgapi_ssh')
+        try:
+            # Stands in for ssh: logs its arguments, and runs the remote command locally
+            log_path = os.path.join(work_dir, 'ssh.log')
+            fake_ssh = os.path.join(work_dir, 'fakessh')
+            with open(fake_ssh, 'w') as out:
+                out.write('#!{0}\n'.format(sys.executable))
+                out.write('import json, os, subprocess, sys\n')
+                out.write('with open({0!r}, "a") as log:\n'.format(str(log_path)))
+                out.write('    log.write(json.dumps(sys.argv[1:]) + "\\n")\n')
+                out.write('args = sys.argv[1:]\n')
+                out.write('while args[0].startswith("-"):\n')
+                out.write('    args = args[2:]   if args[0] in ("-l", "-i", "-o", "-p", "-O", "-S")   else args[1:]\n')
+                out.write('if "-O" in sys.argv:\n')
+                out.write('    sys.exit(0)\n')
+                out.write('sys.exit(subprocess.call(" ".join(args[1:]), shell=True))\n')
+            os.chmod(fake_ssh, 0o755)
+            key_path = os.path.join(work_dir, 'id_test')
+            with open(key_path, 'w') as out:
+                out.write('key')
+
+            manager = hgapi.SSHSessionManager(ssh_executable=fake_ssh, persist=30)
+            hgapi.set_ssh_session_manager(manager)
+            try:
+                clone_path = os.path.join(work_dir, 'clone')
+                clone = hgapi.Repo.hg_clone(clone_path, 'ssh://localhost/' + self._test_dir_path, user=self._user,
+                                            ssh_key_path=key_path)
+                clone.hg_pull()
+                self.assertEqual(self.repo.hg_node('tip'), clone.hg_node('tip'))
+            finally:
+                hgapi.set_ssh_session_manager(None)
+
+            with open(log_path) as f:
+                invocations = [json.loads(line)   for line in f]
+            self.assertEqual(2, len(invocations))
+            control_path = manager.control_path(key_path)
+            self.assertTrue(control_path.startswith(manager.control_dir))
+            for argv in invocations:
+                self.assertTrue('ControlMaster=auto' in argv)
+                self.assertTrue('ControlPersist=30' in argv)
+                self.assertTrue('ControlPath={0}'.format(control_path) in argv)
+                self.assertEqual(key_path, argv[argv.index('-i') + 1])
+            self.assertNotEqual(control_path, manager.control_path(fake_ssh))
+
+            # Without a key, e.g. when authenticating through ssh-agent, connections are shared all the same
+            hgapi.set_ssh_session_manager(manager)
+            try:
+                keyless_clone = hgapi.Repo(clone_path, user=self._user)
+                keyless_clone.hg_pull()
+            finally:
+                hgapi.set_ssh_session_manager(None)
+            with open(log_path) as f:
+                argv = json.loads(f.readlines()[-1])
+            self.assertFalse('-i' in argv)
+            self.assertTrue('ControlPath={0}'.format(manager.control_path(None)) in argv)
+            self.assertTrue(os.path.basename(manager.control_path(None)).startswith('nokey-'))
+
+            # Closing shuts down the masters, and removes the control directory
+            master = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                socket_path = os.path.join(manager.control_dir, 'master')
+                master.bind(socket_path)
+                self.assertEqual([socket_path], manager.sockets())
+                manager.close()
+            finally:
+                master.close()
+            with open(log_path) as f:
+                last = json.loads(f.readlines()[-1])
+            self.assertEqual(['-o', 'ControlPath={0}'.format(socket_path), '-O', 'exit', 'localhost'], last)
+            self.assertFalse(os.path.exists(manager.control_dir))
+            self.assertRaises(ValueError, manager.ssh_options, key_path)
+        finally:
+            shutil.rmtree(work_dir)
+
+
+    def test_590_mirror(self):
+        import mirror
+        work_dir = tempfile.mkdtemp(prefix='testhgapi_mirror')
+        try:
+            clock = [1000.0]
+            def _clock():
+                return clock[0]
+            good = mirror.Mirror(self._test_dir_path, os.path.join(work_dir, 'good'), interval=60, clock=_clock)
+            bad = mirror.Mirror(os.path.join(work_dir, 'missing'), os.path.join(work_dir, 'bad'), interval=60,
+                                retry_delay=10, max_retry_delay=25, clock=_clock)
+            daemon = mirror.MirrorDaemon([good, bad], clock=_clock)
+
+            self.assertEqual({good: mirror.SYNC_CLONED, bad: mirror.SYNC_FAILED}, daemon.sync_due())
+            tip = self.repo.hg_node('tip')
+            self.assertEqual(tip, good.repo.hg_node('tip'))
+            metrics = daemon.metrics()[good.path]
+            self.assertEqual(1, metrics.pulls)
+            self.assertEqual(int(self.repo.hg_command(None, 'log', '-r', 'tip', '--template', '{rev}')) + 1, metrics.changesets_fetched)
+            self.assertEqual(1060.0, metrics.next_check_time)
+            self.assertEqual(0.0, metrics.lag)
+            metrics = bad.metrics
+            self.assertEqual(1, metrics.consecutive_failures)
+            self.assertTrue(isinstance(metrics.last_error, hgapi.HGBaseError))
+            self.assertEqual(None, metrics.lag)
+
+            # Exponential backoff, up to max_retry_delay
+            for expected_next in [1030.0, 1055.0, 1080.0]:
+                clock[0] = bad.metrics.next_check_time
+                self.assertEqual({bad: mirror.SYNC_FAILED}, daemon.sync_due())
+                self.assertEqual(expected_next, bad.metrics.next_check_time)
+            daemon.remove(bad)
+
+            # Nothing has changed upstream, so nothing is pulled
+            clock[0] = 1060.0
+            self.assertEqual({good: mirror.SYNC_UNCHANGED}, daemon.sync_due())
+            metrics = good.metrics
+            self.assertEqual((1, 1), (metrics.pulls, metrics.skipped))
+            self.assertEqual({}, daemon.sync_due())
+
+            with open(self._test_file('file_mirror.txt'), 'w') as out:
+                out.write('mirror')
+            self.repo.hg_add('file_mirror.txt')
+            self.repo.hg_commit('Mirror')
+            clock[0] = 1200.0
+            self.assertEqual({good: mirror.SYNC_PULLED}, daemon.sync_due())
+            self.assertEqual(self.repo.hg_node('tip'), good.repo.hg_node('tip'))
+            clock[0] = 1210.0
+            metrics = good.metrics
+            self.assertEqual(2, metrics.pulls)
+            self.assertEqual(1, metrics.last_fetched)
+            self.assertTrue(metrics.bytes_fetched > 0)
+            self.assertEqual(10.0, metrics.lag)
+
+            # The mirror has the upstream's tip, even though its own tip differs
+            with open(os.path.join(good.path, 'local.txt'), 'w') as out:
+                out.write('local')
+            good.repo.hg_add('local.txt')
+            good.repo.hg_command(None, 'commit', '-u', self._user, '-m', 'Local')
+            clock[0] = good.metrics.next_check_time
+            self.assertEqual({good: mirror.SYNC_UNCHANGED}, daemon.sync_due())
+
+            # Pulls are made from the upstream, not from the mirror's default path
+            with open(os.path.join(good.path, '.hg', 'hgrc'), 'w') as out:
+                out.write('[paths]\ndefault = {0}\n'.format(os.path.join(work_dir, 'missing')))
+            with open(self._test_file('file_mirror.txt'), 'a') as out:
+                out.write('again')
+            self.repo.hg_commit('Mirror again')
+            clock[0] = good.metrics.next_check_time
+            self.assertEqual({good: mirror.SYNC_PULLED}, daemon.sync_due())
+            upstream_tip = self.repo.hg_node('tip')
+            self.assertEqual(upstream_tip, good.repo.hg_node(upstream_tip))
+
+            # Unexpected errors are recorded as failed syncs
+            good.upstream_tip = lambda repo: [][0]
+            clock[0] = good.metrics.next_check_time
+            self.assertEqual({good: mirror.SYNC_FAILED}, daemon.sync_due())
+            self.assertTrue(isinstance(good.metrics.last_error, IndexError))
+            del good.upstream_tip
+
+            # In the background, with the real clock
+            daemon = mirror.MirrorDaemon([mirror.Mirror(self._test_dir_path, os.path.join(work_dir, 'background'))])
+            daemon.start()
+            try:
+                t_end = time.time() + 60
+                while daemon.metrics()[os.path.join(work_dir, 'background')].pulls == 0  and  time.time() < t_end:
+                    time.sleep(0.1)
+            finally:
+                daemon.stop()
+            self.assertEqual(self.repo.hg_node('tip'), daemon.mirrors[0].repo.hg_node('tip'))
+
+            # A mirror added while the daemon waits with nothing to do is synced without waiting for anything else
+            daemon = mirror.MirrorDaemon()
+            daemon.start()
+            try:
+                time.sleep(0.2)
+                added = daemon.add(mirror.Mirror(self._test_dir_path, os.path.join(work_dir, 'added')))
+                t_end = time.time() + 60
+                while added.metrics.pulls == 0  and  time.time() < t_end:
+                    time.sleep(0.1)
+                self.assertEqual(1, added.metrics.pulls)
+                daemon.remove(added)
+                self.assertEqual([], daemon.mirrors)
+            finally:
+                daemon.stop(60)
+        finally:
+            shutil.rmtree(work_dir)
+
+
 
 
 
@@ -0,0 +1,271 @@
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import struct
+import sys
+import threading
+
+
+
+
+_IN_MODIFY = 0x00000002
+_IN_ATTRIB = 0x00000004
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_FROM = 0x00000040
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+_IN_DELETE = 0x00000200
+_IN_DELETE_SELF = 0x00000400
+_IN_MOVE_SELF = 0x00000800
+_IN_Q_OVERFLOW = 0x00004000
+_IN_IGNORED = 0x00008000
+_IN_ONLYDIR = 0x01000000
+_IN_DONT_FOLLOW = 0x02000000
+_IN_EXCL_UNLINK = 0x04000000
+_IN_ISDIR = 0x40000000
+
+_IN_NONBLOCK = 0o4000
+_IN_CLOEXEC = 0o2000000
+
+_WATCH_MASK = _IN_MODIFY | _IN_ATTRIB | _IN_CLOSE_WRITE | _IN_MOVED_FROM | _IN_MOVED_TO | _IN_CREATE | _IN_DELETE |\
+              _IN_DELETE_SELF | _IN_MOVE_SELF | _IN_ONLYDIR | _IN_DONT_FOLLOW | _IN_EXCL_UNLINK
+
+_EVENT_HEADER = struct.Struct(str('iIII'))
+
+# Files directly inside .hg whose modification can change the status of any file
+_HG_STATUS_FILES = frozenset(['dirstate', 'branch', 'merge'])
+# Files in the root of the working copy whose modification can change the status of any file
+_ROOT_STATUS_FILES = frozenset(['.hgignore'])
+
+_log = logging.getLogger(__name__)
+
+
+def _load_libc():
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library(str('c'))  or  str('libc.so.6'), use_errno=True)
+        libc.inotify_init1
+        libc.inotify_add_watch
+    except (OSError, AttributeError):
+        return None
+    libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    return libc
+
+_libc = _load_libc()
+
+
+def is_available():
+    """Determine if inotify can be used on this platform"""
+    return _libc is not None
+
+
+
+
+class WatcherUnavailableError (Exception):
+    pass
+
+
+
+
+class WorkingCopyWatcher (object):
+    """Watches a working copy for modifications using Linux inotify, from a background thread.
+
+    Every directory of the working copy is watched, along with the top level of .hg (only changes to the dirstate,
+    branch and merge state are of interest there). Paths that have been touched since they were last taken with
+    take_dirty() are accumulated; a modification that could affect the status of any file (such as a commit or
+    update modifying the dirstate, an edit to .hgignore, or the kernel's event queue overflowing) marks the whole
+    working copy as dirty.
+
+    on_modified, if not None, is called from the watcher thread once no further modifications have occurred for
+    debounce seconds. Exceptions that it raises are logged, and do not stop the watcher.
+
+    Between suppress_notifications() and resume_notifications(), modifications do not cause on_modified to be called
+    and changes to the files in .hg are ignored entirely; use these around commands whose effects the caller accounts
+    for itself (by calling mark_all_dirty() if needed). Paths touched in the working copy meanwhile are still
+    accumulated, and once notifications resume, on_modified is called for them unless the caller reports them itself
+    by calling notification_delivered() first. With working_copy=False, only changes to the files in .hg are ignored;
+    use this around read-only commands, which may rewrite the dirstate but leave the working copy alone.
+    """
+    def __init__(self, root, on_modified=None, debounce=0.2):
+        if _libc is None:
+            raise WatcherUnavailableError('inotify is not available on this platform')
+        self.root = os.path.abspath(root)
+        self.__on_modified = on_modified
+        self.__debounce = debounce
+        self.__lock = threading.Lock()
+        self.__dirty = set()
+        self.__all_dirty = True
+        self.__notify_pending = False
+        self.__suppressed = 0
+        self.__hg_suppressed = 0
+        self.__missed = False
+        self.__dir_by_wd = {}
+        self.__closed = False
+
+        self.__fd = _libc.inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+        if self.__fd < 0:
+            raise WatcherUnavailableError('inotify_init1 failed: {0}'.format(os.strerror(ctypes.get_errno())))
+        try:
+            self.__watch_tree('')
+            self.__add_watch('.hg')
+        except WatcherUnavailableError:
+            os.close(self.__fd)
+            raise
+
+        self.__thread = threading.Thread(target=self.__run)
+        self.__thread.daemon = True
+        self.__thread.start()
+
+
+    def __add_watch(self, rel_dir):
+        path = os.path.join(self.root, rel_dir)   if rel_dir   else self.root
+        if not isinstance(path, bytes):
+            path = path.encode(sys.getfilesystemencoding())
+        wd = _libc.inotify_add_watch(self.__fd, path, _WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err in (errno.ENOENT, errno.ENOTDIR):
+                # Removed before we got to it; the parent's event will have been recorded
+                return
+            raise WatcherUnavailableError('Could not watch {0}: {1}'.format(path, os.strerror(err)))
+        self.__dir_by_wd[wd] = rel_dir
+
+
+    def __watch_tree(self, rel_dir):
+        top = os.path.join(self.root, rel_dir)   if rel_dir   else self.root
+        for dir_path, dir_names, file_names in os.walk(top):
+            if dir_path == self.root:
+                dir_names[:] = [d   for d in dir_names   if d != '.hg']
+            self.__add_watch(os.path.relpath(dir_path, self.root)   if dir_path != self.root   else '')
+
+
+    def __drain(self):
+        """Read and process all queued events; call with the lock held. Returns True if there were any"""
+        any_events = False
+        while True:
+            try:
+                buf = os.read(self.__fd, 65536)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return any_events
+                raise
+            if not buf:
+                return any_events
+            offset = 0
+            while offset < len(buf):
+                wd, mask, cookie, name_length = _EVENT_HEADER.unpack_from(buf, offset)
+                offset += _EVENT_HEADER.size
+                name = buf[offset:offset + name_length].rstrip(b'\0').decode(sys.getfilesystemencoding(), 'replace')
+                offset += name_length
+                any_events = self.__event(wd, mask, name)   or  any_events
+
+
+    def __event(self, wd, mask, name):
+        """Process an event; returns True if it is of interest"""
+        if mask & _IN_Q_OVERFLOW:
+            self.__all_dirty = True
+            return True
+        rel_dir = self.__dir_by_wd.get(wd)
+        if mask & _IN_IGNORED:
+            self.__dir_by_wd.pop(wd, None)
+            return False
+        if rel_dir is None:
+            return False
+        if rel_dir == '.hg':
+            if name in _HG_STATUS_FILES  and  not self.__hg_suppressed:
+                self.__all_dirty = True
+                return True
+            return False
+        if mask & (_IN_DELETE_SELF | _IN_MOVE_SELF):
+            # Reported as a child of the parent directory
+            return False
+        rel_path = os.path.join(rel_dir, name)   if rel_dir   else name
+        if rel_dir == ''  and  name in _ROOT_STATUS_FILES:
+            self.__all_dirty = True
+        if (mask & _IN_ISDIR)  and  (mask & (_IN_CREATE | _IN_MOVED_TO)):
+            self.__watch_tree(rel_path)
+        self.__dirty.add(rel_path.replace(os.sep, '/'))
+        if self.__suppressed:
+            self.__missed = True
+            return False
+        return True
+
+
+    def __run(self):
+        while not self.__closed:
+            timeout = self.__debounce   if self.__notify_pending   else 1.0
+            try:
+                readable, _, _ = select.select([self.__fd], [], [], timeout)
+            except (select.error, ValueError):
+                # Closed
+                return
+            if self.__closed:
+                return
+            if readable:
+                with self.__lock:
+                    if self.__drain():
+                        self.__notify_pending = True
+            elif self.__notify_pending:
+                self.__notify_pending = False
+                if self.__on_modified is not None:
+                    try:
+                        self.__on_modified()
+                    except Exception:
+                        _log.exception('Exception in on_modified callback of watcher for %s', self.root)
+
+
+    def take_dirty(self):
+        """Get the paths (relative to the root, separated by '/') touched since the last call, and whether the
+        entire working copy must be considered dirty; returns a tuple (paths, all_dirty).
+        Events that the kernel has queued but that the watcher thread has not yet seen are included."""
+        with self.__lock:
+            if self.__drain():
+                # The watcher thread will not see these events, so would not report them
+                self.__notify_pending = True
+            dirty, all_dirty = self.__dirty, self.__all_dirty
+            self.__dirty = set()
+            self.__all_dirty = False
+        return dirty, all_dirty
+
+
+    def mark_all_dirty(self):
+        with self.__lock:
+            self.__all_dirty = True
+
+
+    def suppress_notifications(self, working_copy=True):
+        with self.__lock:
+            self.__hg_suppressed += 1
+            if working_copy:
+                self.__suppressed += 1
+
+
+    def resume_notifications(self, working_copy=True):
+        """Undo one call of suppress_notifications(). Events already queued by the kernel are processed first, so
+        that they are still treated as suppressed"""
+        with self.__lock:
+            self.__drain()
+            self.__hg_suppressed -= 1
+            if working_copy:
+                self.__suppressed -= 1
+                if self.__suppressed == 0  and  self.__missed:
+                    self.__missed = False
+                    self.__notify_pending = True
+
+
+    def notification_delivered(self):
+        """Cancel any pending call of on_modified, as the caller has reported the modifications itself"""
+        with self.__lock:
+            self.__missed = False
+            self.__notify_pending = False
+
+
+    def close(self):
+        if not self.__closed:
+            self.__closed = True
+            self.__thread.join()
+            os.close(self.__fd)